@@ -0,0 +1,165 @@
+"""
+Microbenchmarks of the preprocessing hot path on synthetic grids of increasing size: interpolation
+weights, interpolation, dataframe construction (wide, long and with xarray for reference), entry
+key, GRIB decoding and staging writes.
+Each case is run `--repeat` times and the best and median times are reported. Reports are written
+to `data/benchmarks/` and can be compared across commits like those of `run_benchmark.py`:
+
+    python scripts/benchmark_preprocessing.py --grids 1 10 100 400
+    python scripts/benchmark_preprocessing.py --grids 1 10 100 400 --compare data/benchmarks/<report>.json
+"""
+import io
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+# ---------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------
+
+ROOT_PATH = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_PATH))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import xarray as xr  # noqa: E402
+
+from src.preprocessing.interpolation import compute_weights, interpolate  # noqa: E402
+from src.preprocessing.grib_reader import read_grib_points  # noqa: E402
+from src.preprocessing.frames import dataset_to_frame  # noqa: E402
+from src.preprocessing.staging import ParquetStagingWriter, CsvStagingWriter  # noqa: E402
+from src.preprocessing.main import _add_metadata  # noqa: E402
+from fake_mars import grib_payload, netcdf_payload  # noqa: E402
+from benchmark_report import write_report, print_table, print_comparison  # noqa: E402
+
+RESULTS_PATH = ROOT_PATH / "data" / "benchmarks"
+
+# Top left corner and resolution of the synthetic grids, around the Hill of Towie wind farm
+NORTH, WEST, RESOLUTION = 57.6, -3.2, 0.1
+
+RESULT_COLUMNS = [
+    ("best (ms)", "best_ms", ".2f"),
+    ("median (ms)", "median_ms", ".2f"),
+    ("rows", "rows", "d"),
+    ("rows/s", "rows_per_s", ".0f"),
+]
+COMPARED_METRICS = ["best_ms", "rows_per_s"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the preprocessing hot path on synthetic grids.")
+    parser.add_argument("--grids", type=int, nargs="+", default=[1, 10, 100], help="Sizes of the square grids (points per side)")
+    parser.add_argument("--points", type=int, default=21, help="Number of points interpolated")
+    parser.add_argument("--issues", type=int, default=4, help="Number of issue times")
+    parser.add_argument("--steps", type=int, default=73, help="Number of hourly steps")
+    parser.add_argument("--variables", type=str, nargs="+", default=["2t", "10u", "10v", "tp"], help="Variables of the files")
+    parser.add_argument("--members", type=int, default=0, help="Number of ensemble members (0 for HRES)")
+    parser.add_argument("--method", type=str, default="linear", help="Interpolation method (linear or nearest)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each case")
+    parser.add_argument("--output", type=str, default=str(RESULTS_PATH), help="Folder of the JSON reports")
+    parser.add_argument("--compare", type=str, help="Previous JSON report to compare the results with")
+    return parser.parse_args()
+
+
+def measure(scenario: str, func, repeat: int) -> dict:
+    """ Run `func` `repeat` times. If it returns a dataframe, its rows are counted in the throughput. """
+    times, out = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - start)
+    result = {"scenario": scenario, "best_ms": 1e3 * min(times), "median_ms": 1e3 * statistics.median(times)}
+    if isinstance(out, pd.DataFrame):
+        result.update(rows=len(out), rows_per_s=len(out) / min(times))
+    return result
+
+
+def synthetic_request(args: argparse.Namespace, size: int) -> dict:
+    """ MARS request of the synthetic files, passed to the simulated MARS to generate them. """
+    south, east = NORTH - RESOLUTION * (size - 1), WEST + RESOLUTION * (size - 1)
+    request = {
+        "date": "2016-01-01",
+        "time": "/".join(f"{h:02d}" for h in range(0, 24, 24 // args.issues)[:args.issues]),
+        "step": f"0/to/{args.steps - 1}/by/1",
+        "param": args.variables,
+        "area": f"{NORTH}/{WEST}/{south:.4f}/{east:.4f}",
+        "grid": f"{RESOLUTION}/{RESOLUTION}",
+    }
+    if args.members:
+        request["number"] = f"1/to/{args.members}"
+    return request
+
+
+def benchmark_grid(args: argparse.Namespace, size: int, tmp: Path) -> list[dict]:
+    request = synthetic_request(args, size)
+    rng = np.random.default_rng(0)
+    extent = RESOLUTION * (size - 1)
+    lats = NORTH - rng.uniform(0, extent, args.points)
+    lons = WEST + rng.uniform(0, extent, args.points)
+    entry = {
+        "rowid": 1, "entry_id": "benchmark", "query_id": "benchmark", "retrieval_id": "benchmark", "model": "hres",
+        "level": "surface", "issued": "2016-01-01", "lookback_hours": 72, "step_granularity": 1,
+        "variables": ",".join(args.variables), "timestamp": "2016-01-01T00:00:00",
+    }
+    data = xr.open_dataset(io.BytesIO(netcdf_payload(request))).load()
+    grib_path = tmp / f"grid-{size}.grib"
+    grib_path.write_bytes(grib_payload(request))
+
+    interpolated = interpolate(data, lats, lons, method=args.method)
+    df = dataset_to_frame(interpolated)
+    df_metadata = _add_metadata(df, entry, np.arange(args.points))
+    parquet_writer = ParquetStagingWriter(tmp / f"staging-{size}")
+    csv_path = tmp / f"staging-{size}.csv"
+
+    def write_parquet() -> pd.DataFrame:
+        parquet_writer.write(entry, df_metadata)
+        return df_metadata
+
+    def write_csv() -> pd.DataFrame:
+        csv_path.unlink(missing_ok=True)
+        CsvStagingWriter(csv_path).write(entry, df_metadata)
+        return df_metadata
+
+    # interpolation weights are cached by `interpolate`, as when preprocessing files sharing a grid
+    cases = [
+        ("weights", lambda: compute_weights(data.latitude.values, data.longitude.values, lats, lons, args.method)),
+        ("interpolate", lambda: interpolate(data, lats, lons, method=args.method).compute()),
+        ("to-dataframe", lambda: interpolated.to_dataframe().reset_index()),  # xarray, for reference
+        ("dataframe", lambda: dataset_to_frame(interpolated)),
+        ("dataframe-long", lambda: dataset_to_frame(interpolated, "long")),
+        ("metadata", lambda: _add_metadata(df, entry, np.arange(args.points))),
+        ("grib-decode", lambda: read_grib_points(grib_path, lats, lons, method=args.method)),
+        ("write-parquet", write_parquet),
+        ("write-csv", write_csv),
+    ]
+    results = []
+    for name, func in cases:
+        results.append(measure(f"{name}-{size}x{size}", func, args.repeat))
+        print_table(results[-1:], RESULT_COLUMNS)
+    return results
+
+
+def main():
+    args = parse_args()
+    print(
+        f"Preprocessing microbenchmarks: {args.points} points, {args.issues} issues x {args.steps} steps x "
+        f"{len(args.variables)} variables" + (f" x {args.members} members" if args.members else "")
+    )
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ecmwf-microbenchmark-") as tmp:
+        for size in args.grids:
+            results.extend(benchmark_grid(args, size, Path(tmp)))
+
+    report_path = write_report(ROOT_PATH, args.output, "microbenchmark", vars(args), results)
+    print()
+    print_table(results, RESULT_COLUMNS)
+    print(f"\nReport written to {report_path}")
+    if args.compare:
+        print_comparison(report_path, args.compare, COMPARED_METRICS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+JSON reports of the benchmark scripts, tagged with the commit and the machine so that runs on
+different commits can be compared with `print_comparison`.
+"""
+import json
+import platform
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+
+REPORT_VERSION = 1
+IGNORED_PARAMETERS = ["output", "compare", "verbose"]
+
+
+def git_revision(root: Path) -> dict:
+    def git(*args) -> str:
+        return subprocess.run(["git", *args], cwd=root, capture_output=True, text=True).stdout.strip()
+    return {"commit": git("rev-parse", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def write_report(root: Path, output: Path, name: str, parameters: dict, results: list[dict], **extra) -> Path:
+    """ Write a report to `<output>/<name>_<timestamp>_<commit>.json` and return its path. """
+    report = {
+        "version": REPORT_VERSION,
+        "name": name,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(root),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()},
+        "parameters": parameters,
+        **extra,
+        "results": results,
+    }
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    revision = (report["revision"]["commit"] or "unknown")[:10]
+    report_path = output / f"{name}_{datetime.now():%Y%m%d_%H%M%S}_{revision}.json"
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+    return report_path
+
+
+def print_table(results: list[dict], columns: list[tuple[str, str, str]]) -> None:
+    """ Print one line per result, with `columns` given as (title, key, format), '-' for missing keys. """
+    print(f"{'scenario':<32} " + " ".join(f"{title:>10}" for title, _, _ in columns))
+    for r in results:
+        values = [format(r[key], fmt) if key in r else "-" for _, key, fmt in columns]
+        print(f"{r['scenario']:<32} " + " ".join(f"{v:>10}" for v in values))
+
+
+def print_comparison(report_path: Path, previous_path: Path, metrics: list[str]) -> None:
+    """ Print the change of each metric of the scenarios found in both reports. """
+    report, previous = (json.loads(Path(p).read_text()) for p in (report_path, previous_path))
+    differences = [
+        k for k, v in report["parameters"].items()
+        if k not in IGNORED_PARAMETERS and previous["parameters"].get(k) != v
+    ]
+    print(f"\nCompared with {previous['revision']['commit']} ({previous['timestamp']}):")
+    if differences:
+        print(f"  warning, the parameters differ: {', '.join(differences)}")
+
+    before = {r["scenario"]: r for r in previous["results"]}
+    for r in report["results"]:
+        old = before.get(r["scenario"])
+        if old is None:
+            continue
+        changes = [
+            f"{metric} {old[metric]:.4g} -> {r[metric]:.4g} ({100 * (r[metric] / old[metric] - 1):+.0f}%)"
+            for metric in metrics
+            if r.get(metric) and old.get(metric)
+        ]
+        print(f"  {r['scenario']:<32} " + ", ".join(changes))
@@ -0,0 +1,259 @@
+"""
+Simulated MARS backend for the benchmarks, standing in for `ECMWFService` and `AsyncMARSService`.
+
+Jobs wait in a queue, run, then transfer a synthetic result at a limited throughput, and fail
+with a transient error at a configurable rate. Results are real GRIB2 or NetCDF files holding
+every field of the request (dates, times, steps, parameters, members and grid points), so the
+preprocessing of the retrieved files can be measured too.
+"""
+from __future__ import annotations
+import io
+import re
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from pathlib import Path
+from collections import Counter
+from dataclasses import dataclass, field
+
+import numpy as np
+import xarray as xr
+import eccodes
+from ecmwfapi.api import APIException
+
+from src.ecmwf_client_new.cost import request_values, request_dimensions
+from src.ecmwf_client_new.telemetry import JobTiming
+
+
+GRIB_SAMPLE = "regular_ll_sfc_grib2"
+ENSEMBLE_SIZE = 50
+TRANSFER_CHUNK = 1024 * 1024  # in bytes
+COST_FIELD_SIZE = 1000  # bytes per field reported by the cost checks, about the size of a small area field
+
+
+@dataclass
+class FakeMARS:
+    """
+    Settings and counters of the simulated MARS. Times are in seconds and the throughput in bytes
+    per second (None for no limit). The same instance is shared by the services it creates.
+    """
+    queue_delay: float = 1.0
+    active_delay: float = 1.0
+    failure_rate: float = 0.0
+    throughput: float | None = 50e6
+    seed: int = 0
+    stats: Counter = field(default_factory=Counter)
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        self._lock = threading.Lock()
+
+    def service(self, name: str = "mars", log=print) -> FakeMARSService:
+        """ Factory with the signature of `ECMWFService`. """
+        return FakeMARSService(self, log)
+
+    def async_service(self, name: str = "mars") -> FakeAsyncMARSService:
+        """ Factory with the signature of `AsyncMARSService`. """
+        return FakeAsyncMARSService(self)
+
+    def count(self, **counts) -> None:
+        with self._lock:
+            self.stats.update(counts)
+
+    def fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def payload(self, request: dict | str) -> bytes:
+        """ Result of a request: a cost output for cost checks, otherwise a GRIB2 or NetCDF file. """
+        start = time.perf_counter()
+        if isinstance(request, str):
+            data = cost_payload(request)
+        elif str(request.get("format", "grib2")).startswith("grib"):
+            data = grib_payload(request, self.seed)
+        else:
+            data = netcdf_payload(request, self.seed)
+        self.count(payload_seconds=time.perf_counter() - start)
+        return data
+
+
+class FakeMARSService:
+    """ Blocking simulated MARS service, a replacement for `ECMWFService`. """
+
+    def __init__(self, mars: FakeMARS, log=print):
+        self.mars = mars
+        self.log = log
+
+    def execute(self, request: dict | str, target: str | Path) -> None:
+        mars = self.mars
+        mars.count(jobs=1)
+        self.log("Request is queued")
+        time.sleep(mars.queue_delay)
+        if mars.fails():
+            mars.count(failures=1)
+            raise APIException("ecmwf.API error: MARS is temporarily unavailable, try again later")
+
+        self.log("Request is active")
+        start = time.monotonic()
+        data = mars.payload(request)
+        time.sleep(max(mars.active_delay - (time.monotonic() - start), 0.0))
+
+        self.log("Request is complete")
+        self.log(f"Transfering {len(data)} bytes into {target}")
+        with open(target, "wb") as f:
+            for offset in range(0, len(data), TRANSFER_CHUNK):
+                chunk = data[offset:offset + TRANSFER_CHUNK]
+                f.write(chunk)
+                if mars.throughput:
+                    time.sleep(len(chunk) / mars.throughput)
+        mars.count(bytes=len(data))
+
+
+class FakeAsyncMARSService:
+    """ Asynchronous simulated MARS service, a replacement for `AsyncMARSService`. """
+
+    def __init__(self, mars: FakeMARS):
+        self.mars = mars
+
+    async def execute(self, request: dict | str, target: str | Path) -> JobTiming:
+        mars = self.mars
+        mars.count(jobs=1)
+        timing = JobTiming()
+        submitted = time.monotonic()
+        await asyncio.sleep(mars.queue_delay)
+        if mars.fails():
+            mars.count(failures=1)
+            raise APIException("ecmwf.API error: MARS is temporarily unavailable, try again later")
+
+        started = time.monotonic()
+        data = await asyncio.to_thread(mars.payload, request)
+        await asyncio.sleep(max(mars.active_delay - (time.monotonic() - started), 0.0))
+        completed = time.monotonic()
+
+        digest = hashlib.sha256()
+        with open(target, "wb") as f:
+            for offset in range(0, len(data), TRANSFER_CHUNK):
+                chunk = data[offset:offset + TRANSFER_CHUNK]
+                f.write(chunk)
+                digest.update(chunk)
+                if mars.throughput:
+                    await asyncio.sleep(len(chunk) / mars.throughput)
+        mars.count(bytes=len(data))
+
+        timing.queued = started - submitted
+        timing.active = completed - started
+        timing.download = time.monotonic() - completed
+        timing.size = len(data)
+        timing.checksum = digest.hexdigest()
+        return timing
+
+
+def parse_cost_request(cost_request: str) -> dict:
+    """ Read back the request of a cost check string made by `make_cost_check_request`. """
+    body = cost_request.split(",", 1)[1]
+    pairs = re.findall(r"(\w+) = ([^,]+)", body)
+    return {k: v.strip() for k, v in pairs if k != "output"}
+
+
+def cost_payload(cost_request: str) -> bytes:
+    dims = request_dimensions(parse_cost_request(cost_request))
+    fields = dims["dates"] * dims["times"] * dims["steps"] * dims["params"] * dims["members"]
+    return (
+        f"size={fields * COST_FIELD_SIZE};\n"
+        f"number_of_fields={fields};\n"
+        f"online_size={fields * COST_FIELD_SIZE};\n"
+        f"number_of_online_fields={fields};\n"
+    ).encode()
+
+
+def _grid(request: dict) -> tuple[np.ndarray, np.ndarray, float, float]:
+    north, west, south, east = (float(x) for x in str(request["area"]).split("/"))
+    dlat, dlon = (float(x) for x in str(request["grid"]).split("/"))
+    lats = north - dlat * np.arange(int(round(abs(north - south) / dlat)) + 1)
+    lons = west + dlon * np.arange(int(round(abs(east - west) / dlon)) + 1)
+    return lats, lons, dlat, dlon
+
+
+def _param_templates(request: dict, seed: int) -> dict[str, int]:
+    """ One GRIB message per parameter, on the grid of the request and filled with random values. """
+    lats, lons, dlat, dlon = _grid(request)
+    rng = np.random.default_rng(seed)
+    templates = {}
+    for param in request_values(request)["params"]:
+        gid = eccodes.codes_grib_new_from_samples(GRIB_SAMPLE)
+        eccodes.codes_set(gid, "Ni", len(lons))
+        eccodes.codes_set(gid, "Nj", len(lats))
+        eccodes.codes_set(gid, "latitudeOfFirstGridPointInDegrees", lats[0])
+        eccodes.codes_set(gid, "latitudeOfLastGridPointInDegrees", lats[-1])
+        eccodes.codes_set(gid, "longitudeOfFirstGridPointInDegrees", lons[0])
+        eccodes.codes_set(gid, "longitudeOfLastGridPointInDegrees", lons[-1])
+        eccodes.codes_set(gid, "iDirectionIncrementInDegrees", dlon)
+        eccodes.codes_set(gid, "jDirectionIncrementInDegrees", dlat)
+        # the template must be set before the parameter, which switches it to a statistical one if needed
+        eccodes.codes_set(gid, "productDefinitionTemplateNumber", 1 if "number" in request else 0)
+        eccodes.codes_set(gid, "stepUnits", 1)
+        eccodes.codes_set(gid, "shortName", str(param))
+        if "number" in request:
+            eccodes.codes_set(gid, "typeOfEnsembleForecast", 3)
+            eccodes.codes_set(gid, "numberOfForecastsInEnsemble", ENSEMBLE_SIZE)
+        eccodes.codes_set_values(gid, rng.normal(280.0, 5.0, size=len(lats) * len(lons)))
+        templates[param] = gid
+    return templates
+
+
+def grib_payload(request: dict, seed: int = 0) -> bytes:
+    """ GRIB2 file with one message per date, time, step, member and parameter of the request. """
+    values = request_values(request)
+    templates = _param_templates(request, seed)
+    out = io.BytesIO()
+    try:
+        # the template of each parameter is updated in place, cloning a message is much slower
+        for date in values["dates"]:
+            for issue_time in values["times"]:
+                for gid in templates.values():
+                    eccodes.codes_set(gid, "dataDate", int(date.strftime("%Y%m%d")))
+                    eccodes.codes_set(gid, "dataTime", int(issue_time) * 100)
+                for step in values["steps"]:
+                    for member in values["members"]:
+                        for gid in templates.values():
+                            eccodes.codes_set(gid, "endStep", step)
+                            if member is not None:
+                                eccodes.codes_set(gid, "perturbationNumber", member)
+                            out.write(eccodes.codes_get_message(gid))
+    finally:
+        for gid in templates.values():
+            eccodes.codes_release(gid)
+    return out.getvalue()
+
+
+def netcdf_payload(request: dict, seed: int = 0) -> bytes:
+    """ NetCDF file with one variable per parameter, named like cfgrib does (e.g. `t2m` for `2t`). """
+    values = request_values(request)
+    lats, lons, _, _ = _grid(request)
+    templates = _param_templates(request, seed)
+    try:
+        names = [eccodes.codes_get(gid, "cfVarName") for gid in templates.values()]
+    finally:
+        for gid in templates.values():
+            eccodes.codes_release(gid)
+
+    times = np.array([
+        np.datetime64(date.strftime("%Y-%m-%d")) + np.timedelta64(int(t), "h")
+        for date in values["dates"] for t in values["times"]
+    ], dtype="datetime64[ns]")
+    steps = np.array(values["steps"], dtype="timedelta64[h]").astype("timedelta64[ns]")
+    coords = {"time": times, "step": steps, "latitude": lats, "longitude": lons}
+    dims = ["time", "step", "latitude", "longitude"]
+    if "number" in request:
+        coords["number"] = np.array(values["members"])
+        dims.insert(2, "number")
+
+    rng = np.random.default_rng(seed)
+    shape = tuple(len(coords[d]) for d in dims)
+    data = xr.Dataset(
+        {name: (dims, rng.normal(280.0, 5.0, size=shape).astype(np.float32)) for name in names},
+        coords=coords,
+    )
+    return bytes(data.to_netcdf(engine="scipy"))
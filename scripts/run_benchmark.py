@@ -0,0 +1,190 @@
+"""
+End-to-end benchmark of `run_retrieval` and `run_preprocessing` against a simulated MARS (see
+`fake_mars.py`), on a real query truncated to a few days. Each run writes a JSON report to
+`data/benchmarks/`, which a later run (e.g. on another commit) can be compared with:
+
+    python scripts/run_benchmark.py --days 10 --concurrent-jobs 1 8 --async
+    python scripts/run_benchmark.py --days 10 --concurrent-jobs 1 8 --async --compare data/benchmarks/<report>.json
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import dataclasses
+from datetime import timedelta
+from pathlib import Path
+
+# ---------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------
+
+ROOT_PATH = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_PATH))
+
+import pandas as pd  # noqa: E402
+
+from src.setup import load_config, setup_logging  # noqa: E402
+from src.query import Query, TimeRange  # noqa: E402
+from src.pipeline import run_retrieval  # noqa: E402
+from src.preprocessing import run_preprocessing  # noqa: E402
+from src.ecmwf_client_new.telemetry import METRICS_FOLDER_NAME, PHASES, DONE, FAILED  # noqa: E402
+from fake_mars import FakeMARS  # noqa: E402
+from benchmark_report import write_report, print_table, print_comparison  # noqa: E402
+
+LOGGING_CONFIG_PATH = ROOT_PATH / "config" / "logging.yml"
+RESULTS_PATH = ROOT_PATH / "data" / "benchmarks"
+DEFAULT_QUERY_PATH = ROOT_PATH / "queries" / "hill-of-towie-full.json"
+
+COMPARED_METRICS = ["wall", "requests_per_s", "mb_per_s", "rows_per_s"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the retrieval and preprocessing pipelines against a simulated MARS.")
+    parser.add_argument("--config-path", type=str, help="Path to the YAML configuration file")
+    parser.add_argument("--query-path", type=str, default=str(DEFAULT_QUERY_PATH), help="Query file to benchmark")
+    parser.add_argument("--days", type=int, default=10, help="Keep only the first days of the query time range")
+    parser.add_argument("--model", type=str, help="Model type (hres or ens), overrides the configuration")
+    parser.add_argument("--format", type=str, help="Data format (grib2 or netcdf), overrides the configuration")
+    parser.add_argument("--variables", type=str, nargs="+", help="Variables to retrieve, overrides the configuration")
+    parser.add_argument("--concurrent-jobs", type=int, nargs="+", default=[1, 4], help="Concurrencies of the retrieval runs")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Also run the retrieval with the asyncio engine")
+    parser.add_argument("--skip-cost", action="store_true", help="Skip the cost checks")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="Worker counts of the preprocessing runs")
+    parser.add_argument("--engine", type=str, default="auto", help="Preprocessing engine (auto, xarray or eccodes)")
+    parser.add_argument("--skip-preprocessing", action="store_true", help="Only benchmark the retrieval")
+    parser.add_argument("--queue-delay", type=float, default=1.0, help="Time spent by each job in the MARS queue, in seconds")
+    parser.add_argument("--active-delay", type=float, default=1.0, help="Time spent by each job running, in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of the jobs failing with a transient error")
+    parser.add_argument("--throughput", type=float, default=50.0, help="Download throughput of each job, in MB/s (0 for no limit)")
+    parser.add_argument("--retry-delay", type=float, default=0.1, help="Base delay of the retries, in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the simulated failures and data")
+    parser.add_argument("--output", type=str, default=str(RESULTS_PATH), help="Folder of the JSON reports")
+    parser.add_argument("--compare", type=str, help="Previous JSON report to compare the results with")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs of the pipelines")
+    return parser.parse_args()
+
+
+def truncate_query(query: Query, days: int) -> Query:
+    end = min(query.time_range.end, query.time_range.start + timedelta(days=days) - timedelta(seconds=1))
+    return Query(time_range=TimeRange(start=query.time_range.start, end=end), points=query.points, name=query.name)
+
+
+def benchmark_retrieval(config, mars: FakeMARS, concurrent_jobs: int, use_async: bool, skip_cost: bool) -> dict:
+    """ Retrieve the query into an empty landing folder and summarise the request metrics of the run. """
+    mars.stats.clear()
+    start = time.perf_counter()
+    run_retrieval(
+        config,
+        concurrent_jobs=concurrent_jobs,
+        use_async=use_async,
+        skip_cost=skip_cost,
+        service_factory=mars.service,
+        async_service_factory=mars.async_service,
+    )
+    wall = time.perf_counter() - start
+
+    records = [
+        json.loads(line)
+        for path in (config.landing_path / METRICS_FOLDER_NAME).glob("*.jsonl")
+        for line in path.read_text().splitlines()
+    ]
+    done = sum(r["status"] == DONE for r in records)
+    n_bytes = sum(r["bytes"] for r in records)
+    return {
+        "scenario": f"retrieval-{'async' if use_async else 'sync'}-{concurrent_jobs}",
+        "wall": wall,
+        "requests": len(records),
+        "done": done,
+        "failed": sum(r["status"] == FAILED for r in records),
+        "retries": sum(r["retries"] for r in records),
+        "bytes": n_bytes,
+        "requests_per_s": done / wall,
+        "mb_per_s": n_bytes / 1e6 / wall,
+        "phases": {phase: sum(r[phase] for r in records) for phase in PHASES},
+        "payload_seconds": mars.stats["payload_seconds"],  # time spent generating the simulated results
+    }
+
+
+def benchmark_preprocessing(config, workers: int, engine: str) -> dict:
+    """ Preprocess every file of the landing folder into an empty staging and count the rows written. """
+    start = time.perf_counter()
+    run_preprocessing(config, workers=workers, engine=engine)
+    wall = time.perf_counter() - start
+
+    if config.staging_path.suffix == ".csv":
+        rows = len(pd.read_csv(config.staging_path, usecols=["entry_key"]))
+    else:
+        rows = len(pd.read_parquet(config.staging_path, columns=["entry_key"]))
+    return {
+        "scenario": f"preprocessing-{engine}-{workers}",
+        "wall": wall,
+        "rows": rows,
+        "rows_per_s": rows / wall,
+    }
+
+
+RESULT_COLUMNS = [
+    ("wall (s)", "wall", ".2f"),
+    ("req/s", "requests_per_s", ".2f"),
+    ("MB/s", "mb_per_s", ".2f"),
+    ("rows/s", "rows_per_s", ".0f"),
+    ("retries", "retries", "d"),
+    ("failed", "failed", "d"),
+]
+
+
+def main():
+    args = parse_args()
+    config = load_config(argparse.Namespace(
+        config_path=args.config_path, model=args.model, format=args.format, variables=args.variables
+    ))
+    config = dataclasses.replace(config, retry_base_delay=args.retry_delay, retry_max_delay=10 * args.retry_delay)
+    query = truncate_query(Query.from_json(args.query_path), args.days)
+
+    mars = FakeMARS(
+        queue_delay=args.queue_delay,
+        active_delay=args.active_delay,
+        failure_rate=args.failure_rate,
+        throughput=args.throughput * 1e6 or None,
+        seed=args.seed,
+    )
+    scenarios = [(c, use_async) for use_async in ([False, True] if args.use_async else [False]) for c in args.concurrent_jobs]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ecmwf-benchmark-") as tmp:
+        tmp = Path(tmp)
+        query_path = tmp / "query.json"
+        query_path.write_text(json.dumps(query.to_dict(), indent=2))
+        setup_logging(LOGGING_CONFIG_PATH, tmp / "benchmark.log", timestamped=False)
+        if not args.verbose:
+            for handler in logging.getLogger("src").handlers + logging.getLogger("ecmwfapi").handlers:
+                if not isinstance(handler, logging.FileHandler):
+                    handler.setLevel(logging.WARNING)
+
+        print(f"Benchmarking query '{query.name}' {query.time_range.start:%Y-%m-%d} to {query.time_range.end:%Y-%m-%d} "
+              f"({len(query.points.points)} points), model {config.model}, format {config.format}")
+        for i, (concurrent_jobs, use_async) in enumerate(scenarios):
+            landing = tmp / f"landing-{i}"
+            run_config = dataclasses.replace(config, landing_path=landing, query_path=query_path)
+            results.append(benchmark_retrieval(run_config, mars, concurrent_jobs, use_async, args.skip_cost))
+            print_table(results[-1:], RESULT_COLUMNS)
+
+        if not args.skip_preprocessing:
+            for workers in args.workers:
+                run_config = dataclasses.replace(config, landing_path=tmp / "landing-0", staging_path=tmp / f"staging-{workers}")
+                results.append(benchmark_preprocessing(run_config, workers, args.engine))
+                print_table(results[-1:], RESULT_COLUMNS)
+
+    parameters = {**vars(args), "start": query.time_range.start.isoformat(), "end": query.time_range.end.isoformat()}
+    report_path = write_report(ROOT_PATH, args.output, "benchmark", parameters, results, config=config.to_dict())
+
+    print()
+    print_table(results, RESULT_COLUMNS)
+    print(f"\nReport written to {report_path}")
+    if args.compare:
+        print_comparison(report_path, args.compare, COMPARED_METRICS)
+
+if __name__ == "__main__":
+    main()
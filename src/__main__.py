@@ -18,8 +18,37 @@ if __name__ == "__main__":
             **vars(args)
         )
 
+    elif args.command == "resume":
+        from .pipeline import resume_retrieval
+        resume_retrieval(
+            config=config,
+            **vars(args)
+        )
+
+    elif args.command == "cost":
+        from .pipeline import run_cost_mapping
+        run_cost_mapping(
+            config=config,
+            **vars(args)
+        )
+
     elif args.command == "preprocess":
         from .preprocessing import run_preprocessing
         run_preprocessing(
             config=config,
+            **vars(args)
+        )
+
+    elif args.command == "consolidate":
+        from .preprocessing import run_consolidation
+        run_consolidation(
+            config=config,
+            **vars(args)
+        )
+
+    elif args.command == "read":
+        from .preprocessing import run_read
+        run_read(
+            config=config,
+            **vars(args)
         )
@@ -2,4 +2,8 @@ import logging
 logger = logging.getLogger(__name__)
 
 from .request_builder import ECMWFRequestsBuilder
-from .request_executor import ECMWFRequestsExecutor
\ No newline at end of file
+from .request_executor import ECMWFRequestsExecutor
+from .request_planner import ECMWFRequestsPlanner
+from .scheduler import AdaptiveScheduler
+from .cost import CostEstimator, CostModel
+from .query_merger import QueryMerger
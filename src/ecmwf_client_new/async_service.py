@@ -0,0 +1,225 @@
+from __future__ import annotations
+import json
+import time
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from contextlib import closing
+from pathlib import Path
+from typing import Callable
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin
+from urllib.request import HTTPRedirectHandler, Request, build_opener, urlopen
+
+from ecmwfapi.api import APIException, RetryError, get_apikey_values
+
+from . import logger
+from .telemetry import JobTiming
+from ..setup.logging import ecmwf_log
+
+
+class _NoRedirect303(HTTPRedirectHandler):
+    """ Surface 303 responses, which the Web API uses to point at the result of a job. """
+
+    def http_error_303(self, req, fp, code, msg, headers):
+        return None
+
+
+class AsyncMARSService:
+    """
+    Asynchronous client of the ECMWF Web API, speaking the same protocol as `ECMWFService`:
+
+        - POST the request to `<url>/services/<service>/requests`, the job is at the `Location` header,
+        - GET the job until its status is `complete`, waiting `Retry-After` seconds between polls,
+        - download the result at `href`, then DELETE the job.
+
+    Jobs are awaited from an event loop instead of blocking a thread each: the HTTP calls are short
+    and run in the default thread pool, so many jobs can be queued at MARS for the cost of a few
+    threads. Only downloads hold a thread for their duration, and at most `max_downloads` run at once.
+
+    Downloads are streamed to the target file while computing its SHA-256, and resumed with HTTP
+    range requests when the connection drops, up to `max_resumes` times.
+    """
+
+    chunk_size = 1024 * 1024  # in bytes
+    poll_interval = 5.0  # in seconds, used when the server does not send a Retry-After header
+    max_resumes = 10
+    resume_delay = 5.0  # in seconds
+
+    def __init__(
+        self,
+        service: str = "mars",
+        url: str | None = None,
+        key: str | None = None,
+        email: str | None = None,
+        max_downloads: int = 4,
+        log: Callable[[str], None] = ecmwf_log,
+    ):
+        if url is None or key is None or email is None:
+            key, url, email = get_apikey_values()
+        self.url = url.rstrip("/")
+        self.service = service
+        self.key = key
+        self.email = email
+        self.log = log
+        self._downloads = asyncio.Semaphore(max_downloads)
+        self._opener = build_opener(_NoRedirect303)
+
+    @property
+    def requests_url(self) -> str:
+        return f"{self.url}/services/{self.service}/requests"
+
+    async def execute(self, request: dict, target: Path) -> JobTiming:
+        """ Submit a request, wait for its job to complete and download the result to `target`. """
+        timing = JobTiming()
+        submitted = time.monotonic()
+        job = await asyncio.to_thread(self._call, "POST", self.requests_url, request)
+        location = job.location
+        started = submitted
+        try:
+            self.log(f"Request submitted, id: {job.body.get('name')}")
+            status = job.status
+            while not job.done:
+                await asyncio.sleep(job.retry_after or self.poll_interval)
+                job = await asyncio.to_thread(self._call, "GET", location, offset=job.offset)
+                if job.status != status:
+                    self.log(f"Request is {job.status}")
+                    if status == "queued" or status is None:
+                        started = time.monotonic()
+                    status = job.status
+
+            completed = time.monotonic()
+            timing.queued = started - submitted
+            timing.active = completed - started
+
+            result = job.body.get("result", job.body)
+            async with self._downloads:
+                timing.size, timing.checksum = await asyncio.to_thread(
+                    self._transfer, urljoin(self.url + "/", result["href"]), Path(target), result["size"]
+                )
+            timing.download = time.monotonic() - completed
+        finally:
+            await asyncio.to_thread(self._cleanup, location)
+
+        logger.debug(
+            f"Job {location} done: queued {timing.queued:.1f}s, active {timing.active:.1f}s, "
+            f"download {timing.download:.1f}s ({timing.size} bytes)"
+        )
+        return timing
+
+    def _call(self, method: str, url: str, payload: dict | None = None, offset: int = 0) -> _JobState:
+        """ Make a blocking call to the Web API and return the state of the job. """
+        headers = {"Accept": "application/json", "From": self.email, "X-ECMWF-KEY": self.key}
+        data = None
+        if payload is not None:
+            data = json.dumps(payload).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        req = Request(f"{url}?offset={offset}&limit=500", data=data, headers=headers, method=method)
+        try:
+            res = self._opener.open(req)
+        except HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                raise RetryError(e.code, e.read().decode("utf-8", errors="replace"))
+            if e.code != 303:
+                # like `ECMWFService`, surface the error message of the Web API when there is one
+                try:
+                    message = json.loads(e.read().decode("utf-8"))["error"]
+                except Exception:
+                    raise e
+                raise APIException(f"ecmwf.API error: {message}")
+            res = e
+
+        with closing(res):
+            body = res.read().decode("utf-8")
+            code = res.status if hasattr(res, "status") else res.code
+            location = res.headers.get("Location")
+            retry_after = res.headers.get("Retry-After")
+
+        state = _JobState(
+            location=urljoin(url, location) if location else url,
+            retry_after=float(retry_after) if retry_after else None,
+            offset=offset,
+        )
+        if code == 204 or not body:
+            return state
+        try:
+            state.body = json.loads(body)
+        except ValueError as e:
+            raise APIException(f"ecmwf.API error: {e}: {body}")
+
+        for message in state.body.get("messages", []):
+            self.log(message)
+            state.offset += 1
+        if "error" in state.body:
+            raise APIException(f"ecmwf.API error: {state.body['error']}")
+
+        state.status = state.body.get("status")
+        state.done = (code == 200 and state.status == "complete") or code == 303
+        return state
+
+    def _transfer(self, url: str, target: Path, size: int) -> tuple[int, str]:
+        """
+        Stream the result to `target`, resuming from the bytes already written when the transfer
+        is interrupted. Returns the number of bytes and the SHA-256 of the file.
+        """
+        target.unlink(missing_ok=True)
+        digest, hashed = hashlib.sha256(), 0
+        for attempt in range(self.max_resumes + 1):
+            written = target.stat().st_size if target.exists() else 0
+            if written != hashed:
+                # the file and the digest disagree after an error in the middle of a chunk
+                digest, hashed = hashlib.sha256(), 0
+                with open(target, "rb") as f:
+                    while chunk := f.read(self.chunk_size):
+                        digest.update(chunk)
+                        hashed += len(chunk)
+
+            request = Request(url)
+            if written:
+                request.add_header("Range", f"bytes={written}-")
+            try:
+                with closing(urlopen(request)) as http:
+                    if written and http.status != 206:
+                        logger.debug(f"Server ignored the range request for {url}, downloading from the start")
+                        written, digest, hashed = 0, hashlib.sha256(), 0
+                    with open(target, "ab" if written else "wb") as f:
+                        while chunk := http.read(self.chunk_size):
+                            f.write(chunk)
+                            digest.update(chunk)
+                            hashed += len(chunk)
+            except (URLError, HTTPException, ConnectionError, TimeoutError) as e:
+                if isinstance(e, HTTPError) and e.code < 500:
+                    raise
+                logger.warning(f"Transfer of {url} interrupted after {hashed} of {size} bytes: {e}")
+
+            if hashed == size:
+                return hashed, digest.hexdigest()
+            if hashed > size:
+                break
+            if attempt < self.max_resumes:
+                self.log(f"Transfer interrupted at {hashed} of {size} bytes, resuming in {self.resume_delay:.0f}s...")
+                time.sleep(self.resume_delay)
+
+        raise ConnectionError(f"Transfer of {url} failed: {hashed} of {size} bytes received")
+
+    def _cleanup(self, location: str) -> None:
+        """ Delete a job from the server, ignoring errors. """
+        try:
+            self._call("DELETE", location)
+        except Exception as e:
+            logger.debug(f"Could not delete job {location}: {e}")
+
+
+@dataclass
+class _JobState:
+    location: str
+    retry_after: float | None = None
+    offset: int = 0
+    status: str | None = None
+    done: bool = False
+    body: dict | None = None
+
+    def __post_init__(self):
+        self.body = self.body or {}
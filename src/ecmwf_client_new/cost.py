@@ -0,0 +1,282 @@
+from __future__ import annotations
+import csv
+import json
+import math
+import hashlib
+import traceback
+import concurrent.futures
+from pathlib import Path
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+
+from . import logger
+from .request_builder import ECMWFRequestsBuilder
+
+
+# Fields reported by a MARS `list` request with `output = cost`
+COST_FIELDS = [
+    "size",
+    "number_of_fields",
+    "online_size",
+    "off_line_size",
+    "number_of_tape_files",
+    "number_of_disk_files",
+    "number_of_online_fields",
+    "number_of_offline_fields",
+    "number_of_tapes",
+]
+
+
+def parse_cost_output(text: str) -> dict:
+    """ Parse the `key=value;` lines of a MARS cost output into a dict, converting integers. """
+    out = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if "=" in line and line.endswith(";"):
+            key, val = line[:-1].split("=", 1)
+            key, val = key.strip(), val.strip()
+            try:
+                val = int(val)
+            except ValueError:
+                pass
+            out[key] = val
+    return out
+
+
+def parse_cost_file(path: Path) -> dict:
+    """ Parse a MARS cost output file. """
+    return parse_cost_output(Path(path).read_text())
+
+
+def _expand_mars_list(value, to_value=lambda v: v) -> list:
+    """ Expand a MARS list value ('a/b/c', 'a/to/b' or 'a/to/b/by/c') into its elements. """
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    parts = str(value).split("/")
+    if len(parts) >= 3 and parts[1] == "to":
+        start, end = to_value(parts[0]), to_value(parts[2])
+        step = to_value(parts[4]) if len(parts) == 5 and parts[3] == "by" else None
+        return list(_mars_range(start, end, step))
+    return [to_value(part) for part in parts]
+
+
+def _mars_range(start, end, step):
+    if isinstance(start, datetime):
+        step = step or timedelta(days=1)
+    else:
+        step = step or 1
+    current = start
+    while current <= end:
+        yield current
+        current += step
+
+
+def request_values(request: dict) -> dict:
+    """ Expand the dates, times, steps, parameters and members of a MARS request into lists. """
+    return {
+        "dates": _expand_mars_list(request["date"], lambda v: datetime.strptime(v, "%Y-%m-%d")),
+        "times": _expand_mars_list(request["time"]),
+        "steps": _expand_mars_list(request["step"], int),
+        "params": _expand_mars_list(request["param"]),
+        "members": _expand_mars_list(request["number"], int) if "number" in request else [None],
+    }
+
+
+def request_dimensions(request: dict) -> dict:
+    """ Count the dates, times, steps, parameters, members and grid points covered by a MARS request. """
+    values = request_values(request)
+
+    north, west, south, east = (float(x) for x in str(request["area"]).split("/"))
+    dlat, dlon = (float(x) for x in str(request["grid"]).split("/"))
+    n_lat = int(round(abs(north - south) / dlat)) + 1
+    n_lon = int(round(abs(east - west) / dlon)) + 1
+
+    return {
+        **{name: len(v) for name, v in values.items()},
+        "grid_points": n_lat * n_lon,
+    }
+
+
+@dataclass
+class CostEstimate:
+    fields: int
+    bytes: float
+    tape_files: float
+    seconds: float
+    retry_seconds: float = 0.0
+    give_up: float = 0.0  # probability that the request fails all its attempts
+
+
+@dataclass
+class CostModel:
+    """
+    Cost model of a MARS request, expressed in estimated seconds.
+
+    The time `T` of a single attempt is a per-request overhead plus terms linear in tape files,
+    fields and bytes. Failures arrive at `failure_rate` (λ) per hour of run time and restart the
+    request, for at most `max_attempts` (N) attempts. An attempt fails with probability
+    `p = 1 - exp(-λT)` and lasts `p / λ` on average, so the expected time of the request is
+    `p / λ * (1 + p + ... + p^(N-1))`, which tends to `(exp(λT) - 1) / λ` for many attempts.
+    Large requests pay for their retry exposure while small ones pay their overhead, which is
+    the trade-off the planner settles.
+
+    The data dependent coefficients (bytes per field and grid point, tape files touched per
+    issue) are fitted on the cost files saved by previous retrievals; the time coefficients
+    are rough orders of magnitude of the MARS queue, tape and transfer overheads.
+    """
+    bytes_per_field_point: float = 8.0
+    tape_files_per_issue: float = 1.0
+    request_overhead: float = 60.0  # seconds spent in the queue and setting up a request
+    tape_file_time: float = 30.0  # seconds to mount and seek a tape file
+    field_time: float = 0.005  # seconds to extract and post-process a field
+    transfer_rate: float = 10e6  # bytes per second
+    failure_rate: float = 0.2  # failures per hour a request runs, each one restarts the request
+    max_attempts: int = 3
+    samples: int = 0
+
+    @classmethod
+    def from_cost_files(cls, folder: Path, **kwargs) -> CostModel:
+        """
+        Fit the model on the cost files of a `queries_cost` folder that have a request sidecar.
+        `kwargs` set the coefficients that are not fitted (e.g. `failure_rate`, `max_attempts`).
+        """
+        folder = Path(folder)
+        tapes, issues = 0.0, 0
+        byte_ratios = []
+        for cost_file in sorted(folder.glob("ecmwf_cost_*.txt")):
+            request_file = cost_file.with_suffix(".json")
+            if not request_file.exists():
+                continue
+            try:
+                cost = parse_cost_file(cost_file)
+                dims = request_dimensions(json.loads(request_file.read_text()))
+            except Exception as e:
+                logger.debug(f"Ignoring cost file {cost_file}: {e}")
+                continue
+            if not cost.get("number_of_fields") or "size" not in cost:
+                continue
+
+            byte_ratios.append(cost["size"] / (cost["number_of_fields"] * dims["grid_points"]))
+            tapes += cost.get("number_of_tape_files", 0)
+            issues += dims["dates"] * dims["times"]
+
+        if not byte_ratios:
+            logger.info(f"No usable cost files in {folder}, using the default cost model.")
+            return cls(**kwargs)
+
+        model = cls(
+            bytes_per_field_point=sum(byte_ratios) / len(byte_ratios),
+            tape_files_per_issue=tapes / issues if issues else cls.tape_files_per_issue,
+            samples=len(byte_ratios),
+            **kwargs,
+        )
+        logger.info(f"Cost model fitted on {model.samples} cost files: {model}")
+        return model
+
+    def estimate(self, request: dict) -> CostEstimate:
+        dims = request_dimensions(request)
+        issues = dims["dates"] * dims["times"]
+        fields = issues * dims["steps"] * dims["params"] * dims["members"]
+        size = fields * dims["grid_points"] * self.bytes_per_field_point
+        tape_files = math.ceil(issues * self.tape_files_per_issue)
+        attempt = (
+            self.request_overhead
+            + tape_files * self.tape_file_time
+            + fields * self.field_time
+            + size / self.transfer_rate
+        )
+        rate = self.failure_rate / 3600
+        if rate == 0:
+            return CostEstimate(fields=fields, bytes=size, tape_files=tape_files, seconds=attempt)
+
+        p = -math.expm1(-rate * attempt)  # probability that an attempt fails
+        seconds = p / rate * sum(p ** k for k in range(self.max_attempts))
+        return CostEstimate(
+            fields=fields, bytes=size, tape_files=tape_files, seconds=seconds,
+            retry_seconds=max(seconds - attempt, 0.0), give_up=p ** self.max_attempts,
+        )
+
+
+@dataclass
+class CostRecord:
+    request_hash: str
+    request: dict
+    cost: dict
+    cached: bool = False
+
+    def to_row(self) -> dict:
+        """ Flatten the record into a row of the cost table. """
+        param = self.request.get("param", [])
+        return {
+            "request_hash": self.request_hash,
+            "variables": ",".join(param) if isinstance(param, (list, tuple)) else param,
+            "date": self.request.get("date"),
+            "time": self.request.get("time"),
+            "area": self.request.get("area"),
+            "grid": self.request.get("grid"),
+            "cached": self.cached,
+            **{k: self.cost.get(k) for k in COST_FIELDS},
+            **self.cost,
+        }
+
+
+class CostEstimator:
+    """
+    Runs MARS cost checks in-process and concurrently, caching their output by request hash.
+
+    Cached outputs are stored in `cache_folder` as `ecmwf_cost_<hash>.txt` with the request
+    next to them (`.json`), so they are also picked up by `CostModel.from_cost_files`.
+    """
+
+    def __init__(self, server, cache_folder: Path, max_workers: int = 4):
+        self.server = server
+        self.cache_folder = Path(cache_folder)
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.max_workers = max_workers
+
+    @staticmethod
+    def request_hash(request: dict) -> str:
+        cost_req = ECMWFRequestsBuilder.make_cost_check_request(request)
+        return hashlib.sha256(cost_req.encode()).hexdigest()[:16]
+
+    def estimate(self, request: dict) -> CostRecord:
+        """ Return the cost of a request, running a MARS cost check only if it is not cached. """
+        request_hash = self.request_hash(request)
+        cost_file = self.cache_folder / f"ecmwf_cost_{request_hash}.txt"
+        if cost_file.exists():
+            logger.debug(f"Cost cache hit for request {request_hash}")
+            return CostRecord(request_hash, request, parse_cost_file(cost_file), cached=True)
+
+        cost_req = ECMWFRequestsBuilder.make_cost_check_request(request)
+        tmp_file = cost_file.with_suffix(".tmp")
+        logger.debug(f"Running cost check request: {cost_req}")
+        self.server.execute(cost_req, tmp_file)
+        cost_file.with_suffix(".json").write_text(json.dumps(request))
+        tmp_file.replace(cost_file)
+        return CostRecord(request_hash, request, parse_cost_file(cost_file))
+
+    def estimate_many(self, requests: list[dict]) -> list[CostRecord]:
+        """ Estimate the cost of many requests concurrently. Failed cost checks are logged and skipped. """
+        records = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as thread_pool:
+            future_to_request = {thread_pool.submit(self.estimate, req): req for req in requests}
+            for i, future in enumerate(concurrent.futures.as_completed(future_to_request), 1):
+                try:
+                    records.append(future.result())
+                    logger.info(f"[{i}/{len(requests)}] Cost check done")
+                except Exception as e:
+                    logger.warning(f"[{i}/{len(requests)}] Cost check failed for {future_to_request[future]}: {e}")
+                    logger.debug(traceback.format_exc())
+        return records
+
+    @staticmethod
+    def write_cost_table(rows: list[dict], path: Path) -> None:
+        """ Write cost table rows to a CSV file. """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fieldnames = list(dict.fromkeys(k for row in rows for k in row))
+        with path.open("w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        logger.info(f"Cost table with {len(rows)} rows written to {path}")
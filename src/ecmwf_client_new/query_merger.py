@@ -0,0 +1,63 @@
+from __future__ import annotations
+from datetime import timedelta
+
+from . import logger
+from ..query import Query, QueryGroup, TimeRange
+
+
+class QueryMerger:
+    """
+    Merges several queries into groups retrieved with shared requests.
+
+    Queries whose points fit in a bounding box of at most `max_extent` degrees are grouped
+    together. Within a group, overlapping or adjacent time ranges are merged, so each field
+    (date, issue, step, variable) is requested once for all the queries of the group, over
+    an area covering all their points. MARS costs scale with the number of fields, not with
+    the area, so a larger area is cheaper than requesting the same fields several times.
+    """
+
+    max_extent: float = 5.0  # in degrees, maximum size of the bounding box of a group
+
+    def __init__(self, queries: list[Query]):
+        self.queries = queries
+
+    def groups(self) -> list[QueryGroup]:
+        """ Return one query group per spatial cluster and contiguous time range. """
+        groups = []
+        for cluster in self.cluster_queries():
+            for time_range, members in self.merge_time_ranges(cluster):
+                groups.append(QueryGroup.merge(members, time_range))
+        logger.info(f"Merged {len(self.queries)} queries into {len(groups)} query groups")
+        for group in groups:
+            logger.info(
+                f"  {group.name}: {group.time_range.start.date()} to {group.time_range.end.date()}, "
+                f"{len(group.points.points)} points"
+            )
+        return groups
+
+    def cluster_queries(self) -> list[list[Query]]:
+        """ Greedily group queries whose points fit in a box of at most `max_extent` degrees. """
+        clusters: list[list[Query]] = []
+        for query in self.queries:
+            for cluster in clusters:
+                lats = [lat for q in cluster + [query] for lat in q.points.lats]
+                lons = [lon for q in cluster + [query] for lon in q.points.lons]
+                if max(lats) - min(lats) <= self.max_extent and max(lons) - min(lons) <= self.max_extent:
+                    cluster.append(query)
+                    break
+            else:
+                clusters.append([query])
+        return clusters
+
+    @staticmethod
+    def merge_time_ranges(queries: list[Query]) -> list[tuple[TimeRange, list[Query]]]:
+        """ Merge overlapping or adjacent (less than a day apart) time ranges, with the queries of each. """
+        merged: list[tuple[TimeRange, list[Query]]] = []
+        for query in sorted(queries, key=lambda q: q.time_range.start):
+            if merged and query.time_range.start <= merged[-1][0].end + timedelta(days=1):
+                time_range, members = merged[-1]
+                time_range.end = max(time_range.end, query.time_range.end)
+                members.append(query)
+            else:
+                merged.append((TimeRange(query.time_range.start, query.time_range.end), [query]))
+        return merged
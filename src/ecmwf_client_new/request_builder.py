@@ -4,7 +4,7 @@ from datetime import timedelta
 from . import logger
 from ..setup import PipelineConfig
 from ..query import Query, PointCloud
-from ..utils.geometry import get_smallest_bounding_box
+from ..utils.geometry import AREA_POINTS_KEY, get_smallest_bounding_box, cluster_points, encode_points
 
 
 class ECMWFRequestsBuilder:
@@ -12,7 +12,8 @@ class ECMWFRequestsBuilder:
     Builds ECMWF MARS request dictionaries for the given configuration and query.
 
     Each request corresponds to a combination of:
-        - a spatial subset (grid or individual point)
+        - a spatial subset (grid, individual point, or small area around a group of points
+          with `coalesce_points`)
         - a forecast issuance time
         - a date in the specified time range.
 
@@ -21,6 +22,7 @@ class ECMWFRequestsBuilder:
 
     grid_resolution: float = 0.1
     point_resolution: float = 0.01
+    coalesce_max_extent: float = 0.2  # in degrees, largest group of points served by one request
 
     def __init__(self, config: PipelineConfig, query: Query):
         self.config = config
@@ -129,6 +131,12 @@ class ECMWFRequestsBuilder:
             area_str, grid_str = self.get_area_grid(self.query.points, grid_res)
             return [{**base, "area": area_str, "grid": grid_str}]
 
+        elif mode == "point" and self.config.coalesce_points:
+            grid_res = self.grid_resolution
+            clusters = cluster_points(self.query.points, self.coalesce_max_extent)
+            logger.debug(f"Coalesced {len(self.query.points.points)} points into {len(clusters)} requests")
+            return [self.cluster_request(base, cluster, grid_res) for cluster in clusters]
+
         elif mode == "point":
             point_res = self.point_resolution
             return [
@@ -139,6 +147,12 @@ class ECMWFRequestsBuilder:
         logger.error(f"Unsupported retrieval mode: {mode}")
         raise NotImplementedError(f"Retrieval mode {mode} not supported")
 
+    @classmethod
+    def cluster_request(cls, base: dict, cluster: PointCloud, grid_res: float) -> dict:
+        """ Request for the area around a cluster of points, recording the points it is for. """
+        area_str, grid_str = cls.get_area_grid(cluster, grid_res)
+        return {**base, "area": area_str, "grid": grid_str, AREA_POINTS_KEY: encode_points(cluster)}
+
     @staticmethod
     def get_area_grid(points: PointCloud, grid_res: float) -> tuple[str, str]:
         """ TODO """
@@ -147,12 +161,17 @@ class ECMWFRequestsBuilder:
         grid_str = f"{grid_res}/{grid_res}"
         return area_str, grid_str
 
+    @staticmethod
+    def mars_request(request: dict) -> dict:
+        """ The request without the keys that are not MARS keywords (e.g. `AREA_POINTS_KEY`). """
+        return {k: v for k, v in request.items() if not k.startswith("_")}
+
     @staticmethod
     def make_cost_check_request(request: dict) -> str:
         """ Create a cost check request string from a request dict. """
         parts = [
             f"{k} = {'/'.join(str(x) for x in v) if k == 'param' and isinstance(v, (list, tuple)) else v}"
-            for k, v in request.items()
+            for k, v in ECMWFRequestsBuilder.mars_request(request).items()
             if k != "format"
         ]
 
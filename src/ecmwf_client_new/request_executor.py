@@ -1,3 +1,7 @@
+import json
+import time
+import asyncio
+import threading
 import traceback
 
 from ecmwfapi import ECMWFService
@@ -8,17 +12,52 @@ from ..setup import PipelineConfig
 from ..storage import StorageManager, RetrievalMeta, RetrievalTicket
 from ..setup.logging import ecmwf_log
 from .request_builder import ECMWFRequestsBuilder
+from .retry import RetryPolicy, classify_error, is_rejection, PERMANENT
+from .cost import COST_FIELDS, parse_cost_file
+from .async_service import AsyncMARSService
+from .telemetry import MetricsRecorder, RequestMetrics, PhaseTracker, DONE, CACHED, SKIPPED, FAILED
 
 
 class ECMWFRequestsExecutor:
     """ TODO """
 
-    def __init__(self, config: PipelineConfig, query: Query):
+    def __init__(
+        self,
+        config: PipelineConfig,
+        query: Query,
+        service_factory=ECMWFService,
+        async_service_factory=AsyncMARSService,
+    ):
         logger.info("Initializing ECMWF Client...")
-        self.server = ECMWFService("mars", log=ecmwf_log)
+        # the factories are called like `ECMWFService`, to run against a simulated MARS in benchmarks
+        self.server = service_factory("mars", log=self._server_log)
+        self.async_service_factory = async_service_factory
         self.config = config
         self.query = query
         self.storage_manager = StorageManager(config.landing_path)
+        self.retry_policy = RetryPolicy.from_config(config)
+        self.on_rejection = None  # optional callback notified when MARS rejects a request (per-user limits)
+        self.metrics: MetricsRecorder | None = None  # optional recorder of the metrics of each request
+
+        self._async_server: AsyncMARSService | None = None
+
+        self.failures: list[dict] = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def last_error(self) -> str | None:
+        """ Error message of the last failed `get_forecast` call made by the current thread. """
+        return getattr(self._local, "last_error", None)
+
+    @property
+    def async_server(self) -> AsyncMARSService:
+        """ Web API client used by `get_forecast_async`, created on first use. """
+        if self._async_server is None:
+            self._async_server = self.async_service_factory("mars")
+        return self._async_server
 
     def get_forecast(
         self,
@@ -26,53 +65,286 @@ class ECMWFRequestsExecutor:
         dry_run: bool = False,
         skip_cost: bool = False,
         skip_query: bool = False,
+        force: bool = False,
         **kwargs
     ) -> bool:
         """ Retrieve forecast data for given points and date range. """
         logger.info(f"Retrieving forecast with request: {request}")
         meta = RetrievalMeta.from_request(request, self.config)
+        self._local.last_error = None
+        metrics = RequestMetrics.start(request, meta.id)
+
+        # === CACHE LOOKUP PHASE ===
+        if not force and not skip_query:
+            if self._use_cached(meta, dry_run):
+                self._record_metrics(metrics, CACHED)
+                return True
+
         ticket = self.storage_manager.allocate(meta, self.query)
 
         success = False
         try:
             # === COST CHECK PHASE ===
             if not skip_cost:
-                self._run_cost_check(request, ticket)
+                self._run_cost_check(request, ticket, metrics)
             else:
                 logger.info("Skipping cost check as requested (--skip-cost)")
 
             # === DATA RETRIEVAL PHASE ===
             if not skip_query:
-                self._run_data_query(request, ticket, dry_run)
+                # only the download is retried: indexing a committed file twice would duplicate its entries
+                self._run_with_retry(self._run_data_query, request, ticket, metrics)
+                start = time.monotonic()
+                self._finalize_data_query(ticket, dry_run)
+                metrics.finalize += time.monotonic() - start
                 success = True
             else:
                 logger.info("Skipping data query as requested (--skip-query)")
                 self.storage_manager.finalize(ticket, self.query, success=False)
             
         except Exception as e:
-            logger.error(f"Error during retrieval process: {e}")
-            logger.debug(traceback.format_exc())
-            self.storage_manager.finalize(ticket, self.query, success=False)
+            self._local.last_error = self._record_failure(request, meta, e)
+            metrics.error_kind = classify_error(e)
+            self._discard(ticket)
             success = False
 
-        return success           
+        self._record_metrics(metrics, DONE if success else FAILED if metrics.error_kind else SKIPPED)
+        return success
+
+    async def get_forecast_async(
+        self,
+        request: dict,
+        dry_run: bool = False,
+        skip_cost: bool = False,
+        skip_query: bool = False,
+        force: bool = False,
+        **kwargs
+    ) -> bool:
+        """
+        Same as `get_forecast`, but the MARS jobs are submitted, polled and downloaded from the
+        event loop (see `AsyncMARSService`) instead of blocking a thread for their whole lifetime.
+        """
+        logger.info(f"Retrieving forecast with request: {request}")
+        meta = RetrievalMeta.from_request(request, self.config)
+        metrics = RequestMetrics.start(request, meta.id)
+        error = None
+
+        if not force and not skip_query:
+            if await asyncio.to_thread(self._use_cached, meta, dry_run):
+                self._record_metrics(metrics, CACHED)
+                self._local.last_error = None
+                return True
+
+        ticket = await asyncio.to_thread(self.storage_manager.allocate, meta, self.query)
+
+        success = False
+        try:
+            if not skip_cost:
+                await self._run_cost_check_async(request, ticket, metrics)
+            else:
+                logger.info("Skipping cost check as requested (--skip-cost)")
+
+            if not skip_query:
+                await self._run_with_retry_async(request, ticket, metrics)
+                start = time.monotonic()
+                await asyncio.to_thread(self._finalize_data_query, ticket, dry_run)
+                metrics.finalize += time.monotonic() - start
+                success = True
+            else:
+                logger.info("Skipping data query as requested (--skip-query)")
+                await asyncio.to_thread(self.storage_manager.finalize, ticket, self.query, success=False)
+
+        except Exception as e:
+            error = self._record_failure(request, meta, e)
+            metrics.error_kind = classify_error(e)
+            await asyncio.to_thread(self._discard, ticket)
+
+        self._record_metrics(metrics, DONE if success else FAILED if error else SKIPPED)
+
+        # set after the last await, so the caller reads the error of this request
+        self._local.last_error = error
+        return success
+
+    def _record_metrics(self, metrics: RequestMetrics, status: str) -> None:
+        metrics.finish(status)
+        if self.metrics is not None:
+            self.metrics.record(metrics)
+
+    def _server_log(self, msg: str) -> None:
+        """ Log function of `ECMWFService`, also timing the phases of the job of the current thread. """
+        ecmwf_log(msg)
+        tracker = getattr(self._local, "tracker", None)
+        if tracker is not None:
+            tracker.observe(msg)
+
+    def _record_failure(self, request: dict, meta: RetrievalMeta, e: Exception) -> str:
+        """ Log a failed retrieval, add it to the failure report and return its error message. """
+        logger.error(f"Error during retrieval process: {e}")
+        logger.debug(traceback.format_exc())
+        kind = classify_error(e)
+        with self._stats_lock:
+            self.failures.append({
+                "retrieval_id": meta.id,
+                "date": request.get("date"),
+                "time": request.get("time"),
+                "area": request.get("area"),
+                "kind": kind,
+                "error": f"{type(e).__name__}: {e}",
+            })
+        return f"[{kind}] {type(e).__name__}: {e}"
+
+    def _discard(self, ticket: RetrievalTicket) -> None:
+        """ Remove the files of a failed retrieval, unless its download was committed and may already be indexed. """
+        if ticket.size is not None:
+            logger.warning(f"Keeping committed data file {ticket.data_file_path}, it may already be indexed for some queries.")
+            ticket.part_file_path.unlink(missing_ok=True)
+            return
+        self.storage_manager.finalize(ticket, self.query, success=False)
+
+    def _run_with_retry(self, func, request: dict, ticket: RetrievalTicket, metrics: RequestMetrics, *args) -> None:
+        """ Run a MARS query, retrying transient errors with exponential backoff and jitter. """
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            metrics.attempts = attempt
+            try:
+                return func(request, ticket, metrics, *args)
+            except Exception as e:
+                time.sleep(self._retry_delay(e, ticket, metrics, attempt))
+
+    async def _run_with_retry_async(self, request: dict, ticket: RetrievalTicket, metrics: RequestMetrics) -> None:
+        """ Asynchronous version of `_run_with_retry` for the data query. """
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            metrics.attempts = attempt
+            try:
+                timing = await self.async_server.execute(ECMWFRequestsBuilder.mars_request(request), ticket.part_file_path)
+                metrics.add_timing(timing)
+                checksum = timing.checksum if self.config.checksum else None
+                await asyncio.to_thread(self.storage_manager.commit_download, ticket, timing.size, checksum, compute_checksum=False)
+                return
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, ticket, metrics, attempt))
+
+    def _retry_delay(self, error: Exception, ticket: RetrievalTicket, metrics: RequestMetrics, attempt: int) -> float:
+        """
+        Decide what to do after a failed attempt: re-raise `error` if it is permanent or if it was
+        the last attempt, otherwise drop the partial download and return the delay before the next one.
+        """
+        policy = self.retry_policy
+        if is_rejection(error) and self.on_rejection is not None:
+            self.on_rejection()
+        if classify_error(error) == PERMANENT:
+            logger.error(f"Permanent error for request {ticket.meta.id}, not retrying: {error}")
+            raise error
+        if attempt == policy.max_attempts:
+            logger.error(f"Request {ticket.meta.id} failed after {attempt} attempts: {error}")
+            raise error
+
+        delay = policy.delay(attempt)
+        logger.warning(
+            f"Transient error for request {ticket.meta.id} (attempt {attempt}/{policy.max_attempts}): {error}. "
+            f"Retrying in {delay:.0f}s..."
+        )
+        logger.debug(traceback.format_exc())
+        ticket.part_file_path.unlink(missing_ok=True)
+        metrics.backoff += delay
+        return delay
+
+    def log_failure_report(self) -> None:
+        """ Log the requests that failed for good since the executor was created. """
+        if not self.failures:
+            logger.info("Failure report: no failed requests.")
+            return
+        logger.warning(f"Failure report: {len(self.failures)} requests failed permanently:")
+        for failure in self.failures:
+            logger.warning(
+                f"  - {failure['date']} {failure['time']} area={failure['area']} "
+                f"({failure['kind']}): {failure['error']}"
+            )
 
-    def _run_cost_check(self, request: dict, ticket: RetrievalTicket) -> None:
+    def _use_cached(self, meta: RetrievalMeta, dry_run: bool) -> bool:
+        """ Reuse an existing retrieval with the same ID if its data file is still valid. """
+        entry = self.storage_manager.lookup(meta)
+        with self._stats_lock:
+            if entry is None:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+
+        if entry is None:
+            logger.debug(f"Cache miss for retrieval {meta.id}")
+            return False
+
+        logger.info(f"Cache hit for retrieval {meta.id}, reusing {entry['data_file']} (use --force to retrieve again)")
+        if not dry_run:
+            self.storage_manager.link(entry, meta, self.query)
+        return True
+
+    def log_cache_report(self) -> None:
+        """ Log the number of cache hits and misses since the executor was created. """
+        total = self.cache_hits + self.cache_misses
+        if total == 0:
+            logger.info("Cache report: no lookups performed.")
+            return
+        logger.info(
+            f"Cache report: {self.cache_hits} hits, {self.cache_misses} misses "
+            f"({100 * self.cache_hits / total:.1f}% hit rate)"
+        )
+
+    def _run_cost_check(self, request: dict, ticket: RetrievalTicket, metrics: RequestMetrics) -> None:
         """Run the ECMWF cost estimation query."""
+        start = time.monotonic()
+        try:
+            self.server.execute(self._cost_check_request(request), ticket.cost_check_file_path)
+            self._save_cost(request, ticket, metrics)
+        except Exception as e:
+            self._log_cost_check_failure(e)
+        metrics.cost_check = time.monotonic() - start
+
+    async def _run_cost_check_async(self, request: dict, ticket: RetrievalTicket, metrics: RequestMetrics) -> None:
+        """ Asynchronous version of `_run_cost_check`. """
+        start = time.monotonic()
         try:
-            cost_req = ECMWFRequestsBuilder.make_cost_check_request(request)
-            logger.debug(f"Running cost check request: {cost_req}")
-            self.server.execute(cost_req, ticket.cost_check_file_path)
-            logger.info(f"Cost check saved to {ticket.cost_check_file_path}")
+            await self.async_server.execute(self._cost_check_request(request), ticket.cost_check_file_path)
+            await asyncio.to_thread(self._save_cost, request, ticket, metrics)
         except Exception as e:
-            logger.warning(f"Cost check failed (continuing anyway): {e}")
-            logger.debug(traceback.format_exc())
+            self._log_cost_check_failure(e)
+        metrics.cost_check = time.monotonic() - start
+
+    @staticmethod
+    def _cost_check_request(request: dict) -> dict:
+        cost_req = ECMWFRequestsBuilder.make_cost_check_request(request)
+        logger.debug(f"Running cost check request: {cost_req}")
+        return cost_req
+
+    def _save_cost(self, request: dict, ticket: RetrievalTicket, metrics: RequestMetrics) -> None:
+        """ Save the request next to its cost file (for `CostModel.from_cost_files`) and read the cost. """
+        ticket.cost_check_file_path.with_suffix(".json").write_text(json.dumps(request))
+        logger.info(f"Cost check saved to {ticket.cost_check_file_path}")
+        self._read_cost(ticket, metrics)
+
+    @staticmethod
+    def _log_cost_check_failure(e: Exception) -> None:
+        logger.warning(f"Cost check failed (continuing anyway): {e}")
+        logger.debug(traceback.format_exc())
 
-    def _run_data_query(self, request: dict, ticket: RetrievalTicket, dry_run: bool) -> None:
-        """Run the actual ECMWF data retrieval."""
+    @staticmethod
+    def _read_cost(ticket: RetrievalTicket, metrics: RequestMetrics) -> None:
+        cost = parse_cost_file(ticket.cost_check_file_path)
+        metrics.cost = {k: cost[k] for k in COST_FIELDS if k in cost}
+
+    def _run_data_query(self, request: dict, ticket: RetrievalTicket, metrics: RequestMetrics) -> None:
+        """Run the actual ECMWF data retrieval and commit the downloaded file."""
         logger.debug(f"Running ECMWF data request: {request}")
-        self.server.execute(request, ticket.data_file_path)
+        self._local.tracker = PhaseTracker()
+        try:
+            self.server.execute(ECMWFRequestsBuilder.mars_request(request), ticket.part_file_path)
+        finally:
+            size = ticket.part_file_path.stat().st_size if ticket.part_file_path.exists() else 0
+            metrics.add_timing(self._local.tracker.timing(size))
+            self._local.tracker = None
+
+        self.storage_manager.commit_download(ticket, compute_checksum=self.config.checksum)
 
+    def _finalize_data_query(self, ticket: RetrievalTicket, dry_run: bool) -> None:
         if dry_run:
             logger.info(f"Dry run: retrieval simulated, skipping save for {ticket.data_file_path}")
             self.storage_manager.finalize(ticket, self.query, success=False)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+import math
+from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+
+from . import logger
+from ..setup import PipelineConfig
+from ..query import Query, PointCloud
+from .cost import CostModel, request_dimensions
+from .request_builder import ECMWFRequestsBuilder
+from ..utils.geometry import AREA_POINTS_KEY, cluster_points
+
+
+@dataclass
+class RequestPlan:
+    batch_days: int
+    spatial: str
+    variable_groups: list[list[str]]
+    requests: list[dict] = field(default_factory=list)
+    fields: int = 0
+    bytes: float = 0.0
+    tape_files: float = 0.0
+    seconds: float = 0.0
+    retry_seconds: float = 0.0
+    failures: float = 0.0  # expected number of requests failing all their attempts
+
+    def __repr__(self) -> str:
+        return (
+            f"RequestPlan(batch_days={self.batch_days}, spatial={self.spatial}, "
+            f"variable_groups={len(self.variable_groups)}, requests={len(self.requests)}, "
+            f"fields={self.fields}, size={self.bytes / 1e6:.1f}MB, tape_files={self.tape_files:.0f}, "
+            f"estimated_time={self.seconds / 3600:.2f}h, of which retries={self.retry_seconds / 3600:.2f}h, "
+            f"expected_failures={self.failures:.2f})"
+        )
+
+
+class ECMWFRequestsPlanner:
+    """
+    Chooses the request boundaries of a retrieval to minimise its estimated MARS cost.
+
+    Candidate plans combine:
+        - day chunks of `batch_days_candidates` days, never crossing a month boundary
+          (MARS archives operational data by month, so a chunk spanning two months touches more tapes),
+        - a spatial layout: one bounding box or one box per cluster of nearby points in `grid`
+          retrieval mode, one request per point in `point` mode,
+        - variable groups, only when a request would exceed `max_fields_per_request`.
+
+    Each candidate is scored with a `CostModel` fitted on the saved `queries_cost` files and the
+    cheapest one (fewest requests on ties) is kept. The per-request overhead favours long day
+    chunks and the retry exposure of long-running requests favours short ones. Plans expected to
+    leave `max_expected_failures` requests or more failing all their attempts are only kept when
+    every plan does: with few attempts, the expected time of a huge request is bounded by its
+    failures rather than its size.
+    """
+
+    batch_days_candidates: list[int] = [1, 2, 3, 5, 7, 10, 15, 31]
+    max_fields_per_request: int = 100_000
+    cluster_max_extent: float = 0.5  # in degrees, maximum size of a point cluster
+    max_expected_failures: float = 1.0
+
+    def __init__(self, config: PipelineConfig, query: Query, cost_model: CostModel | None = None):
+        self.config = config
+        self.query = query
+        self.builder = ECMWFRequestsBuilder(config, query)
+        self.cost_model = cost_model or CostModel.from_cost_files(
+            config.landing_path / "queries_cost", failure_rate=config.failure_rate, max_attempts=config.max_attempts
+        )
+
+    def build_requests(self) -> list[dict]:
+        """ Build the requests of the cheapest plan, logging the plan beforehand. """
+        plan = self.plan()
+        self.log_plan(plan)
+        return plan.requests
+
+    def plan(self) -> RequestPlan:
+        """ Evaluate every candidate plan and return the cheapest one. """
+        candidates = [
+            self._evaluate(batch_days, spatial)
+            for spatial in self._spatial_candidates()
+            for batch_days in self.batch_days_candidates
+        ]
+        for candidate in candidates:
+            logger.debug(f"Candidate plan: {candidate}")
+        return min(candidates, key=lambda p: (p.failures >= self.max_expected_failures, p.seconds, len(p.requests)))
+
+    def log_plan(self, plan: RequestPlan) -> None:
+        logger.info(f"Retrieval plan for query '{self.query.name}': {plan}")
+        logger.info(
+            f"  {len(plan.requests)} requests of up to {plan.batch_days} days, "
+            f"spatial layout '{plan.spatial}', {len(plan.variable_groups)} variable group(s)"
+        )
+
+    def _spatial_candidates(self) -> list[str]:
+        if self.config.retrieval_mode == "grid":
+            return ["box", "clusters"]
+        return ["points"]
+
+    def _spatial_requests(self, spatial: str) -> list[dict]:
+        """ Return the `area` / `grid` parts of the requests for a spatial layout. """
+        if spatial == "box":
+            area, grid = self.builder.get_area_grid(self.query.points, self.builder.grid_resolution)
+            return [{"area": area, "grid": grid}]
+        if spatial == "clusters":
+            return [
+                self.builder.cluster_request({}, cluster, self.builder.grid_resolution)
+                for cluster in self.cluster_points(self.query.points, self.cluster_max_extent)
+            ]
+        if spatial == "points":
+            keys = ("area", "grid", AREA_POINTS_KEY)
+            return [{k: r[k] for k in keys if k in r} for r in self.builder._build_grid_requests()]
+        raise NotImplementedError(f"Spatial layout {spatial} not supported")
+
+    def _evaluate(self, batch_days: int, spatial: str) -> RequestPlan:
+        base = self.builder.base_request
+        chunks = self.date_chunks(self.query.time_range.start, self.query.time_range.end, batch_days)
+        spatial_requests = self._spatial_requests(spatial)
+        time_str = "/".join(self.config.issue_hours)
+
+        # Split the variables only if the largest request would exceed the field limit
+        probe = {**base, **spatial_requests[0], "date": self._date_str(*max(chunks, key=lambda c: c[1] - c[0])), "time": time_str}
+        dims = request_dimensions(probe)
+        fields = dims["dates"] * dims["times"] * dims["steps"] * dims["params"] * dims["members"]
+        n_groups = min(len(self.config.variables), max(1, math.ceil(fields / self.max_fields_per_request)))
+        group_size = math.ceil(len(self.config.variables) / n_groups)
+        groups = [self.config.variables[i:i + group_size] for i in range(0, len(self.config.variables), group_size)]
+
+        plan = RequestPlan(batch_days=batch_days, spatial=spatial, variable_groups=groups)
+        for start, end in chunks:
+            for spatial_req in spatial_requests:
+                for group in groups:
+                    request = {**base, "param": group, **spatial_req, "date": self._date_str(start, end), "time": time_str}
+                    estimate = self.cost_model.estimate(request)
+                    plan.requests.append(request)
+                    plan.fields += estimate.fields
+                    plan.bytes += estimate.bytes
+                    plan.tape_files += estimate.tape_files
+                    plan.seconds += estimate.seconds
+                    plan.retry_seconds += estimate.retry_seconds
+                    plan.failures += estimate.give_up
+        return plan
+
+    @staticmethod
+    def _date_str(start: datetime, end: datetime) -> str:
+        if start.date() == end.date():
+            return start.strftime("%Y-%m-%d")
+        return f"{start.strftime('%Y-%m-%d')}/to/{end.strftime('%Y-%m-%d')}"
+
+    @staticmethod
+    def date_chunks(start: datetime, end: datetime, max_days: int) -> list[tuple[datetime, datetime]]:
+        """ Split [start, end] into chunks of at most `max_days` days that never cross a month boundary. """
+        chunks = []
+        current = start
+        while current <= end:
+            next_month = (current.replace(day=1) + timedelta(days=32)).replace(day=1)
+            chunk_end = min(end, current + timedelta(days=max_days - 1), next_month - timedelta(days=1))
+            chunks.append((current, chunk_end))
+            current = chunk_end + timedelta(days=1)
+        return chunks
+
+    @staticmethod
+    def cluster_points(points: PointCloud, max_extent: float) -> list[PointCloud]:
+        """ Greedily group points into clusters whose bounding box is at most `max_extent` degrees wide. """
+        return cluster_points(points, max_extent)
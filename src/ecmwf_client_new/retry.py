@@ -0,0 +1,112 @@
+from __future__ import annotations
+import random
+import socket
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+from dataclasses import dataclass
+
+from ecmwfapi.api import APIException, RetryError, APIKeyNotFoundError, APIKeyFetchError
+
+from ..setup import PipelineConfig
+
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# Fragments of MARS / Web API error messages (lower case) that will not go away by retrying
+PERMANENT_ERROR_MARKERS = [
+    "unknown parameter",
+    "bad parameter",
+    "invalid",
+    "illegal",
+    "ambiguous",
+    "syntax error",
+    "no matching data",
+    "not authorized",
+    "access denied",
+    "forbidden",
+]
+
+# Fragments of error messages (lower case) meaning MARS refused the request because of per-user limits
+REJECTION_ERROR_MARKERS = [
+    "too many",
+    "queue",
+    "limit",
+]
+
+# Fragments of error messages (lower case) caused by queue limits, network or server load
+TRANSIENT_ERROR_MARKERS = [
+    "too many",
+    "queue",
+    "limit",
+    "temporarily",
+    "try again",
+    "timeout",
+    "timed out",
+    "connection",
+    "unavailable",
+    "aborted",
+]
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    Classify an error raised while executing a MARS request as transient (worth retrying)
+    or permanent (the request itself is wrong, retrying would fail again).
+    Unknown errors are considered transient.
+    """
+    if isinstance(error, (APIKeyNotFoundError, APIKeyFetchError, ValueError, NotImplementedError, FileExistsError)):
+        return PERMANENT
+
+    if isinstance(error, HTTPError):
+        return TRANSIENT if error.code in (408, 429) or error.code >= 500 else PERMANENT
+
+    if isinstance(error, (RetryError, URLError, HTTPException, ConnectionError, TimeoutError, socket.timeout)):
+        return TRANSIENT
+
+    message = str(error).lower()
+    if isinstance(error, APIException):
+        if any(marker in message for marker in TRANSIENT_ERROR_MARKERS):
+            return TRANSIENT
+        if any(marker in message for marker in PERMANENT_ERROR_MARKERS):
+            return PERMANENT
+
+    return TRANSIENT
+
+
+def is_rejection(error: BaseException) -> bool:
+    """ Whether an error means the request was rejected because of the MARS per-user active/queued limits. """
+    if isinstance(error, (RetryError, HTTPError)) and error.code == 429:
+        return True
+    if isinstance(error, (APIException, RetryError)):
+        message = str(error).lower()
+        return any(marker in message for marker in REJECTION_ERROR_MARKERS)
+    return False
+
+
+@dataclass
+class RetryPolicy:
+    """ Exponential backoff with jitter for failed MARS requests. """
+    max_attempts: int = 3
+    base_delay: float = 30.0  # in seconds
+    max_delay: float = 600.0  # in seconds
+    jitter: float = 0.5  # fraction of the delay drawn at random
+
+    def __post_init__(self):
+        if self.max_attempts < 1:
+            raise ValueError("max_attempts must be >= 1")
+        if not 0 <= self.jitter <= 1:
+            raise ValueError("jitter must be between 0 and 1")
+
+    @classmethod
+    def from_config(cls, config: PipelineConfig) -> RetryPolicy:
+        return cls(
+            max_attempts=config.max_attempts,
+            base_delay=config.retry_base_delay,
+            max_delay=config.retry_max_delay,
+        )
+
+    def delay(self, attempt: int) -> float:
+        """ Delay to wait before the attempt following the given (1-based) failed attempt. """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1)
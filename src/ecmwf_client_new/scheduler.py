@@ -0,0 +1,186 @@
+from __future__ import annotations
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from . import logger
+
+
+class AdaptiveScheduler:
+    """
+    Runs jobs on a pool of threads whose in-flight concurrency adapts to the MARS behaviour.
+
+    The concurrency limit follows an additive-increase / multiplicative-decrease scheme:
+        - it is halved when a rejection caused by the MARS per-user limits is reported,
+        - it grows by one after `limit` successful jobs, up to `max_concurrency`, as long as
+          the smoothed job latency stays within `latency_factor` times the best latency seen.
+
+    An optional global rate limit spaces out job starts, and jobs are started in the order
+    they are given, so callers can prioritise them by sorting. `run_async` applies the same
+    limits to coroutines awaited from a single event loop.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 1,
+        max_concurrency: int | None = None,
+        min_concurrency: int = 1,
+        rate_limit: float | None = None,
+        latency_factor: float = 2.0,
+        ewma_alpha: float = 0.3,
+        rejection_cooldown: float = 60.0,
+    ):
+        if concurrency < 1 or min_concurrency < 1:
+            raise ValueError("concurrency and min_concurrency must be >= 1")
+        if rate_limit is not None and rate_limit <= 0:
+            raise ValueError("rate_limit must be > 0")
+
+        self.max_concurrency = max(max_concurrency or concurrency, concurrency)
+        self.min_concurrency = min(min_concurrency, concurrency)
+        self.limit = concurrency
+        self.rate_limit = rate_limit  # in jobs per minute
+        self.latency_factor = latency_factor
+        self.ewma_alpha = ewma_alpha
+        self.rejection_cooldown = rejection_cooldown  # in seconds
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._successes_since_change = 0
+        self._last_decrease = float("-inf")
+        self._latency_ewma: float | None = None
+        self._latency_best: float | None = None
+
+        self._rate_lock = threading.Lock()
+        self._next_start = 0.0
+
+    def report_rejection(self) -> None:
+        """ Halve the concurrency limit after a rejection, at most once per cooldown period. """
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < self.rejection_cooldown:
+                return
+            new_limit = max(self.min_concurrency, self.limit // 2)
+            if new_limit < self.limit:
+                logger.warning(f"MARS rejected a request, lowering concurrency from {self.limit} to {new_limit}")
+                self.limit = new_limit
+            self._last_decrease = now
+            self._successes_since_change = 0
+
+    def _acquire(self) -> None:
+        """ Wait for a free concurrency slot, then for the rate limit. """
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+        delay = self._rate_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _rate_delay(self) -> float:
+        """ Reserve the next start allowed by the rate limit and return the time to wait for it. """
+        if self.rate_limit is None:
+            return 0.0
+        with self._rate_lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + 60.0 / self.rate_limit
+        return start - now
+
+    def _release(self, latency: float | None, success: bool) -> None:
+        """ Free a concurrency slot and adapt the limit from the latency of the finished job. """
+        with self._cond:
+            self._in_flight -= 1
+            if success and latency is not None:
+                self._observe_latency(latency)
+            self._cond.notify_all()
+
+    def _observe_latency(self, latency: float) -> None:
+        if self._latency_ewma is None:
+            self._latency_ewma = latency
+        else:
+            self._latency_ewma = self.ewma_alpha * latency + (1 - self.ewma_alpha) * self._latency_ewma
+        self._latency_best = min(self._latency_best or self._latency_ewma, self._latency_ewma)
+
+        self._successes_since_change += 1
+        if self._successes_since_change < self.limit or self.limit >= self.max_concurrency:
+            return
+        if self._latency_ewma > self.latency_factor * self._latency_best:
+            logger.debug(
+                f"Latency {self._latency_ewma:.1f}s above {self.latency_factor}x best "
+                f"({self._latency_best:.1f}s), keeping concurrency at {self.limit}"
+            )
+            return
+
+        self.limit += 1
+        self._successes_since_change = 0
+        logger.info(f"Raising concurrency to {self.limit} (latency {self._latency_ewma:.1f}s)")
+
+    def run(self, jobs: list, func: Callable[[Any], Any]) -> list:
+        """ Run `func` on every job and return the results in the order of the jobs. """
+        queue = deque(enumerate(jobs))
+        queue_lock = threading.Lock()
+        results: list = [None] * len(jobs)
+
+        def worker() -> None:
+            while True:
+                self._acquire()
+                with queue_lock:
+                    if not queue:
+                        self._release(None, False)
+                        return
+                    i, job = queue.popleft()
+
+                start = time.monotonic()
+                success = False
+                try:
+                    results[i] = func(job)
+                    success = results[i] is not False
+                except Exception as e:
+                    logger.error(f"Unexpected error durring execution: {e}")
+                    logger.debug(traceback.format_exc())
+                self._release(time.monotonic() - start, success)
+
+        threads = [
+            threading.Thread(target=worker, name=f"scheduler-{n}", daemon=True)
+            for n in range(min(self.max_concurrency, len(jobs)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    async def run_async(self, jobs: list, func: Callable[[Any], Awaitable[Any]]) -> list:
+        """
+        Run the coroutine function `func` on every job from the current event loop and return the
+        results in the order of the jobs. Same adaptive limits as `run`, without a thread per job.
+        """
+        queue = deque(enumerate(jobs))
+        results: list = [None] * len(jobs)
+
+        async def run_one(i: int, job: Any) -> None:
+            start = time.monotonic()
+            success = False
+            try:
+                results[i] = await func(job)
+                success = results[i] is not False
+            except Exception as e:
+                logger.error(f"Unexpected error durring execution: {e}")
+                logger.debug(traceback.format_exc())
+            self._release(time.monotonic() - start, success)
+
+        tasks: set[asyncio.Task] = set()
+        while queue or tasks:
+            while queue and self._in_flight < self.limit:
+                delay = self._rate_delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                with self._cond:
+                    self._in_flight += 1
+                tasks.add(asyncio.create_task(run_one(*queue.popleft())))
+            _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        return results
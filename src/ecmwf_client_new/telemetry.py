@@ -0,0 +1,229 @@
+from __future__ import annotations
+import json
+import time
+import statistics
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+
+from . import logger
+
+
+METRICS_FOLDER_NAME = "metrics"
+PROMETHEUS_FILE_NAME = "retrieval.prom"
+PHASES = ["cost_check", "queued", "active", "download", "backoff", "finalize"]
+
+# Request outcomes
+DONE = "done"
+CACHED = "cached"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+@dataclass
+class JobTiming:
+    """ Time spent by a MARS job in each phase, in seconds. """
+    queued: float = 0.0  # from submission to the start of the job
+    active: float = 0.0  # from the start of the job to its completion
+    download: float = 0.0  # transfer of the result
+    size: int = 0  # size of the result, in bytes
+    checksum: str | None = None  # SHA-256 of the result, computed while downloading
+
+    @property
+    def total(self) -> float:
+        return self.queued + self.active + self.download
+
+
+class PhaseTracker:
+    """
+    Times the phases of a job run by the blocking `ECMWFService` from the messages it logs
+    ("Request is active", "Request is complete", "Transfering ..."), which are the only
+    signal it gives of the progress of a job.
+    """
+
+    def __init__(self):
+        self.submitted = time.monotonic()
+        self.started: float | None = None
+        self.completed: float | None = None
+
+    def observe(self, msg: str) -> None:
+        now = time.monotonic()
+        if "Request is active" in msg and self.started is None:
+            self.started = now
+        elif "Request is complete" in msg or msg.startswith("Transfering"):
+            self.started = self.started or now
+            self.completed = self.completed or now
+
+    def timing(self, size: int = 0) -> JobTiming:
+        """ Phase times of the job, to call once `execute` returned. """
+        end = time.monotonic()
+        started = self.started or self.submitted
+        completed = self.completed or end
+        return JobTiming(
+            queued=started - self.submitted,
+            active=completed - started,
+            download=end - completed,
+            size=size,
+        )
+
+
+@dataclass
+class RequestMetrics:
+    """ Metrics of one request handled by the executor. Times are in seconds. """
+    retrieval_id: str
+    date: str | None = None
+    issue_time: str | None = None
+    area: str | None = None
+    started: float = field(default_factory=time.time)  # UNIX timestamp
+    status: str | None = None  # done, cached, skipped or failed
+    attempts: int = 0
+    wall: float = 0.0
+    cost_check: float = 0.0
+    queued: float = 0.0
+    active: float = 0.0
+    download: float = 0.0
+    backoff: float = 0.0  # waiting between attempts
+    finalize: float = 0.0  # validation, indexing and consolidation of the data file
+    bytes: int = 0
+    cost: dict = field(default_factory=dict)  # fields of the MARS cost check
+    error_kind: str | None = None
+
+    @classmethod
+    def start(cls, request: dict, retrieval_id: str) -> RequestMetrics:
+        return cls(
+            retrieval_id=retrieval_id,
+            date=request.get("date"),
+            issue_time=request.get("time"),
+            area=request.get("area"),
+        )
+
+    @property
+    def retries(self) -> int:
+        return max(self.attempts - 1, 0)
+
+    @property
+    def throughput(self) -> float | None:
+        """ Download throughput, in bytes per second. """
+        return self.bytes / self.download if self.download > 0 else None
+
+    def add_timing(self, timing: JobTiming) -> None:
+        """ Add the phase times of an attempt (failed attempts count too). """
+        self.queued += timing.queued
+        self.active += timing.active
+        self.download += timing.download
+        self.bytes = timing.size
+
+    def finish(self, status: str) -> None:
+        self.status = status
+        self.wall = time.time() - self.started
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "retries": self.retries, "throughput": self.throughput}
+
+
+class MetricsRecorder:
+    """
+    Collects the metrics of the requests of a retrieval run and writes them, one JSON object
+    per line, to `<landing>/metrics/<run_id>.jsonl` as they complete. With `prometheus`, the
+    run totals are also kept up to date in `<landing>/metrics/retrieval.prom`, in the Prometheus
+    text format (for the node exporter textfile collector).
+    """
+
+    def __init__(self, folder: Path, run_id: str, prometheus: bool = False):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.run_id = run_id
+        self.path = self.folder / f"{run_id}.jsonl"
+        self.prometheus_path = self.folder / PROMETHEUS_FILE_NAME if prometheus else None
+        self.plan_time = 0.0  # time spent building the requests of the run
+        self.records: list[RequestMetrics] = []
+        self.started = time.time()
+        self._lock = threading.RLock()
+
+    def record(self, metrics: RequestMetrics) -> None:
+        with self._lock:
+            self.records.append(metrics)
+            with self.path.open("a") as f:
+                f.write(json.dumps({"run_id": self.run_id, **metrics.to_dict()}) + "\n")
+            if self.prometheus_path is not None:
+                self._write_prometheus()
+
+    def summary(self) -> dict:
+        """ Totals of the run: requests per status, time per phase, bytes, retries and MARS cost. """
+        with self._lock:
+            records = list(self.records)
+        statuses = {s: sum(r.status == s for r in records) for s in (DONE, CACHED, SKIPPED, FAILED)}
+        return {
+            "requests": len(records),
+            **statuses,
+            "retries": sum(r.retries for r in records),
+            "elapsed": time.time() - self.started,
+            "plan": self.plan_time,
+            **{phase: sum(getattr(r, phase) for r in records) for phase in PHASES},
+            "bytes": sum(r.bytes for r in records),
+            "cost_size": sum(int(r.cost.get("size") or 0) for r in records),
+            "cost_fields": sum(int(r.cost.get("number_of_fields") or 0) for r in records),
+        }
+
+    def log_summary(self) -> None:
+        """ Log where the time of the run went, summed over its requests. """
+        summary = self.summary()
+        if not summary["requests"]:
+            logger.info("Metrics summary: no requests handled.")
+            return
+
+        logger.info(
+            f"Metrics summary ({summary['requests']} requests: {summary[DONE]} done, {summary[CACHED]} cached, "
+            f"{summary[SKIPPED]} skipped, {summary[FAILED]} failed, {summary['retries']} retries) "
+            f"in {summary['elapsed']:.1f}s, planning {summary['plan']:.1f}s:"
+        )
+        busy = sum(summary[phase] for phase in PHASES) or 1.0
+        for phase in PHASES:
+            values = [getattr(r, phase) for r in self.records if getattr(r, phase) > 0]
+            if not values:
+                continue
+            logger.info(
+                f"  - {phase}: {summary[phase]:.1f}s in total ({100 * summary[phase] / busy:.0f}%), "
+                f"median {statistics.median(values):.1f}s, max {max(values):.1f}s"
+            )
+        downloads = [r for r in self.records if r.throughput is not None]
+        if downloads:
+            throughput = sum(r.bytes for r in downloads) / sum(r.download for r in downloads)
+            logger.info(f"  - downloaded {summary['bytes'] / 1e6:.1f} MB at {throughput / 1e6:.2f} MB/s")
+        if summary["cost_fields"]:
+            logger.info(f"  - MARS cost: {summary['cost_fields']} fields, {summary['cost_size'] / 1e6:.1f} MB")
+        logger.info(f"Request metrics written to {self.path}")
+
+    def _write_prometheus(self) -> None:
+        """ Write the run totals in the Prometheus text format, replacing the file atomically. """
+        summary = self.summary()
+        run = f'run_id="{self.run_id}"'
+        lines = [
+            "# HELP ecmwf_requests_total Requests handled by the retrieval executor, by outcome.",
+            "# TYPE ecmwf_requests_total counter",
+            *(
+                f'ecmwf_requests_total{{{run},status="{s}"}} {summary[s]}'
+                for s in (DONE, CACHED, SKIPPED, FAILED)
+            ),
+            "# HELP ecmwf_request_retries_total Retried attempts of MARS requests.",
+            "# TYPE ecmwf_request_retries_total counter",
+            f"ecmwf_request_retries_total{{{run}}} {summary['retries']}",
+            "# HELP ecmwf_request_phase_seconds_total Time spent by requests in each phase.",
+            "# TYPE ecmwf_request_phase_seconds_total counter",
+            *(f'ecmwf_request_phase_seconds_total{{{run},phase="{p}"}} {summary[p]:.3f}' for p in PHASES),
+            "# HELP ecmwf_plan_seconds Time spent building the requests of the run.",
+            "# TYPE ecmwf_plan_seconds gauge",
+            f"ecmwf_plan_seconds{{{run}}} {summary['plan']:.3f}",
+            "# HELP ecmwf_downloaded_bytes_total Bytes of data files downloaded.",
+            "# TYPE ecmwf_downloaded_bytes_total counter",
+            f"ecmwf_downloaded_bytes_total{{{run}}} {summary['bytes']}",
+            "# HELP ecmwf_mars_cost_fields_total Fields reported by the MARS cost checks.",
+            "# TYPE ecmwf_mars_cost_fields_total counter",
+            f"ecmwf_mars_cost_fields_total{{{run}}} {summary['cost_fields']}",
+            "# HELP ecmwf_mars_cost_bytes_total Size reported by the MARS cost checks.",
+            "# TYPE ecmwf_mars_cost_bytes_total counter",
+            f"ecmwf_mars_cost_bytes_total{{{run}}} {summary['cost_size']}",
+        ]
+        tmp_path = self.prometheus_path.with_suffix(".prom.tmp")
+        tmp_path.write_text("\n".join(lines) + "\n")
+        tmp_path.replace(self.prometheus_path)
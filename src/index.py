@@ -0,0 +1,176 @@
+from __future__ import annotations
+import csv
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from . import logger
+
+
+INDEX_COLUMNS = [
+    # File paths
+    "data_file",
+    "query_file",
+    "cost_check_file",
+
+    # IDs
+    "retrieval_id",
+    "entry_id",
+    "query_id",
+    "query_name",
+
+    # Metadata (config)
+    "config_name",
+    "model",
+    "level",
+    "retrieval_mode",
+    "batch_issue",
+    "format",
+    "issued",
+    "lookback_hours",
+    "step_granularity",
+    "variables",
+
+    # Metadata (query computed)
+    "area",
+    "grid",
+    "area_points",
+
+    # Data file integrity
+    "size",
+    "checksum",
+
+    # Retrieval timestamp
+    "timestamp",
+]
+
+INDEXED_COLUMNS = ["retrieval_id", "query_id", "issued"]
+
+
+class RetrievalIndex:
+    """
+    Append-only index of successful retrievals, backed by an SQLite database.
+
+    Each entry is appended in constant time inside a single transaction, so the
+    index can be shared by the threads of a pipeline run as well as by several
+    processes working on the same landing folder. Entries can be looked up by
+    `retrieval_id`, `query_id` and `issued` without loading the whole index, and
+    the full index can be exported to CSV for inspection.
+    """
+
+    table = "entries"
+
+    def __init__(self, db_file: Path, timeout: float = 60.0):
+        self.db_file = Path(db_file)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self) -> None:
+        """ Create the entries table and its lookup indexes if needed. """
+        columns = ", ".join(f'"{c}"' for c in INDEX_COLUMNS)
+        with self._lock, self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                f"(rowid INTEGER PRIMARY KEY AUTOINCREMENT, {columns})"
+            )
+            existing = {r["name"] for r in conn.execute(f"PRAGMA table_info({self.table})")}
+            for column in INDEX_COLUMNS:
+                if column not in existing:
+                    logger.debug(f"Adding missing column '{column}' to index {self.db_file}")
+                    conn.execute(f'ALTER TABLE {self.table} ADD COLUMN "{column}"')
+            for column in INDEXED_COLUMNS:
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS idx_{self.table}_{column} ON {self.table} ("{column}")'
+                )
+
+    def append(self, entry: dict) -> int:
+        """ Append an entry to the index and return its row id. """
+        unknown = set(entry) - set(INDEX_COLUMNS)
+        if unknown:
+            logger.error(f"Unknown index columns: {sorted(unknown)}")
+            raise ValueError(f"Unknown index columns: {sorted(unknown)}")
+
+        columns = list(entry)
+        placeholders = ", ".join("?" for _ in columns)
+        names = ", ".join(f'"{c}"' for c in columns)
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO {self.table} ({names}) VALUES ({placeholders})",
+                [entry[c] for c in columns],
+            )
+            rowid = cursor.lastrowid
+        logger.debug(f"Index entry {entry.get('entry_id')} appended at row {rowid}")
+        return rowid
+
+    def find(self, **filters) -> list[dict]:
+        """ Return the entries matching all the given column filters, in append order. """
+        unknown = set(filters) - set(INDEX_COLUMNS) - {"rowid"}
+        if unknown:
+            logger.error(f"Unknown index columns: {sorted(unknown)}")
+            raise ValueError(f"Unknown index columns: {sorted(unknown)}")
+
+        where = " AND ".join(f'"{c}" = ?' for c in filters) or "1"
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM {self.table} WHERE {where} ORDER BY rowid",
+                list(filters.values()),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def rows_since(self, rowid: int) -> list[dict]:
+        """ Return the entries appended after row `rowid`, in append order (a range scan of the primary key). """
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM {self.table} WHERE rowid > ? ORDER BY rowid",
+                [rowid],
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def __len__(self) -> int:
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def export_csv(self, csv_file: Path) -> None:
+        """ Export the whole index to a CSV file, streaming rows from the database. """
+        csv_file = Path(csv_file)
+        tmp_file = csv_file.with_suffix(csv_file.suffix + ".tmp")
+        with self._connect() as conn, tmp_file.open("w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(INDEX_COLUMNS)
+            names = ", ".join(f'"{c}"' for c in INDEX_COLUMNS)
+            for row in conn.execute(f"SELECT {names} FROM {self.table} ORDER BY rowid"):
+                writer.writerow(list(row))
+        tmp_file.replace(csv_file)
+        logger.debug(f"Index exported to {csv_file}")
+
+    def import_csv(self, csv_file: Path) -> int:
+        """ Import the entries of a legacy `index.csv` file. Returns the number of imported rows. """
+        csv_file = Path(csv_file)
+        with csv_file.open("r", newline="") as f:
+            rows = [
+                {k: (v if v != "" else None) for k, v in row.items() if k in INDEX_COLUMNS}
+                for row in csv.DictReader(f)
+            ]
+        if not rows:
+            return 0
+
+        with self._lock, self._connect() as conn:
+            for row in rows:
+                names = ", ".join(f'"{c}"' for c in row)
+                placeholders = ", ".join("?" for _ in row)
+                conn.execute(f"INSERT INTO {self.table} ({names}) VALUES ({placeholders})", list(row.values()))
+        logger.info(f"Imported {len(rows)} entries from legacy index {csv_file}")
+        return len(rows)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from . import logger
+from .query import Query
+from .setup import PipelineConfig
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+JOB_STATES = [PENDING, RUNNING, DONE, FAILED]
+
+
+class RetrievalJournal:
+    """
+    Persistent journal of retrieval runs, backed by an SQLite database in the landing folder.
+
+    A run stores the configuration, the query, the execution options and the full list of
+    planned requests. Each request (job) tracks its state (pending / running / done / failed),
+    the number of attempts and the last error, so an interrupted run can be resumed by
+    executing only the jobs that are not done.
+    """
+
+    def __init__(self, db_file: Path, timeout: float = 60.0):
+        self.db_file = Path(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self) -> None:
+        """ Create the runs and jobs tables if needed. """
+        with self._lock, self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id TEXT PRIMARY KEY, created INTEGER, config TEXT, query TEXT, options TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "run_id TEXT, position INTEGER, request TEXT, state TEXT, attempts INTEGER, "
+                "last_error TEXT, updated INTEGER, PRIMARY KEY (run_id, position))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (run_id, state)")
+
+    def create_run(self, config: PipelineConfig, query: Query, requests: list[dict], options: dict) -> str:
+        """ Persist a new run with all its planned requests in the pending state. Returns the run ID. """
+        now = int(time.time())
+        config_json = json.dumps(config.to_dict())
+        query_json = json.dumps(query.to_dict())
+        run_id = hashlib.sha256(f"{config_json}_{query_json}_{time.time_ns()}".encode()).hexdigest()[:16]
+
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO runs (run_id, created, config, query, options) VALUES (?, ?, ?, ?, ?)",
+                (run_id, now, config_json, query_json, json.dumps(options)),
+            )
+            conn.executemany(
+                "INSERT INTO jobs (run_id, position, request, state, attempts, last_error, updated) "
+                "VALUES (?, ?, ?, ?, 0, NULL, ?)",
+                [(run_id, i, json.dumps(req), PENDING, now) for i, req in enumerate(requests)],
+            )
+        logger.info(f"Journal run {run_id} created with {len(requests)} requests in {self.db_file}")
+        return run_id
+
+    def load_run(self, run_id: str) -> tuple[PipelineConfig, Query, dict]:
+        """ Load the configuration, query and options of a run. """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            logger.error(f"Run {run_id} not found in journal {self.db_file}")
+            raise KeyError(f"Run {run_id} not found in journal {self.db_file}")
+
+        config = PipelineConfig(**json.loads(row["config"]))
+        query = Query.from_dict(json.loads(row["query"]))
+        return config, query, json.loads(row["options"])
+
+    def latest_unfinished_run(self) -> str | None:
+        """ Return the ID of the most recent run that still has jobs which are not done. """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT runs.run_id FROM runs JOIN jobs ON runs.run_id = jobs.run_id "
+                "WHERE jobs.state != ? GROUP BY runs.run_id ORDER BY runs.created DESC LIMIT 1",
+                (DONE,),
+            ).fetchone()
+        return row["run_id"] if row else None
+
+    def remaining(self, run_id: str) -> list[tuple[int, dict]]:
+        """ Return the (position, request) pairs of the jobs of a run that are not done. """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT position, request FROM jobs WHERE run_id = ? AND state != ? ORDER BY position",
+                (run_id, DONE),
+            ).fetchall()
+        return [(r["position"], json.loads(r["request"])) for r in rows]
+
+    def mark(self, run_id: str, position: int, state: str, error: str | None = None) -> None:
+        """ Update the state of a job. Moving a job to the running state counts as a new attempt. """
+        if state not in JOB_STATES:
+            raise ValueError(f"Unknown job state '{state}'. Choose from {JOB_STATES}.")
+
+        attempt = 1 if state == RUNNING else 0
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + ?, "
+                "last_error = COALESCE(?, last_error), updated = ? "
+                "WHERE run_id = ? AND position = ?",
+                (state, attempt, error, int(time.time()), run_id, position),
+            )
+
+    def summary(self, run_id: str) -> dict[str, int]:
+        """ Return the number of jobs of a run in each state. """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT state, COUNT(*) AS n FROM jobs WHERE run_id = ? GROUP BY state", (run_id,)
+            ).fetchall()
+        counts = {state: 0 for state in JOB_STATES}
+        counts.update({r["state"]: r["n"] for r in rows})
+        return counts
@@ -1,51 +1,247 @@
-import concurrent.futures
+import time
+import asyncio
+import itertools
+import dataclasses
 
 from . import logger
 from .setup import PipelineConfig
-from .query import Query
-from .ecmwf_client_new import ECMWFRequestsExecutor, ECMWFRequestsBuilder
+from .query import Query, QueryGroup
+from .journal import RetrievalJournal, RUNNING, DONE, FAILED
+from .ecmwf_client_new import (
+    ECMWFRequestsExecutor, ECMWFRequestsBuilder, ECMWFRequestsPlanner,
+    AdaptiveScheduler, CostEstimator, QueryMerger,
+)
+from .ecmwf_client_new.telemetry import MetricsRecorder, METRICS_FOLDER_NAME
+
+
+JOURNAL_FILE_NAME = "journal.sqlite"
+RETRIEVAL_OPTIONS = ["dry_run", "skip_cost", "skip_query", "force", "consolidate"]
+SCHEDULING_OPTIONS = ["max_concurrent_jobs", "max_submit_rate", "recent_first", "use_async", "prometheus"]
+BACKEND_OPTIONS = ["service_factory", "async_service_factory"]  # MARS clients, replaced by the benchmarks
+
 
 def run_retrieval(
     config: PipelineConfig,
     concurrent_jobs: int = 1,
+    plan: bool = False,
+    query_paths: list[str] | None = None,
     **kwargs
 ):
-    logger.info(f"Starting pipeline with config file '{config.name}' and query file '{config.name}'")
-
-    query = Query.from_json(config.query_path)
-    builder = ECMWFRequestsBuilder(config, query)
-    executor = ECMWFRequestsExecutor(config, query)
-
-    requests = builder.build_requests()
-
-    if concurrent_jobs > 1:
-        logger.info(f"Running with up to {concurrent_jobs} concurrent jobs...")
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrent_jobs) as thread_pool:
-            future_to_request = {
-                thread_pool.submit(executor.get_forecast, req, **kwargs): req 
-                for req in requests
-            }
-
-            for future in concurrent.futures.as_completed(future_to_request):
-                original_request = future_to_request[future]
-
-                try:
-                    success = future.result()
-                    if success:
-                        logger.info(f"Successfully completed request: {original_request}")
-                    else:
-                        logger.warning(f"Request failed: {original_request}")
-                except Exception as e:
-                    logger.error(f"Unexpected error durring execution: {e}")
-            
+    """
+    Retrieve the query of the configuration, or with `query_paths` several queries at once:
+    queries are merged into groups sharing their requests (see `QueryMerger`) and the
+    retrieved files are indexed under each query they cover. Each group is a journal run.
+    """
+    if query_paths:
+        logger.info(f"Starting pipeline with config file '{config.name}' and query files {query_paths}")
+        queries = QueryMerger([Query.from_json(path) for path in query_paths]).groups()
     else:
-        logger.info("Running sequentially...")
+        logger.info(f"Starting pipeline with config file '{config.name}' and query file '{config.query_path}'")
+        queries = [Query.from_json(config.query_path)]
+
+    journal = RetrievalJournal(config.landing_path / JOURNAL_FILE_NAME)
+    options = {k: kwargs[k] for k in RETRIEVAL_OPTIONS if k in kwargs}
+    scheduling = {k: kwargs[k] for k in SCHEDULING_OPTIONS if k in kwargs}
+    backend = {k: kwargs[k] for k in BACKEND_OPTIONS if k in kwargs}
+
+    for query in queries:
+        start = time.monotonic()
+        requests = _build_requests(config, query, plan)
+        plan_time = time.monotonic() - start
+        if not plan and isinstance(query, QueryGroup) and len(query.members) > 1:
+            separate = sum(len(_build_requests(config, member, plan)) for member in query.members)
+            logger.info(f"Query group '{query.name}': {len(requests)} shared requests instead of {separate}")
+
+        run_id = journal.create_run(config, query, requests, options)
+        _execute_run(
+            journal, run_id, config, query, concurrent_jobs,
+            plan_time=plan_time, backend=backend, **scheduling, **options
+        )
+
+
+def _build_requests(config: PipelineConfig, query: Query, plan: bool = False) -> list[dict]:
+    if plan:
+        return ECMWFRequestsPlanner(config, query).build_requests()
+    return ECMWFRequestsBuilder(config, query).build_requests()
+
+
+def resume_retrieval(
+    config: PipelineConfig,
+    run_id: str | None = None,
+    concurrent_jobs: int = 1,
+    max_attempts: int | None = None,
+    **kwargs
+):
+    """ Resume an interrupted retrieval run, executing only the requests that are not done. """
+    journal = RetrievalJournal(config.landing_path / JOURNAL_FILE_NAME)
+    run_id = run_id or journal.latest_unfinished_run()
+    if run_id is None:
+        logger.info(f"No unfinished run found in journal {journal.db_file}. Nothing to resume.")
+        return
+
+    run_config, query, options = journal.load_run(run_id)
+    if max_attempts is not None:
+        run_config = dataclasses.replace(run_config, max_attempts=max_attempts)
+    logger.info(f"Resuming run {run_id} with config '{run_config.name}' and query '{query.name}'")
+    scheduling = {k: kwargs[k] for k in SCHEDULING_OPTIONS if k in kwargs}
+    backend = {k: kwargs[k] for k in BACKEND_OPTIONS if k in kwargs}
+    _execute_run(journal, run_id, run_config, query, concurrent_jobs, backend=backend, **scheduling, **options)
+
+
+def _execute_run(
+    journal: RetrievalJournal,
+    run_id: str,
+    config: PipelineConfig,
+    query: Query,
+    concurrent_jobs: int = 1,
+    max_concurrent_jobs: int | None = None,
+    max_submit_rate: float | None = None,
+    recent_first: bool = False,
+    use_async: bool = False,
+    prometheus: bool = False,
+    plan_time: float = 0.0,
+    consolidate: bool = False,
+    backend: dict | None = None,
+    **kwargs
+):
+    """
+    Execute the remaining jobs of a journal run, recording the state of each job and the
+    metrics of each request (see `MetricsRecorder`).
+    """
+    executor = ECMWFRequestsExecutor(config, query, **(backend or {}))
+    executor.metrics = MetricsRecorder(config.landing_path / METRICS_FOLDER_NAME, run_id, prometheus)
+    executor.metrics.plan_time = plan_time
+    if consolidate:
+        _consolidate_on_finalize(executor, config)
+    jobs = journal.remaining(run_id)
+    logger.info(f"Run {run_id}: {len(jobs)} requests to execute.")
 
-        for request in requests:
-            executor.get_forecast(
-                request=request,
-                **kwargs
+    def run_job(position: int, request: dict) -> bool:
+        journal.mark(run_id, position, RUNNING)
+        success = executor.get_forecast(request=request, **kwargs)
+        if success:
+            journal.mark(run_id, position, DONE)
+            logger.info(f"Successfully completed request: {request}")
+        else:
+            journal.mark(run_id, position, FAILED, error=executor.last_error or "Unknown error")
+            logger.warning(f"Request failed: {request}")
+        return success
+
+    async def run_job_async(position: int, request: dict) -> bool:
+        journal.mark(run_id, position, RUNNING)
+        success = await executor.get_forecast_async(request=request, **kwargs)
+        if success:
+            journal.mark(run_id, position, DONE)
+            logger.info(f"Successfully completed request: {request}")
+        else:
+            journal.mark(run_id, position, FAILED, error=executor.last_error or "Unknown error")
+            logger.warning(f"Request failed: {request}")
+        return success
+
+    if recent_first:
+        logger.info("Prioritising the most recent issue dates.")
+        jobs.sort(key=lambda job: job[1]["date"], reverse=True)
+
+    scheduler = AdaptiveScheduler(
+        concurrency=concurrent_jobs,
+        max_concurrency=max_concurrent_jobs,
+        rate_limit=max_submit_rate,
+    )
+    executor.on_rejection = scheduler.report_rejection
+
+    if use_async:
+        logger.info(
+            f"Running asynchronously with {concurrent_jobs} jobs in flight "
+            f"(adaptive, up to {scheduler.max_concurrency})..."
+        )
+        asyncio.run(scheduler.run_async(jobs, lambda job: run_job_async(*job)))
+    else:
+        if scheduler.max_concurrency > 1:
+            logger.info(
+                f"Running with {concurrent_jobs} concurrent jobs "
+                f"(adaptive, up to {scheduler.max_concurrency})..."
             )
+        else:
+            logger.info("Running sequentially...")
+        scheduler.run(jobs, lambda job: run_job(*job))
+
+    summary = journal.summary(run_id)
+    logger.info(f"Run {run_id} journal: " + ", ".join(f"{n} {state}" for state, n in summary.items()))
+    if summary[FAILED] or summary[RUNNING]:
+        logger.info(f"Run 'python -m src resume --run-id {run_id}' to retry the remaining requests.")
 
+    executor.log_failure_report()
+    executor.log_cache_report()
+    executor.metrics.log_summary()
+    executor.storage_manager.export_index()
     logger.info("Pipeline finished.")
+
+
+def _consolidate_on_finalize(executor: ECMWFRequestsExecutor, config: PipelineConfig) -> None:
+    """ Write each new index entry of the executor to its Zarr store as soon as it is finalized. """
+    from .preprocessing import ZarrConsolidator
+
+    consolidator = ZarrConsolidator(config.landing_path)
+
+    def consolidate_entry(entry: dict) -> None:
+        try:
+            consolidator.consolidate(entry)
+        except Exception as e:
+            logger.error(f"Consolidation of entry {entry['entry_id']} failed: {e}")
+            logger.info("Run 'python -m src consolidate' to consolidate the remaining entries.")
+
+    logger.info(f"Consolidating retrieved files into {consolidator.store_folder}")
+    executor.storage_manager.on_finalize = consolidate_entry
+
+
+def run_cost_mapping(
+    config: PipelineConfig,
+    variables: list[str] | None = None,
+    max_combination_size: int = 2,
+    sample_requests: int = 1,
+    concurrent_jobs: int = 4,
+    output_path: str | None = None,
+    **kwargs
+):
+    """
+    Estimate the MARS cost of every combination of up to `max_combination_size` variables for the
+    configured query, without retrieving data, and write a single cost table.
+    Only the first `sample_requests` requests of each combination are estimated.
+    """
+    from ecmwfapi import ECMWFService
+    from .setup.logging import ecmwf_log
+
+    variables = variables or config.variables
+    query = Query.from_json(config.query_path)
+    combinations = [
+        list(combo)
+        for size in range(1, max_combination_size + 1)
+        for combo in itertools.combinations(variables, size)
+    ]
+    logger.info(f"Estimating the cost of {len(combinations)} variable combinations for query '{query.name}'")
+
+    requests, request_combos = [], []
+    for combo in combinations:
+        combo_config = dataclasses.replace(config, variables=combo)
+        for request in ECMWFRequestsBuilder(combo_config, query).build_requests()[:sample_requests]:
+            requests.append(request)
+            request_combos.append(",".join(combo))
+
+    estimator = CostEstimator(
+        ECMWFService("mars", log=ecmwf_log),
+        config.landing_path / "queries_cost",
+        max_workers=concurrent_jobs,
+    )
+    records = {r.request_hash: r for r in estimator.estimate_many(requests)}
+
+    rows = []
+    for request, combo in zip(requests, request_combos):
+        record = records.get(CostEstimator.request_hash(request))
+        if record is not None:
+            rows.append({"combination": combo, **record.to_row()})
+
+    cached = sum(r.cached for r in records.values())
+    logger.info(f"{len(records)} cost checks done ({cached} from cache, {len(requests) - len(records)} failed)")
+
+    output_path = output_path or config.landing_path / "variable_costs.csv"
+    CostEstimator.write_cost_table(rows, output_path)
@@ -1,4 +1,7 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from .main import run_preprocessing
\ No newline at end of file
+from .main import run_preprocessing
+from .consolidation import ZarrConsolidator, run_consolidation
+from .reader import read_staging, latest_issue, run_read
+from .series import SeriesCache, update_series_cache
@@ -0,0 +1,327 @@
+from __future__ import annotations
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+import zarr
+import numpy as np
+import xarray as xr
+from xarray.coding.times import encode_cf_datetime
+
+from . import logger
+from .main import ALLOWED_ENGINES, load_entry_files, entry_point_indexes, query_time_bounds
+from .interpolation import interpolate
+from .grib_reader import read_grib_points
+from ..setup import PipelineConfig
+from ..storage import StorageManager
+
+
+STORE_DIMS = ["time", "step", "number", "points"]
+STORE_FOLDER_NAME = "zarr"
+
+
+class RegionIndex:
+    """
+    Regions of the consolidated stores filled by each index entry, backed by a `regions` table
+    next to the retrieval index. A region is a contiguous range `[time_start, time_stop)` of
+    issue-time positions in a store; an entry spans several regions when some of its issue
+    times were already in the store and were overwritten in place.
+    """
+
+    table = "regions"
+
+    def __init__(self, db_file: Path, timeout: float = 60.0):
+        self.db_file = Path(db_file)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "entry_id TEXT NOT NULL, store TEXT NOT NULL, "
+                "time_start INTEGER NOT NULL, time_stop INTEGER NOT NULL, consolidated INTEGER)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_entry_id ON {self.table} (entry_id)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, entry_id: str, store: str, runs: list[tuple[int, int]]) -> None:
+        """ Record the regions `[(time_start, time_stop), ...]` written for an entry. """
+        now = int(time.time())
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                f"INSERT INTO {self.table} (entry_id, store, time_start, time_stop, consolidated) VALUES (?, ?, ?, ?, ?)",
+                [(entry_id, store, start, stop, now) for start, stop in runs],
+            )
+
+    def find(self, **filters) -> list[dict]:
+        """ Return the regions matching the given column filters (`entry_id`, `store`). """
+        where = " AND ".join(f'"{c}" = ?' for c in filters) or "1"
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM {self.table} WHERE {where} ORDER BY rowid", list(filters.values())
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def remap(self, store: str, mapping: dict[int, int]) -> None:
+        """ Move the recorded regions of a store to new positions (`{old: new}`), after issue times were inserted. """
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT rowid, entry_id, time_start, time_stop, consolidated FROM {self.table} WHERE store = ?", [store]
+            ).fetchall()
+            for row in rows:
+                positions = range(row["time_start"], row["time_stop"])
+                if not any(j in mapping for j in positions):
+                    continue
+                runs = _contiguous_runs([mapping.get(j, j) for j in positions])
+                conn.execute(f"DELETE FROM {self.table} WHERE rowid = ?", [row["rowid"]])
+                conn.executemany(
+                    f"INSERT INTO {self.table} (entry_id, store, time_start, time_stop, consolidated) VALUES (?, ?, ?, ?, ?)",
+                    [(row["entry_id"], store, start, stop, row["consolidated"]) for start, stop in runs],
+                )
+
+    def consolidated_entries(self) -> set[str]:
+        """ Return the IDs of the entries already written to a store. """
+        with self._connect() as conn:
+            return {r[0] for r in conn.execute(f"SELECT DISTINCT entry_id FROM {self.table}")}
+
+
+def _contiguous_runs(indexes: list[int]) -> list[tuple[int, int]]:
+    """ Group sorted positions into `[start, stop)` ranges. """
+    runs = []
+    for i in sorted(indexes):
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+    return runs
+
+
+class ZarrConsolidator:
+    """
+    Append retrieved files into one Zarr store per query, model and level:
+
+        <landing>/zarr/<query_id>_<model>_<level>.zarr
+
+    Each store holds the variables interpolated at the query points, with dimensions
+    (time, step, number, points) where `time` is the issue time, chunked by `time_chunk`
+    issue times and compressed with the Zarr default codec. Issue times already in the
+    store are updated in place (the values of the entry take precedence, points and variables
+    it does not cover are kept) and new ones are inserted in order, so the `time` axis stays
+    sorted whatever the order the entries arrive in (concurrent jobs, `--recent-first`, retries)
+    and can be sliced with `.sel(time=slice(...))`. The positions written for each index entry
+    are recorded in a `regions` table of the landing index, and moved when issue times are
+    inserted before them.
+
+    Writes to the stores are serialised by a lock, so `consolidate` can be called from the
+    threads of a retrieval run.
+    """
+
+    time_chunk = 32
+
+    def __init__(
+        self,
+        landing_folder: Path,
+        store_folder: Path | None = None,
+        interpolation: str = "linear",
+        engine: str = "auto",
+    ):
+        self.landing_folder = Path(landing_folder)
+        self.store_folder = Path(store_folder) if store_folder else self.landing_folder / STORE_FOLDER_NAME
+        self.interpolation = interpolation
+        self.engine = engine
+        self.regions = RegionIndex(self.landing_folder / "index.sqlite")
+        self._lock = threading.Lock()
+
+    def store_path(self, entry: dict) -> Path:
+        return self.store_folder / f"{entry['query_id']}_{entry['model']}_{entry['level']}.zarr"
+
+    def consolidate(self, entry: dict) -> bool:
+        """ Write an index entry to its store. Returns False if its files are missing. """
+        ds = self.entry_dataset(entry)
+        if ds is None:
+            return False
+
+        store = self.store_path(entry)
+        name = os.path.relpath(store, self.landing_folder)
+        with self._lock:
+            indexes, moved = self._write(store, ds)
+            if moved:
+                self.regions.remap(name, moved)
+            self.regions.add(entry["entry_id"], name, _contiguous_runs(indexes))
+        logger.info(f"Consolidated entry {entry['entry_id']} into {store} ({len(indexes)} issue times)")
+        return True
+
+    def entry_dataset(self, entry: dict) -> xr.Dataset | None:
+        """ Interpolate the data file of an entry at its query points, as a (time, step, number, points) dataset. """
+        files = load_entry_files(entry, self.landing_folder)
+        if files is None:
+            return None
+        query, data_path = files
+
+        all_lats, all_lons = np.array(query.points.lats), np.array(query.points.lons)
+        points = entry_point_indexes(entry, query)
+        if not len(points):
+            logger.warning(f"No query point inside the area {entry['area']} of entry {entry['entry_id']}. Skipping entry.")
+            return None
+
+        lats, lons = all_lats[points], all_lons[points]
+        if self.engine != "xarray" and str(entry.get("format", "")).startswith("grib"):
+            df = read_grib_points(data_path, lats, lons, method=self.interpolation)
+            variables = [c for c in df.columns if c not in STORE_DIMS + ["latitude", "longitude", "valid_time"]]
+            ds = df.set_index(STORE_DIMS)[variables].to_xarray()
+        else:
+            with xr.open_dataset(data_path) as data:
+                ds = interpolate(data, lats, lons, method=self.interpolation).load()
+
+        ds = ds[[name for name, var in ds.data_vars.items() if set(var.dims) <= set(STORE_DIMS)]]
+        ds = ds.drop_vars([name for name in ds.coords if name not in STORE_DIMS])
+        if "time" not in ds.dims:
+            ds = ds.expand_dims("time")
+        start, end = query_time_bounds(query)
+        ds = ds.isel(time=np.flatnonzero((ds["time"].values >= start) & (ds["time"].values <= end)))
+        if not ds.sizes["time"]:
+            logger.warning(f"No issue time of entry {entry['entry_id']} is in the range of its query. Skipping entry.")
+            return None
+        ds = ds.sortby("time").transpose(*[d for d in STORE_DIMS if d in ds.dims])
+        ds = ds.assign_coords(points=points).reindex(points=np.arange(len(all_lats)))
+        ds = ds.assign_coords(latitude=("points", all_lats), longitude=("points", all_lons))
+        for var in ds.variables.values():
+            var.encoding = {}
+        return ds
+
+    def _write(self, store: Path, ds: xr.Dataset) -> tuple[list[int], dict[int, int]]:
+        """
+        Write a dataset to a store. Returns the issue-time positions it was written to, and the
+        new positions of the stored issue times moved by the insertion (`{old: new}`).
+        """
+        if not store.exists():
+            store.parent.mkdir(parents=True, exist_ok=True)
+            encoding = {
+                name: {"chunks": tuple(self.time_chunk if d == "time" else n for d, n in var.sizes.items())}
+                for name, var in ds.data_vars.items()
+            }
+            ds.to_zarr(store, mode="w", encoding=encoding, zarr_format=2)
+            return list(range(ds.sizes["time"])), {}
+
+        with xr.open_zarr(store) as existing:
+            ds = self._align(store, ds, existing)
+            stored = existing["time"].values
+            time_encoding = existing["time"].encoding
+            positions = {t: i for i, t in enumerate(stored)}
+
+            in_store = np.array([t in positions for t in ds["time"].values])
+            regions = []
+            for i in np.flatnonzero(in_store):
+                # keep the stored values of the points and variables this entry does not cover
+                j = positions[ds["time"].values[i]]
+                regions.append((j, ds.isel(time=[i]).combine_first(existing.isel(time=[j])).load()))
+
+        indexes = []
+        for j, block in regions:
+            self._write_region(store, block, j)
+            indexes.append(j)
+
+        new = ds.isel(time=np.flatnonzero(~in_store))
+        if not new.sizes["time"]:
+            return indexes, {}
+
+        # the issue times from the first one out of order are rewritten in order, the rest appended
+        times = np.sort(np.concatenate([stored, new["time"].values]))
+        unchanged = times[:len(stored)] == stored
+        first = int(np.argmin(unchanged)) if not unchanged.all() else len(stored)
+        moved = {j: int(np.searchsorted(times, stored[j])) for j in range(first, len(stored))}
+        if first < len(stored):
+            logger.debug(f"Inserting {new.sizes['time']} issue times at position {first} of store {store}")
+            with xr.open_zarr(store) as existing:
+                tail = existing.isel(time=slice(first, None)).load()
+            new = xr.concat([tail, new], dim="time", data_vars="minimal", coords="minimal").sortby("time")
+            rewritten = new.isel(time=slice(0, len(stored) - first))
+            self._write_region(store, rewritten, first)
+            # region writes leave the index coordinate as it is
+            values, _, _ = encode_cf_datetime(
+                rewritten["time"].values, time_encoding["units"], time_encoding["calendar"], time_encoding["dtype"]
+            )
+            zarr.open_group(str(store), mode="r+")["time"][first:len(stored)] = values
+            new = new.isel(time=slice(len(stored) - first, None))
+        new.to_zarr(store, append_dim="time")
+
+        indexes = [moved.get(j, j) for j in indexes]
+        indexes.extend(int(i) for i in np.searchsorted(times, ds["time"].values[~in_store]))
+        return indexes, {j: k for j, k in moved.items() if j != k}
+
+    @staticmethod
+    def _write_region(store: Path, block: xr.Dataset, start: int) -> None:
+        """ Overwrite the variables of the issue-time positions of a store from `start` with a block. """
+        region_vars = [name for name, var in block.variables.items() if "time" not in var.dims]
+        block.drop_vars(region_vars).to_zarr(store, region={"time": slice(start, start + block.sizes["time"])})
+
+    def _align(self, store: Path, ds: xr.Dataset, existing: xr.Dataset) -> xr.Dataset:
+        """ Match the dimensions and variables of a dataset to an existing store. """
+        for dim in STORE_DIMS[1:]:
+            if dim in existing.dims and dim not in ds.dims:
+                value = ds[dim].item() if dim in ds.coords else 0
+                ds = ds.drop_vars(dim, errors="ignore").expand_dims({dim: [value]})
+            elif dim in ds.dims and dim not in existing.dims and ds.sizes[dim] == 1:
+                ds = ds.isel({dim: 0}, drop=True)
+
+        for dim in existing.dims:
+            if dim == "time" or dim not in ds.dims:
+                continue
+            dropped = np.setdiff1d(ds[dim].values, existing[dim].values)
+            if len(dropped):
+                logger.warning(f"{len(dropped)} {dim} values are not in store {store} and are dropped.")
+            ds = ds.reindex({dim: existing[dim].values})
+
+        for name, var in existing.data_vars.items():
+            if name not in ds:
+                ds[name] = xr.full_like(ds[next(iter(ds.data_vars))], np.nan, dtype=var.dtype).transpose(*var.dims)
+
+        new_vars = [name for name in ds.data_vars if name not in existing.data_vars]
+        if new_vars:
+            logger.info(f"Adding variables {new_vars} to store {store}")
+            template = existing[next(iter(existing.data_vars))]
+            template = template.drop_vars(list(template.coords))
+            xr.Dataset({
+                name: xr.full_like(template, np.nan, dtype=ds[name].dtype) for name in new_vars
+            }).to_zarr(store, mode="a")
+
+        ds = ds.transpose(*[d for d in STORE_DIMS if d in ds.dims])
+        return ds.assign_coords({c: existing[c] for c in ("latitude", "longitude") if c in existing.coords})
+
+
+def run_consolidation(
+    config: PipelineConfig,
+    interpolation: str = "linear",
+    engine: str = "auto",
+    store_path: str | None = None,
+    **kwargs
+):
+    """
+    Consolidate every index entry not yet in a Zarr store, so that years of forecasts for a
+    query can be read with a single `xarray.open_zarr` instead of opening every landing file.
+    """
+    if engine not in ALLOWED_ENGINES:
+        logger.error(f"Preprocessing engine '{engine}' is not allowed. Choose from {ALLOWED_ENGINES}.")
+        raise ValueError(f"Preprocessing engine '{engine}' is not allowed. Choose from {ALLOWED_ENGINES}.")
+
+    landing_folder = Path(config.landing_path)
+    consolidator = ZarrConsolidator(landing_folder, store_path, interpolation, engine)
+    consolidated = consolidator.regions.consolidated_entries()
+
+    entries = StorageManager(landing_folder).index.find()
+    new_entries = [entry for entry in entries if entry["entry_id"] not in consolidated]
+    logger.info(f"{len(new_entries)} of {len(entries)} index entries to consolidate into {consolidator.store_folder}.")
+
+    n_done = sum(consolidator.consolidate(entry) for entry in new_entries)
+    logger.info(f"Consolidated {n_done} entries.")
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from . import logger
+
+
+ALLOWED_LAYOUTS = ["wide", "long"]
+
+
+def check_layout(layout: str) -> None:
+    if layout not in ALLOWED_LAYOUTS:
+        logger.error(f"Layout '{layout}' is not allowed. Choose from {ALLOWED_LAYOUTS}.")
+        raise ValueError(f"Layout '{layout}' is not allowed. Choose from {ALLOWED_LAYOUTS}.")
+
+
+def frame_from_arrays(columns: dict[str, np.ndarray], variables: dict[str, np.ndarray], layout: str = "wide") -> pd.DataFrame:
+    """
+    Build a table from flat coordinate `columns` and flat `variables` arrays of the same length.
+
+    `wide` has one column per variable. `long` has a categorical `variable` column and a `value`
+    column, with the coordinate columns repeated for each variable. Arrays are used without copy
+    where possible. The names of the variables are kept in `attrs["variables"]`.
+    """
+    check_layout(layout)
+    if layout == "wide":
+        df = pd.DataFrame({**columns, **variables}, copy=False)
+        df.attrs["variables"] = list(variables)
+        return df
+
+    n_rows, names = len(next(iter(columns.values()))), list(variables)
+    long = {name: np.tile(column, len(names)) for name, column in columns.items()}
+    long["variable"] = pd.Categorical.from_codes(np.repeat(np.arange(len(names), dtype=np.int16), n_rows), names)
+    long["value"] = np.concatenate([variables[name] for name in names]) if names else np.empty(0, dtype=np.float32)
+    df = pd.DataFrame(long, copy=False)
+    df.attrs["variables"] = names
+    return df
+
+
+def dataset_to_frame(data: xr.Dataset, layout: str = "wide") -> pd.DataFrame:
+    """
+    Flatten a dataset to one row per element of its data variables, from the NumPy arrays.
+
+    Unlike `xarray.Dataset.to_dataframe`, no MultiIndex is built: each dimension becomes a
+    broadcast coordinate column, non-index coordinates are broadcast to the rows (scalar ones
+    as constant columns) and each variable is raveled, a view of its values if they are
+    contiguous. Rows are ordered by the dimensions of the first data variable (e.g. time, step,
+    number, points); dimensions without coordinate get their positions (e.g. `points`).
+    """
+    names = list(data.data_vars)
+    dims = list(data[names[0]].dims) if names else []
+    dims += [d for d in data.dims if d not in dims]
+    shape = tuple(data.sizes[d] for d in dims)
+
+    def broadcast(var: xr.DataArray) -> np.ndarray:
+        values = var.transpose(*[d for d in dims if d in var.dims]).values
+        expanded = values.reshape([data.sizes[d] if d in var.dims else 1 for d in dims])
+        return np.broadcast_to(expanded, shape).ravel()
+
+    columns = {}
+    for i, dim in enumerate(dims):
+        coord = data[dim].values if dim in data.coords else np.arange(shape[i])
+        columns[dim] = np.tile(np.repeat(coord, int(np.prod(shape[i + 1:]))), int(np.prod(shape[:i])))
+    for name, coord in data.coords.items():
+        if name not in dims:
+            columns[name] = broadcast(coord)
+    variables = {name: broadcast(data[name]) for name in names}
+    return frame_from_arrays(columns, variables, layout)
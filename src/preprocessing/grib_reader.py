@@ -0,0 +1,138 @@
+from __future__ import annotations
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import eccodes
+
+from . import logger
+from .interpolation import get_weights
+from .frames import frame_from_arrays
+from ..utils.profiling import timer
+
+
+GEOMETRY_KEYS = [
+    "Ni",
+    "Nj",
+    "latitudeOfFirstGridPointInDegrees",
+    "longitudeOfFirstGridPointInDegrees",
+    "iDirectionIncrementInDegrees",
+    "jDirectionIncrementInDegrees",
+    "iScansNegatively",
+    "jScansPositively",
+]
+
+
+def _grid_axes(geometry: tuple) -> tuple[np.ndarray, np.ndarray]:
+    """ Latitudes and longitudes of a regular lat/lon grid, in the order of the message values. """
+    ni, nj, lat_first, lon_first, di, dj, i_negative, j_positive = geometry
+    lats = lat_first + (1 if j_positive else -1) * dj * np.arange(nj)
+    lons = lon_first + (-1 if i_negative else 1) * di * np.arange(ni)
+    return lats, lons
+
+
+def read_grib_points(
+    path: Path,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    method: str = "linear",
+    layout: str = "wide",
+) -> pd.DataFrame:
+    """
+    Stream the messages of a GRIB file and interpolate each of them at the given points.
+
+    Only the grid values needed by the interpolation are decoded from each message, and
+    results are written into arrays preallocated from the message count, so memory does
+    not depend on the grid size. Returns one row per (time, step, number, point) with one
+    column per variable (named after the cfgrib variable names, e.g. `t2m`), or in the `long`
+    layout one row per variable too (see `frame_from_arrays`).
+    """
+    path = Path(path)
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    n_points = len(lats)
+
+    with path.open("rb") as f, timer.stage("decode"):
+        n_messages = eccodes.codes_count_in_file(f)
+        values = np.full((n_messages, n_points), np.nan, dtype=np.float32)
+        times = np.empty(n_messages, dtype="datetime64[m]")
+        steps = np.empty(n_messages, dtype=np.int64)
+        numbers = np.zeros(n_messages, dtype=np.int64)
+        names = np.empty(n_messages, dtype=object)
+
+        plans: dict[tuple, tuple] = {}
+        n_read = 0
+        for m in range(n_messages):
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                geometry = tuple(eccodes.codes_get(gid, k) for k in GEOMETRY_KEYS)
+                plan = plans.get(geometry)
+                if plan is None:
+                    grid_lats, grid_lons = _grid_axes(geometry)
+                    weights = get_weights(grid_lats, grid_lons, lats, lons, method)
+                    flat_index = weights.lat_index * geometry[0] + weights.lon_index
+                    needed, inverse = np.unique(flat_index, return_inverse=True)
+                    plan = plans[geometry] = (needed, inverse.reshape(flat_index.shape), weights.weights)
+                needed, inverse, w = plan
+
+                point_values = np.asarray(eccodes.codes_get_double_elements(gid, "values", needed.tolist()))
+                if eccodes.codes_get(gid, "bitmapPresent"):
+                    point_values[point_values == eccodes.codes_get(gid, "missingValue")] = np.nan
+                values[m] = np.einsum("pk,pk->p", point_values[inverse], w)
+
+                data_date, data_time = str(eccodes.codes_get(gid, "dataDate")), eccodes.codes_get(gid, "dataTime")
+                times[m] = np.datetime64(
+                    f"{data_date[:4]}-{data_date[4:6]}-{data_date[6:8]}T{data_time // 100:02d}:{data_time % 100:02d}"
+                )
+                steps[m] = eccodes.codes_get(gid, "endStep")
+                if eccodes.codes_is_defined(gid, "number"):
+                    numbers[m] = eccodes.codes_get(gid, "number") or 0
+                names[m] = eccodes.codes_get(gid, "cfVarName")
+            finally:
+                eccodes.codes_release(gid)
+            n_read += 1
+
+    if n_read < n_messages:
+        # the rows of the messages never read hold no values, and names of None that would pivot to code -1
+        logger.warning(f"Only {n_read} of the {n_messages} GRIB messages counted in {path} could be read.")
+        values, times, steps, numbers, names = (a[:n_read] for a in (values, times, steps, numbers, names))
+    logger.debug(f"Read {n_read} GRIB messages from {path}")
+    with timer.stage("dataframe"):
+        return _messages_to_frame(values, times, steps, numbers, names, lats, lons, layout)
+
+
+def _messages_to_frame(
+    values: np.ndarray,
+    times: np.ndarray,
+    steps: np.ndarray,
+    numbers: np.ndarray,
+    names: np.ndarray,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    layout: str = "wide",
+) -> pd.DataFrame:
+    """ Pivot per-message point values into rows keyed by (time, step, number, point), one column per variable. """
+    n_points = values.shape[1]
+    keys = pd.MultiIndex.from_arrays([times, steps, numbers])
+    key_codes, unique_keys = pd.factorize(keys, sort=True)
+    var_codes, unique_vars = pd.factorize(names, sort=True)
+
+    # variable first, so that the values of each variable are contiguous and raveled without copy
+    wide = np.full((len(unique_vars), len(unique_keys), n_points), np.nan, dtype=np.float32)
+    wide[var_codes, key_codes] = values
+
+    key_times, key_steps, key_numbers = (np.asarray(unique_keys.get_level_values(i)) for i in range(3))
+    key_times = key_times.astype("datetime64[ns]")
+    key_steps = pd.to_timedelta(key_steps, unit="h").values
+    columns = {
+        "time": np.repeat(key_times, n_points),
+        "step": np.repeat(key_steps, n_points),
+        "number": np.repeat(key_numbers, n_points),
+        "points": np.tile(np.arange(n_points), len(unique_keys)),
+        "latitude": np.tile(lats, len(unique_keys)),
+        "longitude": np.tile(lons, len(unique_keys)),
+        "valid_time": np.repeat(key_times + key_steps, n_points),
+    }
+    variables = {name: wide[j].ravel() for j, name in enumerate(unique_vars)}
+    return frame_from_arrays(columns, variables, layout)
@@ -0,0 +1,198 @@
+from __future__ import annotations
+import hashlib
+from dataclasses import dataclass
+
+import numpy as np
+import xarray as xr
+
+from . import logger
+
+
+ALLOWED_METHODS = ["linear", "nearest"]
+
+
+@dataclass(frozen=True)
+class InterpolationWeights:
+    """
+    Indexes and weights of the grid cells used to interpolate a set of points on a regular grid.
+
+    `lat_index`, `lon_index` and `weights` have shape (points, k), with k = 4 for bilinear and
+    k = 1 for nearest neighbour interpolation. Points outside the grid have NaN weights.
+    """
+    lat_index: np.ndarray
+    lon_index: np.ndarray
+    weights: np.ndarray
+    method: str
+
+    @property
+    def n_points(self) -> int:
+        return self.weights.shape[0]
+
+
+_WEIGHTS_CACHE: dict[tuple, InterpolationWeights] = {}
+_WEIGHTS_CACHE_SIZE = 128
+
+
+def _axis_weights(coords: np.ndarray, values: np.ndarray, method: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    For each value, the indexes of the two enclosing coordinates and the weight of the first one
+    (nearest: the same index twice and a weight of 1). Values outside the axis get a NaN weight.
+    A single coordinate axis (point retrievals) always maps to its only coordinate.
+    """
+    n = len(coords)
+    if n == 1:
+        zeros = np.zeros(len(values), dtype=np.intp)
+        return zeros, zeros, np.ones(len(values))
+
+    descending = coords[0] > coords[-1]
+    ascending_coords = coords[::-1] if descending else coords
+
+    pos = np.searchsorted(ascending_coords, values, side="right") - 1
+    pos = np.clip(pos, 0, n - 2)
+    lo, hi = ascending_coords[pos], ascending_coords[pos + 1]
+    frac = (values - lo) / (hi - lo)  # weight of the upper coordinate
+
+    tolerance = 1e-9 * max(1.0, float(np.abs(ascending_coords).max()))
+    outside = (values < ascending_coords[0] - tolerance) | (values > ascending_coords[-1] + tolerance)
+    frac = np.clip(frac, 0.0, 1.0)
+
+    if method == "nearest":
+        pos = np.where(frac > 0.5, pos + 1, pos)
+        i0, i1, w0 = pos, pos, np.ones(len(values))
+    else:
+        i0, i1, w0 = pos, pos + 1, 1.0 - frac
+
+    w0 = np.where(outside, np.nan, w0)
+    if descending:
+        i0, i1 = n - 1 - i0, n - 1 - i1
+    return i0, i1, w0
+
+
+def compute_weights(
+    grid_lats: np.ndarray,
+    grid_lons: np.ndarray,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    method: str = "linear",
+) -> InterpolationWeights:
+    """ Compute the interpolation weights of points (lats, lons) on a regular grid. """
+    if method not in ALLOWED_METHODS:
+        raise ValueError(f"Interpolation method '{method}' is not allowed. Choose from {ALLOWED_METHODS}.")
+
+    grid_lats, grid_lons = np.asarray(grid_lats, dtype=float), np.asarray(grid_lons, dtype=float)
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+
+    # GRIB grids may use 0-360 longitudes (e.g. 357.5 for -2.5): bring the points into the grid convention
+    if len(grid_lons) > 1:
+        lon_min = grid_lons.min() - 1e-6
+        lons = lon_min + np.mod(lons - lon_min, 360.0)
+
+    i0, i1, wy = _axis_weights(grid_lats, lats, method)
+    j0, j1, wx = _axis_weights(grid_lons, lons, method)
+
+    if method == "nearest":
+        return InterpolationWeights(
+            lat_index=i0[:, None],
+            lon_index=j0[:, None],
+            weights=(wy * wx)[:, None],
+            method=method,
+        )
+
+    return InterpolationWeights(
+        lat_index=np.stack([i0, i0, i1, i1], axis=1),
+        lon_index=np.stack([j0, j1, j0, j1], axis=1),
+        weights=np.stack([wy * wx, wy * (1 - wx), (1 - wy) * wx, (1 - wy) * (1 - wx)], axis=1),
+        method=method,
+    )
+
+
+def get_weights(
+    grid_lats: np.ndarray,
+    grid_lons: np.ndarray,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    method: str = "linear",
+) -> InterpolationWeights:
+    """ Cached `compute_weights`, keyed by the grid definition, the point set and the method. """
+    grid_lats, grid_lons = np.asarray(grid_lats, dtype=float), np.asarray(grid_lons, dtype=float)
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    key = (
+        hashlib.sha1(grid_lats.tobytes()).hexdigest(),
+        hashlib.sha1(grid_lons.tobytes()).hexdigest(),
+        hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest(),
+        method,
+    )
+    weights = _WEIGHTS_CACHE.get(key)
+    if weights is None:
+        logger.debug(f"Computing {method} interpolation weights for {len(lats)} points on a {len(grid_lats)}x{len(grid_lons)} grid")
+        weights = compute_weights(grid_lats, grid_lons, lats, lons, method)
+        if len(_WEIGHTS_CACHE) >= _WEIGHTS_CACHE_SIZE:
+            _WEIGHTS_CACHE.pop(next(iter(_WEIGHTS_CACHE)))
+        _WEIGHTS_CACHE[key] = weights
+    return weights
+
+
+def apply_weights(values: np.ndarray, weights: InterpolationWeights) -> np.ndarray:
+    """ Interpolate an array whose two last axes are (latitude, longitude). Returns (..., points). """
+    n_lon = values.shape[-1]
+    flat = values.reshape(*values.shape[:-2], values.shape[-2] * n_lon)
+    gathered = flat[..., weights.lat_index * n_lon + weights.lon_index]  # (..., points, k)
+    out = np.einsum("...pk,pk->...p", gathered, weights.weights)
+    return out.astype(values.dtype) if np.issubdtype(values.dtype, np.floating) else out
+
+
+def _interpolate_lazy(var: xr.DataArray, weights: InterpolationWeights) -> xr.DataArray:
+    """ Lazy `apply_weights` over a Dask-backed variable, one chunk of its non-grid dimensions at a time. """
+    dtype = var.dtype if np.issubdtype(var.dtype, np.floating) else np.dtype(float)
+    return xr.apply_ufunc(
+        apply_weights,
+        var.chunk({"latitude": -1, "longitude": -1}),
+        kwargs={"weights": weights},
+        input_core_dims=[["latitude", "longitude"]],
+        output_core_dims=[["points"]],
+        dask="parallelized",
+        output_dtypes=[dtype],
+        dask_gufunc_kwargs={"output_sizes": {"points": weights.n_points}},
+        keep_attrs=True,
+    )
+
+
+def interpolate(
+    data: xr.Dataset,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    method: str = "linear",
+) -> xr.Dataset:
+    """
+    Interpolate every variable of a (latitude, longitude) gridded dataset at the given points,
+    using cached weights. Equivalent to `data.interp(latitude=..., longitude=...)` along a
+    new `points` dimension.
+
+    Dask-backed variables stay lazy and are interpolated chunk by chunk when computed.
+    """
+    weights = get_weights(data["latitude"].values, data["longitude"].values, lats, lons, method)
+
+    data_vars = {}
+    for name, var in data.data_vars.items():
+        if "latitude" not in var.dims or "longitude" not in var.dims:
+            data_vars[name] = var
+            continue
+        if var.chunks is not None:
+            data_vars[name] = _interpolate_lazy(var, weights)
+            continue
+        other_dims = [d for d in var.dims if d not in ("latitude", "longitude")]
+        values = var.transpose(*other_dims, "latitude", "longitude").values
+        data_vars[name] = xr.DataArray(
+            apply_weights(values, weights),
+            dims=[*other_dims, "points"],
+            attrs=var.attrs,
+        )
+
+    coords = {
+        name: coord for name, coord in data.coords.items()
+        if "latitude" not in coord.dims and "longitude" not in coord.dims
+        and name not in ("latitude", "longitude")
+    }
+    coords["latitude"] = ("points", np.asarray(lats, dtype=float))
+    coords["longitude"] = ("points", np.asarray(lons, dtype=float))
+    return xr.Dataset(data_vars, coords=coords, attrs=data.attrs)
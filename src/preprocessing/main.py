@@ -1,93 +1,365 @@
+import time
 import traceback
+import concurrent.futures
 from pathlib import Path
+from typing import Iterator
 
 import numpy as np
 import xarray as xr
 import pandas as pd
 
 from . import logger
+from .staging import StagingWriter, StagingState, get_staging_writer
+from .interpolation import interpolate
+from .grib_reader import read_grib_points
+from .frames import check_layout, dataset_to_frame
+from .series import update_series_cache
 from ..setup import PipelineConfig
 from ..query import Query
+from ..storage import StorageManager
+from ..utils.geometry import covered_points
+from ..utils.profiling import timer, profiled
+
+
+# Columns of the rows kept in float64, every other float column (the variables) is stored as float32
+COORDINATE_COLUMNS = ["latitude", "longitude"]
+
+ALLOWED_ENGINES = ["auto", "xarray", "eccodes"]
 
 
 def run_preprocessing(
     config: PipelineConfig,
+    workers: int = 1,
+    interpolation: str = "linear",
+    engine: str = "auto",
+    chunks: str | dict[str, int] | None = None,
+    layout: str = "wide",
+    profile: bool = False,
+    profile_output: str | None = None,
+    rescan: bool = False,
+    series_cache: bool = False,
+    **kwargs
 ):
-    """ TODO """
+    """
+    Extract the query points from every new landing file and append them to staging.
+
+    Each index entry is processed independently and written to staging on its own, so an
+    incremental run only costs the new entries. The staging output is a partitioned Parquet
+    dataset, or a single CSV file if the staging path ends with `.csv`.
+
+    The position reached in the index is saved with the staging output (see `StagingState`),
+    so a run only reads the index rows appended since the previous one, plus the entries that
+    produced no rows (missing files), and never reads the staging output. Without a saved state,
+    or with `rescan`, the whole index is compared with the entries already in staging.
+
+    With `workers > 1`, entries are extracted by a pool of processes. With a Parquet staging
+    each worker writes its own entry files and the parent only records processed entries.
+
+    Interpolation weights (`linear` or `nearest`) are computed once per grid and point set
+    and reused for every file sharing them.
+
+    GRIB files are read with eccodes directly (`engine="auto"` or `"eccodes"`), decoding only
+    the grid values around the query points; `engine="xarray"` opens every file with xarray.
+
+    With `chunks` (e.g. `time=1,step=12,number=10`), files opened with xarray are read lazily
+    with Dask, interpolated chunk by chunk and streamed to staging, so files larger than memory
+    can be processed with a peak memory set by the chunk size.
+
+    Rows are built from the NumPy arrays of the interpolated data (see `dataset_to_frame`), with
+    one column per variable (`layout="wide"`) or one row per variable with `variable` and `value`
+    columns (`layout="long"`). A staging output keeps the layout it was first written with.
+
+    With `profile`, the time spent in each stage (open, decode, interpolate, dataframe, metadata,
+    concat, write) is summed over the entries, including those of the worker processes, and
+    logged at the end. With `profile_output`, the run is profiled with cProfile and the
+    statistics of the main process are written to that file.
+
+    With `series_cache`, the entries of the staging output are also written to its memory-mapped
+    series cache (see `SeriesCache`), including those processed before the cache was enabled.
+    """
+    if engine not in ALLOWED_ENGINES:
+        logger.error(f"Preprocessing engine '{engine}' is not allowed. Choose from {ALLOWED_ENGINES}.")
+        raise ValueError(f"Preprocessing engine '{engine}' is not allowed. Choose from {ALLOWED_ENGINES}.")
+    chunks = parse_chunks(chunks)
+    check_layout(layout)
+
     landing_folder = Path(config.landing_path)
-    staging_file = Path(config.staging_path)
+    writer = get_staging_writer(config.staging_path)
+    writer.check_layout(layout)
 
-    # Validate paths and read data
-    if staging_file.suffix != ".csv":
-        logger.error(f"Staging file {staging_file} is not a .csv file.")
-        raise ValueError(f"Staging file {staging_file} is not a .csv file.")
-    try:
-        staging_df = pd.read_csv(staging_file)
-    except (FileNotFoundError, pd.errors.EmptyDataError):
-        logger.info(f"Initializing empty staging file at {staging_file}.")
-        staging_file.parent.mkdir(parents=True, exist_ok=True)
-        staging_file.touch(exist_ok=True)
-        staging_df = pd.DataFrame(columns=['entry_id'])
-    logger.info(f"Read {len(staging_df)} entries from staging file {staging_file}.")
-
-    index_file = landing_folder / "index.csv"
-    if not index_file.exists():
+    index_file = landing_folder / "index.sqlite"
+    if not index_file.exists() and not (landing_folder / "index.csv").exists():
         logger.error(f"Index file {index_file} does not exist. Cannot preprocess.")
         raise FileNotFoundError(f"Index file {index_file} does not exist. Cannot preprocess.")
-    index_df = pd.read_csv(index_file)
-    logger.info(f"Read {len(index_df)} entries from index file {index_file}.")
+    index = StorageManager(landing_folder).index
+
+    state = None if rescan else writer.load_state()
+    if state is None:
+        processed = writer.processed_entries()
+        logger.info(f"Found {len(processed)} entries already in staging {writer.path}.")
+        entries = index.find()
+        logger.info(f"Read {len(entries)} entries from index file {index_file}.")
+        state = StagingState(
+            processed=[entry["rowid"] for entry in entries if entry["entry_id"] in processed],
+            layout=layout,
+        )
+        new_entries = [entry for entry in entries if entry["entry_id"] not in processed]
+        last_rowid = max((entry["rowid"] for entry in entries), default=0)
+    else:
+        writer.rollback(state)
+        new_entries = state.entries(index)
+        logger.info(
+            f"Read the index from row {state.index_rowid} of staging state {writer.state_path} "
+            f"({len(state.retry)} entries to retry)."
+        )
+        last_rowid = max([state.index_rowid, *state.processed, *(entry["rowid"] for entry in new_entries)])
+    logger.info(f"{len(new_entries)} new entries to preprocess.")
+
+    pending = {entry["rowid"] for entry in new_entries}
+
+    def collect(result: tuple[dict, pd.DataFrame | None, int, dict]) -> int:
+        # saved after each entry with the sizes of the appended files: the rows of an entry interrupted
+        # before its state is saved are truncated on the next run (`rollback`) rather than written twice
+        entry_rows = _collect(result, writer)
+        pending.discard(result[0]["rowid"])
+        state.record(result[0]["rowid"], processed=entry_rows > 0)
+        state.advance(pending, last_rowid)
+        writer.save_state(state)
+        return entry_rows
+
+    options = {"interpolation": interpolation, "engine": engine, "chunks": chunks, "layout": layout, "profile": profile}
+    n_rows = 0
+    timer.enabled = profile
+    timer.pop()
+    start = time.perf_counter()
+    with profiled(profile_output):
+        if workers > 1 and len(new_entries) > 1:
+            logger.info(f"Preprocessing with {workers} worker processes...")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(_process_entry, entry, landing_folder, writer.path, **options)
+                    for entry in new_entries
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    n_rows += collect(future.result())
+        else:
+            for entry in new_entries:
+                n_rows += collect(_process_entry(entry, landing_folder, writer.path, writer=writer, **options))
 
-    # Iterate over index
-    for _, row in index_df.iterrows():
+    state.advance(pending, last_rowid)
+    writer.save_state(state)
+    logger.info(f"Saved {n_rows} new rows to staging {writer.path}.")
+    if series_cache:
+        update_series_cache(writer)
+    if profile:
+        # with workers, stages add up over the processes and can exceed the wall time
+        timer.log_summary(f"Preprocessing stages of {len(new_entries)} entries", time.perf_counter() - start)
+
+
+def parse_chunks(chunks: str | dict | None) -> dict[str, int] | None:
+    """ Parse a chunk specification such as `time=1,step=12,number=10` (-1 for a whole dimension). """
+    if chunks is None or isinstance(chunks, dict):
+        return chunks
+    parsed = {}
+    for item in chunks.split(","):
+        dim, _, size = item.partition("=")
         try:
-            if row['entry_id'] in staging_df['entry_id'].values:
-                logger.debug(f"Entry {row['entry_id']} already in staging. Skipping.")
-                continue
-            
-            query_path = landing_folder / row['query_file']
-            if not query_path.exists():
-                logger.error(f"Query file {query_path} does not exist. Skipping entry {row['entry_id']}.")
-                continue
-            query = Query.from_json(query_path)
-            logger.debug(f"Loaded query {query.id} from {query_path}.")
-
-            data_path = landing_folder / row['data_file']
-            if not data_path.exists():
-                logger.error(f"Data file {data_path} does not exist. Skipping entry {row['entry_id']}.")
-                continue
-            data = xr.open_dataset(data_path)
-            logger.debug(f"Opened data file {data_path} with variables: {list(data.data_vars)}.")
-
-            # Interpolation
-            lats, lons = np.array(query.points.lats), np.array(query.points.lons)
-            data_interpolated = data.interp(
-                latitude=xr.DataArray(lats, dims="points"),
-                longitude=xr.DataArray(lons, dims="points"),
-            )
-            df = data_interpolated.to_dataframe().reset_index()
-
-            # Add metadata
-            df['entry_id'] = row['entry_id']
-            df['query_id'] = row['query_id']
-            df['retrieval_id'] = row['retrieval_id']
-            df['model'] = row['model']
-            df['level'] = row['level']
-            df['issued'] = row['issued']
-            df['lookback_hours'] = row['lookback_hours']
-            df['step_granularity'] = row['step_granularity']
-            df['variables'] = row['variables']
-            df['timestamp'] = row['timestamp']
-
-            # Concatenate to staging
-            staging_df = pd.concat([staging_df, df], ignore_index=True)
-            logger.info(f"Processed entry {row['entry_id']} and added {len(df)} rows to staging.")
-            data.close()
-        
-        except Exception as e:
-            logger.error(f"Error processing entry {row['entry_id']}: {e}")
-            logger.debug(f"Traceback: {traceback.format_exc()}")
-            raise e
-
-    # Save staging
-    staging_df.to_csv(staging_file, index=False)
-    logger.info(f"Saved {len(staging_df)} total entries to staging file {staging_file}.")
+            parsed[dim.strip()] = int(size)
+        except ValueError:
+            logger.error(f"Invalid chunk specification '{item}', expected <dimension>=<size>.")
+            raise ValueError(f"Invalid chunk specification '{item}', expected <dimension>=<size>.")
+    return parsed
+
+
+def _process_entry(
+    entry: dict,
+    landing_folder: Path,
+    staging_path: Path,
+    interpolation: str = "linear",
+    engine: str = "auto",
+    chunks: dict[str, int] | None = None,
+    layout: str = "wide",
+    profile: bool = False,
+    writer: StagingWriter | None = None,
+) -> tuple[dict, pd.DataFrame | None, int, dict]:
+    """
+    Extract an index entry and stream it to staging if `writer` is given (same process) or the
+    staging supports parallel writes. Returns the entry, the rows left for the parent to write
+    (if any), the number of rows and the stage timings of the entry (see `StageTimer.pop`).
+    """
+    timer.enabled = profile
+    try:
+        blocks = extract_entry_blocks(entry, landing_folder, interpolation, engine, chunks, layout)
+        if blocks is None:
+            return entry, None, 0, timer.pop()
+
+        if writer is None:
+            writer = get_staging_writer(staging_path)
+            if not writer.parallel_writes:
+                blocks = list(blocks)
+                with timer.stage("concat"):
+                    df = pd.concat(blocks, ignore_index=True)
+                return entry, df, len(df), timer.pop()
+        return entry, None, writer.write_blocks(entry, blocks), timer.pop()
+    except Exception as e:
+        logger.error(f"Error processing entry {entry['entry_id']}: {e}")
+        logger.debug(f"Traceback: {traceback.format_exc()}")
+        raise e
+
+
+def _collect(result: tuple[dict, pd.DataFrame | None, int, dict], writer: StagingWriter) -> int:
+    """ Write the rows returned by `_process_entry` if needed and mark the entry as processed. """
+    entry, df, n_rows, timings = result
+    timer.merge(timings)
+    if df is not None:
+        writer.write(entry, df)
+    if n_rows:
+        writer.mark_processed(entry)
+        logger.info(f"Processed entry {entry['entry_id']} and added {n_rows} rows to staging.")
+    return n_rows
+
+
+def extract_entry(
+    entry: dict,
+    landing_folder: Path,
+    interpolation: str = "linear",
+    engine: str = "auto",
+    chunks: dict[str, int] | None = None,
+    layout: str = "wide",
+) -> pd.DataFrame | None:
+    """ Interpolate the data file of an index entry at its query points. Returns None if a file is missing. """
+    blocks = extract_entry_blocks(entry, landing_folder, interpolation, engine, chunks, layout)
+    if blocks is None:
+        return None
+    return pd.concat(blocks, ignore_index=True)
+
+
+def load_entry_files(entry: dict, landing_folder: Path) -> tuple[Query, Path] | None:
+    """ Load the query of an index entry and locate its data file. Returns None if a file is missing. """
+    query_path = landing_folder / entry['query_file']
+    if not query_path.exists():
+        logger.error(f"Query file {query_path} does not exist. Skipping entry {entry['entry_id']}.")
+        return None
+    query = Query.from_json(query_path)
+    logger.debug(f"Loaded query {query.id} from {query_path}.")
+
+    data_path = landing_folder / entry['data_file']
+    if not data_path.exists():
+        logger.error(f"Data file {data_path} does not exist. Skipping entry {entry['entry_id']}.")
+        return None
+    return query, data_path
+
+
+def extract_entry_blocks(
+    entry: dict,
+    landing_folder: Path,
+    interpolation: str = "linear",
+    engine: str = "auto",
+    chunks: dict[str, int] | None = None,
+    layout: str = "wide",
+) -> Iterator[pd.DataFrame] | None:
+    """
+    Like `extract_entry`, but yield the rows in blocks. With `chunks`, files opened with xarray
+    are read lazily with Dask and one block is computed per chunk of the first chunked dimension,
+    so memory is bounded by a chunk rather than by the file.
+    """
+    with timer.stage("open"):
+        files = load_entry_files(entry, landing_folder)
+    if files is None:
+        return None
+    query, data_path = files
+
+    points = entry_point_indexes(entry, query)
+    if not len(points):
+        logger.warning(f"No query point inside the area {entry['area']} of entry {entry['entry_id']}. Skipping entry.")
+        return None
+
+    lats, lons = np.array(query.points.lats)[points], np.array(query.points.lons)[points]
+    if engine != "xarray" and str(entry.get("format", "")).startswith("grib"):
+        blocks = iter([read_grib_points(data_path, lats, lons, method=interpolation, layout=layout)])
+    else:
+        blocks = _open_and_interpolate(data_path, lats, lons, interpolation, chunks, layout)
+    return _with_metadata(blocks, entry, query, points)
+
+
+def _with_metadata(blocks: Iterator[pd.DataFrame], entry: dict, query: Query, points: np.ndarray) -> Iterator[pd.DataFrame]:
+    """
+    Keep the rows of each block within the query time range and add the entry metadata. The
+    names of the variables extracted are recorded in the entry (`data_variables`).
+    """
+    start, end = query_time_bounds(query)
+    for block in blocks:
+        entry["data_variables"] = ",".join(block.attrs.get("variables", []))
+        with timer.stage("metadata"):
+            in_range = (block["time"] >= start) & (block["time"] <= end)
+            block = _add_metadata(block if in_range.all() else block[in_range], entry, points)
+        yield block
+
+
+def query_time_bounds(query: Query) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    Naive UTC bounds of the query time range, to keep only the issues of a file that belong to
+    the query (a file retrieved for merged queries may cover more dates than each of them).
+    """
+    bounds = []
+    for dt in (query.time_range.start, query.time_range.end):
+        ts = pd.Timestamp(dt)
+        bounds.append(ts.tz_convert("UTC").tz_localize(None) if ts.tzinfo else ts)
+    return bounds[0], bounds[1]
+
+
+def entry_point_indexes(entry: dict, query: Query) -> np.ndarray:
+    """
+    Indexes of the query points an entry was retrieved for (see `covered_points`): the points
+    recorded for a group of coalesced points, else the points inside its area. Entries without
+    an area cover every point.
+    """
+    return np.array(covered_points(query.points, entry.get("area"), entry.get("area_points")), dtype=int)
+
+
+def _open_and_interpolate(
+    data_path: Path,
+    lats: np.ndarray,
+    lons: np.ndarray,
+    interpolation: str,
+    chunks: dict[str, int] | None,
+    layout: str = "wide",
+) -> Iterator[pd.DataFrame]:
+    with timer.stage("open"):
+        data = xr.open_dataset(data_path, chunks=chunks)
+    with data:
+        logger.debug(f"Opened data file {data_path} with variables: {list(data.data_vars)}.")
+        with timer.stage("interpolate"):
+            data_interpolated = interpolate(data, lats, lons, method=interpolation)
+            block_dim = next((d for d in (chunks or {}) if d in data_interpolated.chunksizes), None)
+            if block_dim is None:
+                data_interpolated = data_interpolated.compute()
+
+        if block_dim is None:
+            with timer.stage("dataframe"):
+                block = dataset_to_frame(data_interpolated, layout)
+            yield block
+            return
+
+        start = 0
+        for size in data_interpolated.chunksizes[block_dim]:
+            with timer.stage("interpolate"):
+                block = data_interpolated.isel({block_dim: slice(start, start + size)}).compute()
+            start += size
+            logger.debug(f"Interpolated {block_dim} block {start}/{data_interpolated.sizes[block_dim]} of {data_path}.")
+            with timer.stage("dataframe"):
+                block = dataset_to_frame(block, layout)
+            yield block
+
+
+def _add_metadata(df: pd.DataFrame, entry: dict, points: np.ndarray) -> pd.DataFrame:
+    """
+    Key the rows by the index row of the entry, whose metadata is written once to the entry table
+    of the staging output (see `StagingWriter`), and store the variables as float32.
+    """
+    df = df.copy(deep=False)
+    df["points"] = points[df["points"].to_numpy()].astype(np.int32)  # back to the index of the point in the query
+    values = [c for c in df.columns if df[c].dtype == np.float64 and c not in COORDINATE_COLUMNS]
+    df[values] = df[values].astype(np.float32)
+    df.insert(0, "entry_key", np.int32(entry["rowid"]))
+    return df
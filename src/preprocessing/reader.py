@@ -0,0 +1,296 @@
+from __future__ import annotations
+from pathlib import Path
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from . import logger
+from .staging import CsvStagingWriter, get_staging_writer
+from ..setup import PipelineConfig
+
+
+# Rows of a CSV staging file read at once
+CSV_CHUNK_ROWS = 1_000_000
+
+# Columns of the rows that are not variables, in the wide layout
+COORDINATE_COLUMNS = ["latitude", "longitude"]
+
+# Keys of the latest-issue view besides the valid time: entry table columns, then row columns when present
+LATEST_ENTRY_KEYS = ["query_id", "model", "level"]
+LATEST_KEYS = ["points", "latitude", "longitude", "number", "variable"]
+
+
+def _timestamp(value: str | datetime | None) -> pd.Timestamp | None:
+    """ Naive UTC timestamp, like the times of the staging rows. """
+    if value is None:
+        return None
+    ts = pd.Timestamp(value)
+    return ts.tz_convert("UTC").tz_localize(None) if ts.tzinfo else ts
+
+
+@dataclass
+class StagingFilter:
+    """
+    Row filters of `read_staging`. `start` and `end` bound the valid time, `max_lead` the step and
+    `as_of` the issue time (only the forecasts available at that time). Filters left to None are
+    not applied.
+    """
+
+    start: pd.Timestamp | None = None
+    end: pd.Timestamp | None = None
+    max_lead: pd.Timedelta | None = None
+    as_of: pd.Timestamp | None = None
+    points: list[int] | None = None
+    entry_keys: list[int] | None = None
+    variables: list[str] | None = None
+    model: str | None = None
+
+    def issue_bounds(self) -> tuple[pd.Timestamp | None, pd.Timestamp | None]:
+        """ Bounds of the issue times that can hold matching rows (steps are never negative). """
+        lower = self.start - self.max_lead if self.start is not None and self.max_lead is not None else None
+        upper = min((t for t in (self.end, self.as_of) if t is not None), default=None)
+        return lower, upper
+
+    def expression(self, schema: pa.Schema) -> ds.Expression | None:
+        """ Filter of a partitioned Parquet dataset, pushed down to the partitions and row groups. """
+        names = schema.names
+        lower, upper = self.issue_bounds()
+        parts = []
+        if self.model is not None and "model" in names:
+            parts.append(ds.field("model") == self.model)
+        # the partition of an entry is the month of its first issue, later ones can be in the next months
+        if lower is not None:
+            parts.append(ds.field("time") >= lower.to_pydatetime())
+        if upper is not None:
+            parts += [ds.field("issued_month") <= f"{upper:%Y-%m}", ds.field("time") <= upper.to_pydatetime()]
+        valid_time = ds.field("valid_time") if "valid_time" in names else pc.add(ds.field("time"), ds.field("step"))
+        if self.start is not None:
+            parts.append(valid_time >= self.start.to_pydatetime())
+        if self.end is not None:
+            parts.append(valid_time <= self.end.to_pydatetime())
+        if self.max_lead is not None:
+            parts.append(ds.field("step") <= pa.scalar(self.max_lead.to_pytimedelta(), pa.duration("s")))
+        if self.points is not None:
+            parts.append(ds.field("points").isin(self.points))
+        if self.entry_keys is not None:
+            parts.append(ds.field("entry_key").isin(self.entry_keys))
+        if self.variables is not None and "variable" in names:
+            parts.append(ds.field("variable").isin(self.variables))
+        if not parts:
+            return None
+        expression = parts[0]
+        for part in parts[1:]:
+            expression = expression & part
+        return expression
+
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        """ Same filter on rows read in memory (CSV staging). """
+        mask = np.ones(len(df), dtype=bool)
+        lower, upper = self.issue_bounds()
+        if lower is not None:
+            mask &= (df["time"] >= lower).to_numpy()
+        if upper is not None:
+            mask &= (df["time"] <= upper).to_numpy()
+        if self.start is not None:
+            mask &= (df["valid_time"] >= self.start).to_numpy()
+        if self.end is not None:
+            mask &= (df["valid_time"] <= self.end).to_numpy()
+        if self.max_lead is not None:
+            mask &= (df["step"] <= self.max_lead).to_numpy()
+        if self.points is not None:
+            mask &= df["points"].isin(self.points).to_numpy()
+        if self.entry_keys is not None:
+            mask &= df["entry_key"].isin(self.entry_keys).to_numpy()
+        if self.variables is not None and "variable" in df.columns:
+            mask &= df["variable"].isin(self.variables).to_numpy()
+        return mask
+
+    def columns(self, names: list[str], float_columns: list[str]) -> list[str]:
+        """ Columns to read: all of them but the variables not requested, in the wide layout. """
+        if self.variables is None or "variable" in names:
+            return names
+        return [c for c in names if c not in float_columns or c in COORDINATE_COLUMNS or c in self.variables]
+
+
+def read_staging(
+    staging_path: Path | str,
+    start: str | datetime | None = None,
+    end: str | datetime | None = None,
+    max_lead_hours: float | None = None,
+    as_of: str | datetime | None = None,
+    points: list[int] | None = None,
+    query_id: str | None = None,
+    model: str | None = None,
+    variables: list[str] | None = None,
+    latest: bool = False,
+    with_entries: bool = False,
+) -> pd.DataFrame:
+    """
+    Read the forecasts of a staging output, with their `valid_time`.
+
+    `start` and `end` bound the valid time and `max_lead_hours` the lead time (step). `as_of` only
+    keeps the issues available at that time (issue time not after it), e.g. to backtest. `points`
+    are indexes of the query points, usually combined with `query_id`. Times are naive UTC.
+
+    On a Parquet staging, the filters are pushed down: the `model` and `issued_month` partitions
+    and the row group statistics of the entry files skip what cannot match, so only the matching
+    files are read. A CSV staging is filtered chunk by chunk.
+
+    With `latest`, only the most recent issue of each valid time, point (and member, variable)
+    is kept (see `latest_issue`). With `with_entries`, the metadata of the entry table is joined
+    on `entry_key`.
+    """
+    writer = get_staging_writer(staging_path)
+    entries = writer.read_entries()
+
+    entry_keys = None
+    if query_id is not None or model is not None:
+        selected = np.ones(len(entries), dtype=bool)
+        if query_id is not None:
+            selected &= (entries["query_id"] == query_id).to_numpy()
+        if model is not None:
+            selected &= (entries["model"] == model).to_numpy()
+        entry_keys = entries.index[selected].tolist()
+
+    filters = StagingFilter(
+        start=_timestamp(start),
+        end=_timestamp(end),
+        max_lead=pd.Timedelta(hours=max_lead_hours) if max_lead_hours is not None else None,
+        as_of=_timestamp(as_of),
+        points=points,
+        entry_keys=entry_keys,
+        variables=variables,
+        model=model,
+    )
+    if isinstance(writer, CsvStagingWriter):
+        df = _read_csv(writer.path, filters)
+    else:
+        df = _read_parquet(writer.path, filters)
+    logger.info(f"Read {len(df)} rows from staging {writer.path}.")
+
+    if latest:
+        df = latest_issue(df, entries)
+        logger.info(f"Kept {len(df)} rows of the latest issues.")
+    if with_entries:
+        df = df.join(entries, on="entry_key", rsuffix="_entry")
+    return df
+
+
+def _read_parquet(path: Path, filters: StagingFilter) -> pd.DataFrame:
+    if not path.exists():
+        logger.error(f"Staging dataset {path} does not exist.")
+        raise FileNotFoundError(f"Staging dataset {path} does not exist.")
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    expression = filters.expression(dataset.schema)
+
+    # entries may hold different variables or integer widths: read with the schema of the files that can match
+    fragments = list(dataset.get_fragments(filter=expression))
+    if not fragments:
+        return dataset.schema.empty_table().to_pandas()
+    schemas = [dataset.schema] + [fragment.physical_schema for fragment in fragments]
+    schema = pa.unify_schemas(schemas, promote_options="permissive")
+    dataset = ds.dataset([fragment.path for fragment in fragments], schema=schema, format="parquet",
+                         partitioning="hive", partition_base_dir=str(path))
+
+    float_columns = [f.name for f in schema if pa.types.is_floating(f.type)]
+    table = dataset.to_table(columns=filters.columns(schema.names, float_columns), filter=expression)
+    df = table.to_pandas()
+    if "valid_time" not in df.columns:
+        df["valid_time"] = df["time"] + df["step"]
+    return df
+
+
+def _read_csv(path: Path, filters: StagingFilter) -> pd.DataFrame:
+    if not path.exists():
+        logger.error(f"Staging file {path} does not exist.")
+        raise FileNotFoundError(f"Staging file {path} does not exist.")
+    names = pd.read_csv(path, nrows=0).columns.tolist()
+    dtypes = {"variable": "category"} if "variable" in names else {}
+    blocks = []
+    for block in pd.read_csv(path, chunksize=CSV_CHUNK_ROWS, dtype=dtypes, parse_dates=["time"]):
+        block["step"] = pd.to_timedelta(block["step"])
+        block["valid_time"] = pd.to_datetime(block["valid_time"]) if "valid_time" in names else block["time"] + block["step"]
+        block = block[filters.mask(block)]
+        float_columns = [c for c in block.columns if pd.api.types.is_float_dtype(block[c])]
+        blocks.append(block[filters.columns(block.columns.tolist(), float_columns)])
+    if not blocks:
+        return pd.DataFrame(columns=names)
+    df = pd.concat(blocks, ignore_index=True)
+    if "variable" in df.columns:
+        df["variable"] = df["variable"].astype("category")
+    return df
+
+
+def latest_issue(df: pd.DataFrame, entries: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Keep the most recent issue (`time`) of each valid time and point, member and variable, within
+    each query, model and level of the `entries` table (joined on `entry_key`), so that e.g. the
+    HRES rows and the ENS control member (both `number` 0) are kept apart. The rows are sorted
+    once on these keys and the issue time (`np.lexsort`), and the last row of each run of equal
+    keys is kept, without grouping. Missing values (e.g. `number` of entries without members)
+    compare equal. The result is sorted by query, model, level, point and valid time.
+    """
+    if df.empty:
+        return df
+    arrays = []
+    if entries is not None and "entry_key" in df.columns:
+        for c in LATEST_ENTRY_KEYS:
+            codes = entries[c].astype("category").cat.codes
+            arrays.append(codes.reindex(df["entry_key"].to_numpy(), fill_value=-1).to_numpy())
+    for c in [c for c in LATEST_KEYS if c in df.columns] + ["valid_time"]:
+        arrays.append(df[c].cat.codes.to_numpy() if isinstance(df[c].dtype, pd.CategoricalDtype) else df[c].to_numpy())
+
+    order = np.lexsort([df["time"].to_numpy(), *arrays[::-1]])
+    last = np.zeros(len(order), dtype=bool)
+    last[-1] = True
+    for array in arrays:
+        array = array[order]
+        changed = array[1:] != array[:-1]
+        if array.dtype.kind == "f":
+            changed &= ~(np.isnan(array[1:]) & np.isnan(array[:-1]))
+        last[:-1] |= changed
+    return df.iloc[order[last]].reset_index(drop=True)
+
+
+def run_read(
+    config: PipelineConfig,
+    start: str | None = None,
+    end: str | None = None,
+    max_lead_hours: float | None = None,
+    as_of: str | None = None,
+    points: list[int] | None = None,
+    query_id: str | None = None,
+    model: str | None = None,
+    variables: list[str] | None = None,
+    latest: bool = False,
+    with_entries: bool = False,
+    output_path: str | None = None,
+    **kwargs
+) -> pd.DataFrame:
+    """ Read the staging output with `read_staging` and write the rows to `output_path` (.csv or .parquet) or log a summary of them. """
+    if output_path is not None and Path(output_path).suffix not in (".csv", ".parquet"):
+        logger.error(f"Output path {output_path} must be a .csv or .parquet file.")
+        raise ValueError(f"Output path {output_path} must be a .csv or .parquet file.")
+
+    df = read_staging(
+        config.staging_path, start=start, end=end, max_lead_hours=max_lead_hours, as_of=as_of, points=points,
+        query_id=query_id, model=model, variables=variables, latest=latest, with_entries=with_entries,
+    )
+    if output_path is None:
+        logger.info(f"Read {len(df)} rows, first rows:\n{df.head().to_string()}")
+        logger.info("Use --output-path to write all the rows to a .csv or .parquet file.")
+        return df
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if output_path.suffix == ".csv":
+        df.to_csv(output_path, index=False)
+    else:
+        df.to_parquet(output_path, index=False)
+    logger.info(f"Wrote {len(df)} rows to {output_path}.")
+    return df
@@ -0,0 +1,314 @@
+from __future__ import annotations
+import os
+import json
+import math
+import shutil
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass, field, asdict
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from . import logger
+from .staging import StagingWriter, ParquetStagingWriter
+from .reader import COORDINATE_COLUMNS, StagingFilter, _read_csv, _timestamp
+
+
+HOUR = np.timedelta64(1, "h")
+
+
+def _hours(times: np.ndarray) -> np.ndarray:
+    """ Hours since the epoch of datetime64 values. """
+    return times.astype("datetime64[h]").astype(np.int64)
+
+
+def _hour(value: str | datetime) -> int:
+    return int(_hours(np.array([_timestamp(value)], dtype="datetime64[ns]"))[0])
+
+
+@dataclass
+class SeriesLayout:
+    """
+    Axes of the arrays of a series cache, saved in its `layout.json`.
+
+    Issue times are `first_issue + i * issue_hours` for i < `n_issues` and steps `s * step_hours`
+    for s < `n_steps`, so the offset of an issue time and step is computed rather than searched.
+    The arrays are allocated for `capacity` issues, doubled when full, and are in the folder of
+    their `generation`, a new one for each resize.
+    """
+
+    first_issue: int = 0  # hours since the epoch
+    issue_hours: int = 0
+    n_issues: int = 0
+    capacity: int = 0
+    step_hours: int = 0
+    n_steps: int = 0
+    members: list[int] = field(default_factory=list)
+    n_points: int = 0
+    variables: list[str] = field(default_factory=list)
+    generation: int = 0
+
+    @property
+    def shape(self) -> tuple[int, int, int, int]:
+        return self.n_points, self.capacity, self.n_steps, len(self.members)
+
+    def same_arrays(self, other: SeriesLayout) -> bool:
+        """ Whether the arrays of both layouts have the same shape and axes (the number of issues used may differ). """
+        axes = ["first_issue", "issue_hours", "capacity", "step_hours", "n_steps", "members", "n_points"]
+        return all(getattr(self, a) == getattr(other, a) for a in axes)
+
+    def merged(self, issues: np.ndarray, steps: np.ndarray, members: np.ndarray, n_points: int) -> SeriesLayout:
+        """ Smallest layout holding this one and the given issue hours, step hours, members and points. """
+        old_issues = [self.first_issue, self.first_issue + self.issue_hours * (self.n_issues - 1)] if self.n_issues else []
+        all_issues = np.concatenate([issues, old_issues]).astype(np.int64)
+        first, last = int(all_issues.min()), int(all_issues.max())
+        issue_hours = math.gcd(self.issue_hours, *(all_issues - first).tolist()) or self.issue_hours or 24
+        all_steps = np.concatenate([steps, [self.step_hours * (self.n_steps - 1)] if self.n_steps else []]).astype(np.int64)
+        step_hours = math.gcd(self.step_hours, *all_steps.tolist()) or self.step_hours or 1
+        n_issues = (last - first) // issue_hours + 1
+        return SeriesLayout(
+            first_issue=first,
+            issue_hours=issue_hours,
+            n_issues=n_issues,
+            capacity=self.capacity if n_issues <= self.capacity and issue_hours == self.issue_hours else max(n_issues, 2 * self.capacity),
+            step_hours=step_hours,
+            n_steps=int(all_steps.max()) // step_hours + 1,
+            members=sorted(set(self.members) | set(members.tolist())),
+            n_points=max(self.n_points, n_points),
+            variables=list(self.variables),
+            generation=self.generation,
+        )
+
+
+def _variable_blocks(df: pd.DataFrame, variables: list[str] | None = None) -> Iterator[tuple[pd.DataFrame, dict[str, np.ndarray]]]:
+    """
+    Rows and values of each variable: every variable column at once in the wide layout, one block
+    per variable in the long one. The variable columns are the `variables` extracted from the
+    entry (`data_variables` of the entry table), or the float columns besides the coordinates.
+    """
+    if "variable" in df.columns:
+        for name, rows in df.groupby("variable", observed=True):
+            yield rows, {name: rows["value"].to_numpy()}
+        return
+    if variables is None:
+        variables = [
+            c for c in df.columns
+            if pd.api.types.is_float_dtype(df[c]) and c not in COORDINATE_COLUMNS and c != "number"
+        ]
+    yield df, {c: df[c].to_numpy() for c in variables if c in df.columns}
+
+
+class SeriesCache:
+    """
+    Memory-mapped forecast series of the points of a query, model and level, one `.npy` array per
+    variable with dimensions (points, issues, steps, members):
+
+        <path>/layout.json
+        <path>/<generation>/<variable>.npy
+
+    The series of a point are contiguous, so a window of issues of a point and variable is a view
+    of the memory-mapped file (`series`), read without parsing nor copy. Missing values are NaN.
+
+    Resized arrays are written to the folder of a new generation, swapped in by the atomic
+    replacement of `layout.json`, so an interrupted resize leaves the previous arrays and layout
+    in use and never arrays whose axes do not match the layout.
+    """
+
+    layout_name = "layout.json"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.layout = SeriesLayout()
+        if self.layout_path.exists():
+            with self.layout_path.open("r") as f:
+                self.layout = SeriesLayout(**json.load(f))
+        self._arrays: dict[str, np.memmap] = {}
+
+    @property
+    def layout_path(self) -> Path:
+        return self.path / self.layout_name
+
+    @property
+    def variables(self) -> list[str]:
+        return self.layout.variables
+
+    @property
+    def issues(self) -> np.ndarray:
+        """ Issue times of the cache (datetime64). """
+        layout = self.layout
+        hours = layout.first_issue + layout.issue_hours * np.arange(layout.n_issues)
+        return hours.astype("datetime64[h]")
+
+    @property
+    def steps(self) -> np.ndarray:
+        """ Steps of the cache (timedelta64). """
+        return self.layout.step_hours * np.arange(self.layout.n_steps) * HOUR
+
+    @property
+    def members(self) -> list[int]:
+        return self.layout.members
+
+    def array(self, variable: str) -> np.memmap:
+        """ Read-only memory map of the (points, issues, steps, members) array of a variable. """
+        if variable not in self._arrays:
+            if variable not in self.layout.variables:
+                logger.error(f"Variable {variable} is not in the series cache {self.path}. Available: {self.layout.variables}.")
+                raise KeyError(f"Variable {variable} is not in the series cache {self.path}.")
+            self._arrays[variable] = np.load(self._array_path(variable), mmap_mode="r")
+        return self._arrays[variable]
+
+    def issue_slice(self, start: str | datetime | None = None, end: str | datetime | None = None) -> slice:
+        """ Offsets of the issue times between `start` and `end` (included). """
+        layout = self.layout
+        i0, i1 = 0, layout.n_issues
+        if start is not None:
+            i0 = max(i0, -((layout.first_issue - _hour(start)) // layout.issue_hours))  # rounded up
+        if end is not None:
+            i1 = min(i1, (_hour(end) - layout.first_issue) // layout.issue_hours + 1)
+        return slice(i0, max(i0, i1))
+
+    def series(
+        self,
+        variable: str,
+        point: int,
+        start: str | datetime | None = None,
+        end: str | datetime | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Issue times and values of a point and variable for the issues between `start` and `end`:
+        an array of dimensions (issues, steps, members) that is a view of the memory-mapped file.
+        """
+        window = self.issue_slice(start, end)
+        return self.issues[window], self.array(variable)[point, window]
+
+    def write(self, df: pd.DataFrame, variables: list[str] | None = None) -> None:
+        """ Write staging rows (wide or long layout) to the arrays, growing them if needed (see `_variable_blocks`). """
+        layout = self.layout.merged(
+            np.unique(_hours(df["time"].to_numpy())),
+            np.unique(df["step"].to_numpy() // HOUR),
+            np.unique(df["number"].to_numpy()) if "number" in df.columns else np.zeros(1, dtype=np.int64),
+            int(df["points"].max()) + 1,
+        )
+        if not layout.same_arrays(self.layout):
+            self._resize(layout)
+        self.layout.n_issues = layout.n_issues
+
+        for rows, values in _variable_blocks(df, variables):
+            offsets = self._offsets(rows)
+            for variable, variable_values in values.items():
+                array = self._writable(variable)
+                array[offsets] = variable_values
+                array.flush()
+        self._save_layout()
+
+    def _offsets(self, rows: pd.DataFrame) -> tuple[np.ndarray, ...]:
+        """ Offsets of the rows in the (points, issues, steps, members) arrays. """
+        layout = self.layout
+        issues = (_hours(rows["time"].to_numpy()) - layout.first_issue) // layout.issue_hours
+        steps = (rows["step"].to_numpy() // HOUR).astype(np.int64) // layout.step_hours
+        numbers = rows["number"].to_numpy() if "number" in rows.columns else np.zeros(len(rows), dtype=np.int64)
+        return rows["points"].to_numpy(), issues, steps, np.searchsorted(layout.members, numbers)
+
+    def _generation_path(self, generation: int) -> Path:
+        return self.path / str(generation)
+
+    def _array_path(self, variable: str, generation: int | None = None) -> Path:
+        return self._generation_path(self.layout.generation if generation is None else generation) / f"{variable}.npy"
+
+    def _writable(self, variable: str) -> np.memmap:
+        self._arrays.pop(variable, None)
+        if variable not in self.layout.variables:
+            self._array_path(variable).parent.mkdir(parents=True, exist_ok=True)
+            array = np.lib.format.open_memmap(self._array_path(variable), mode="w+", dtype=np.float32, shape=self.layout.shape)
+            array[:] = np.nan
+            self.layout.variables.append(variable)
+            return array
+        return np.load(self._array_path(variable), mmap_mode="r+")
+
+    def _resize(self, layout: SeriesLayout) -> None:
+        """
+        Copy every array to the new layout (new points, members, steps or issues beyond the
+        capacity) in the folder of a new generation, then switch to it and remove the previous one.
+        """
+        old = self.layout
+        layout.generation = old.generation + 1
+        logger.debug(f"Resizing series cache {self.path} from {old.shape} to {layout.shape} (generation {layout.generation}).")
+        issue_map = (old.first_issue + old.issue_hours * np.arange(old.n_issues) - layout.first_issue) // layout.issue_hours
+        step_map = old.step_hours * np.arange(old.n_steps) // layout.step_hours
+        member_map = np.searchsorted(layout.members, old.members)
+        self._arrays.clear()
+
+        folder = self._generation_path(layout.generation)
+        shutil.rmtree(folder, ignore_errors=True)  # left by an interrupted resize
+        folder.mkdir(parents=True)
+        for variable in old.variables:
+            array = np.lib.format.open_memmap(
+                self._array_path(variable, layout.generation), mode="w+", dtype=np.float32, shape=layout.shape
+            )
+            array[:] = np.nan
+            if old.n_issues:
+                previous = np.load(self._array_path(variable, old.generation), mmap_mode="r")
+                array[np.ix_(np.arange(old.n_points), issue_map, step_map, member_map)] = previous[:, :old.n_issues]
+                del previous
+            array.flush()
+            del array
+
+        self.layout = layout
+        self._save_layout()
+        shutil.rmtree(self._generation_path(old.generation), ignore_errors=True)
+
+    def _save_layout(self) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path / f".{self.layout_name}.tmp"
+        with tmp_path.open("w") as f:
+            json.dump(asdict(self.layout), f)
+        os.replace(tmp_path, self.layout_path)
+
+
+def _entry_rows(writer: StagingWriter, entries: pd.DataFrame) -> Iterator[tuple[int, pd.DataFrame]]:
+    """ Rows of the given entries of the entry table: from their own file in a Parquet staging, in one pass over a CSV one. """
+    if isinstance(writer, ParquetStagingWriter):
+        for entry_key, entry in entries.iterrows():
+            file_path = writer.partition(entry) / f"{entry['entry_id']}.parquet"
+            if file_path.exists():
+                yield entry_key, pd.read_parquet(file_path)
+        return
+    rows = _read_csv(writer.path, StagingFilter(entry_keys=entries.index.tolist()))
+    for entry_key, group in rows.groupby("entry_key"):
+        yield entry_key, group
+
+
+def update_series_cache(writer: StagingWriter) -> int:
+    """
+    Write the entries of the staging output not yet in its series cache (`series_path`), one
+    `SeriesCache` per query, model and level. Cached entries are listed in `_entries.txt`.
+    Returns the number of entries added.
+    """
+    root = writer.series_path
+    cached_path = root / "_entries.txt"
+    cached = set()
+    if cached_path.exists():
+        with cached_path.open("r") as f:
+            cached = {int(line) for line in f if line.strip()}
+
+    entries = writer.read_entries()
+    entries = entries[~entries.index.isin(list(cached))]
+    if entries.empty:
+        return 0
+
+    root.mkdir(parents=True, exist_ok=True)
+    caches: dict[str, SeriesCache] = {}
+    n_entries = 0
+    for entry_key, rows in _entry_rows(writer, entries):
+        entry = entries.loc[entry_key]
+        name = f"{entry['query_id']}_{entry['model']}_{entry['level']}"
+        cache = caches.setdefault(name, SeriesCache(root / name))
+        data_variables = entry.get("data_variables")
+        cache.write(rows, data_variables.split(",") if isinstance(data_variables, str) and data_variables else None)
+        with cached_path.open("a") as f:
+            f.write(f"{entry_key}\n")
+        n_entries += 1
+    logger.info(f"Added {n_entries} entries to the series cache {root}.")
+    return n_entries
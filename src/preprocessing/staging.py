@@ -0,0 +1,366 @@
+from __future__ import annotations
+import os
+import json
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from typing import Iterable
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import logger
+from ..utils.profiling import timer
+from ..index import RetrievalIndex
+
+
+# Columns of the entry table, keyed by the row of the entry in the landing index
+ENTRY_COLUMNS = [
+    "entry_key",
+    "entry_id",
+    "query_id",
+    "retrieval_id",
+    "model",
+    "level",
+    "issued",
+    "lookback_hours",
+    "step_granularity",
+    "variables",
+    "data_variables",
+    "timestamp",
+]
+CATEGORICAL_ENTRY_COLUMNS = ["query_id", "retrieval_id", "model", "level", "issued", "variables", "data_variables"]
+
+
+@dataclass
+class StagingState:
+    """
+    Progress of the preprocessing through the landing index, saved with the staging output so
+    that an incremental run only reads the index rows appended since the last one.
+
+    Every index row up to `index_rowid` is in staging, except the rows in `retry` (missing files
+    or no query point, tried again on each run). Rows after `index_rowid` already in staging,
+    e.g. completed out of order by the workers, are in `processed`. `layout` is the layout of
+    the rows (see `frame_from_arrays`). `sizes` are the sizes in bytes of the files appended to
+    for each entry (see `StagingWriter.appended_paths`) when the state was saved.
+    """
+
+    index_rowid: int = 0
+    retry: list[int] = field(default_factory=list)
+    processed: list[int] = field(default_factory=list)
+    layout: str = "wide"
+    sizes: dict[str, int] = field(default_factory=dict)
+
+    def entries(self, index: RetrievalIndex) -> list[dict]:
+        """ Index rows left to preprocess: the rows to retry and the rows appended after `index_rowid`. """
+        skipped = set(self.retry) | set(self.processed)
+        retried = [row for rowid in self.retry for row in index.find(rowid=rowid)]
+        return retried + [row for row in index.rows_since(self.index_rowid) if row["rowid"] not in skipped]
+
+    def record(self, rowid: int, processed: bool) -> None:
+        """ Record the outcome of an index row: in staging, or to retry on the next run. """
+        if processed:
+            self.retry = [r for r in self.retry if r != rowid]
+            if rowid > self.index_rowid and rowid not in self.processed:
+                self.processed.append(rowid)
+        elif rowid not in self.retry:
+            self.retry.append(rowid)
+
+    def advance(self, pending: set[int], last_rowid: int) -> None:
+        """ Move `index_rowid` up to the first `pending` row of the run, or to `last_rowid` when none is left. """
+        pending = [r for r in pending if r > self.index_rowid]
+        self.index_rowid = max(self.index_rowid, min(pending) - 1 if pending else last_rowid)
+        self.processed = sorted(r for r in self.processed if r > self.index_rowid)
+
+
+class StagingWriter(ABC):
+    """
+    Base class of the staging outputs, written one index entry at a time.
+
+    Rows only hold an integer `entry_key` (the row of the entry in the landing index) besides
+    the data. The metadata of each entry (`ENTRY_COLUMNS`) is stored once in the entry table
+    `entries_path`, appended to by `mark_processed` once the rows of the entry are in place,
+    and read back with `read_entries`. Writers with `parallel_writes` can be used from several
+    processes at once, as long as a single process marks the entries as processed.
+
+    The position of the preprocessing in the index (`StagingState`) is saved in `state_path`,
+    with the sizes of the files appended to for each entry (`appended_paths`), so that the rows of
+    an entry interrupted before the state was saved can be dropped by `rollback`.
+    """
+
+    parallel_writes: bool = False
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @property
+    @abstractmethod
+    def entries_path(self) -> Path:
+        ...
+
+    @property
+    @abstractmethod
+    def state_path(self) -> Path:
+        ...
+
+    @property
+    @abstractmethod
+    def series_path(self) -> Path:
+        """ Folder of the memory-mapped series cache (see `SeriesCache`). """
+
+    @property
+    def appended_paths(self) -> list[Path]:
+        """ Files appended to for each entry. """
+        return [self.entries_path]
+
+    @abstractmethod
+    def columns(self) -> list[str] | None:
+        """ Columns of the rows already written, or None if there are none. """
+
+    def check_layout(self, layout: str | None = None) -> None:
+        """
+        Raise if the staging output was written with the metadata on every row (before the entry
+        table), or if its rows are not in `layout` (`wide`, or `long` with a `variable` column).
+        """
+        columns = self.columns()
+        if columns is None:
+            return
+        if "entry_id" in columns:
+            logger.error(f"Staging {self.path} holds the entry metadata on every row. Preprocess to a new staging path.")
+            raise ValueError(f"Staging {self.path} holds the entry metadata on every row. Preprocess to a new staging path.")
+        written = "long" if "variable" in columns else "wide"
+        if layout is not None and layout != written:
+            logger.error(f"Staging {self.path} is written in the '{written}' layout, not '{layout}'.")
+            raise ValueError(f"Staging {self.path} is written in the '{written}' layout, not '{layout}'.")
+
+    def processed_entries(self) -> set[str]:
+        """ Return the IDs of the index entries already written to staging. """
+        if not self.entries_path.exists():
+            return set()
+        return set(pd.read_csv(self.entries_path, usecols=["entry_id"], dtype=str)["entry_id"])
+
+    def read_entries(self) -> pd.DataFrame:
+        """ Return the entry table indexed by `entry_key`, with its string columns as categoricals. """
+        if not self.entries_path.exists():
+            return pd.DataFrame(columns=ENTRY_COLUMNS).set_index("entry_key")
+        entries = pd.read_csv(self.entries_path, dtype={c: "category" for c in CATEGORICAL_ENTRY_COLUMNS})
+        return entries.drop_duplicates("entry_key", keep="last").set_index("entry_key")
+
+    def load_state(self) -> StagingState | None:
+        """ Return the saved state, or None if there is none or the staging output it describes is gone. """
+        if not self.state_path.exists() or not self.entries_path.exists():
+            return None
+        with self.state_path.open("r") as f:
+            return StagingState(**json.load(f))
+
+    def rollback(self, state: StagingState) -> None:
+        """ Truncate the appended files to their sizes in the saved state, dropping what was appended after it. """
+        for path in self.appended_paths:
+            size = state.sizes.get(path.name)
+            if size is not None and path.exists() and path.stat().st_size > size:
+                logger.warning(f"Dropping {path.stat().st_size - size} bytes appended to {path} after the saved state (interrupted entry).")
+                with path.open("r+b") as f:
+                    f.truncate(size)
+
+    def save_state(self, state: StagingState) -> None:
+        """ Save the state with the current sizes of the appended files. """
+        state.sizes = {path.name: path.stat().st_size for path in self.appended_paths if path.exists()}
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(f".{self.state_path.name}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump(asdict(state), f)
+        os.replace(tmp_path, self.state_path)
+
+    @abstractmethod
+    def write(self, entry: dict, df: pd.DataFrame) -> None:
+        """ Write the rows extracted from one index entry. """
+
+    def write_blocks(self, entry: dict, blocks: Iterable[pd.DataFrame]) -> int:
+        """ Write the rows of one index entry given as successive blocks. Returns the number of rows. """
+        blocks = [block for block in blocks if len(block)]
+        if not blocks:
+            return 0
+        with timer.stage("concat"):
+            df = pd.concat(blocks, ignore_index=True)
+        self.write(entry, df)
+        return len(df)
+
+    def mark_processed(self, entry: dict) -> None:
+        """ Record an entry as processed in the entry table, once its rows are written. """
+        row = pd.DataFrame([{"entry_key": entry["rowid"], **{c: entry.get(c) for c in ENTRY_COLUMNS[1:]}}])
+        with self._lock:
+            self.entries_path.parent.mkdir(parents=True, exist_ok=True)
+            exists = self.entries_path.exists()
+            if exists:
+                # entry tables written before a column was added keep their header
+                with self.entries_path.open("r") as f:
+                    row = row.reindex(columns=f.readline().rstrip("\n").split(","))
+            row.to_csv(self.entries_path, mode="a", header=not exists, index=False)
+
+
+class CsvStagingWriter(StagingWriter):
+    """
+    Single CSV staging file, appended to for each entry once all its rows are extracted.
+
+    The columns are fixed by the first entry written: columns of later entries that are not
+    in the header are dropped, missing ones are left empty. The entry table is written next to
+    it in `<name>.entries.csv`, the state in `<name>.csv.state.json` and the series cache in
+    `<name>.series/`.
+    """
+
+    @property
+    def entries_path(self) -> Path:
+        return self.path.with_suffix(".entries.csv")
+
+    @property
+    def state_path(self) -> Path:
+        return self.path.with_name(f"{self.path.name}.state.json")
+
+    @property
+    def series_path(self) -> Path:
+        return self.path.with_suffix(".series")
+
+    @property
+    def appended_paths(self) -> list[Path]:
+        return [self.path, self.entries_path]
+
+    def columns(self) -> list[str] | None:
+        return self._header()
+
+    def _header(self) -> list[str] | None:
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            return None
+        with self.path.open("r") as f:
+            return f.readline().rstrip("\n").split(",")
+
+    def write(self, entry: dict, df: pd.DataFrame) -> None:
+        self.write_blocks(entry, [df])
+
+    def write_blocks(self, entry: dict, blocks: Iterable[pd.DataFrame]) -> int:
+        """
+        Stream the blocks of an entry to a temporary file, appended to the staging file once the
+        entry is complete, so that an entry failing or interrupted midway leaves no rows in it.
+        """
+        tmp_path = self.path.with_name(f".{self.path.name}.{entry['entry_id']}.tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        n_rows, columns = 0, self._header()
+        try:
+            with tmp_path.open("w") as f:
+                for block in blocks:
+                    if not len(block):
+                        continue
+                    with timer.stage("write"):
+                        if columns is None:
+                            columns = block.columns.tolist()
+                        dropped = [c for c in block.columns if c not in columns]
+                        if dropped:
+                            logger.warning(f"Columns {dropped} of entry {entry['entry_id']} are not in the staging header and are dropped.")
+                        block.reindex(columns=columns).to_csv(f, header=False, index=False)
+                    n_rows += len(block)
+            if n_rows:
+                with self._lock, timer.stage("write"):
+                    if self._header() is None:
+                        pd.DataFrame(columns=columns).to_csv(self.path, index=False)
+                    with tmp_path.open("rb") as src, self.path.open("ab") as dst:
+                        shutil.copyfileobj(src, dst)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return n_rows
+
+
+class ParquetStagingWriter(StagingWriter):
+    """
+    Partitioned Parquet dataset, one file per entry:
+
+        <path>/model=<model>/issued_month=<YYYY-MM>/<entry_id>.parquet
+
+    The entry table (`_entries.csv`) also serves as the manifest of the processed entries, so
+    detecting new entries never reads the data files. The state is saved in `_state.json` and
+    the series cache in `_series/`.
+    """
+
+    entries_name = "_entries.csv"
+    legacy_manifest_name = "_entries.txt"
+    state_name = "_state.json"
+    series_name = "_series"
+    parallel_writes = True
+
+    @property
+    def entries_path(self) -> Path:
+        return self.path / self.entries_name
+
+    @property
+    def state_path(self) -> Path:
+        return self.path / self.state_name
+
+    @property
+    def series_path(self) -> Path:
+        return self.path / self.series_name
+
+    def columns(self) -> list[str] | None:
+        if (self.path / self.legacy_manifest_name).exists():
+            return ["entry_id"]  # the legacy manifest was only written with the metadata on every row
+        file_path = next(self.path.glob("model=*/issued_month=*/*.parquet"), None)
+        return None if file_path is None else pq.read_schema(file_path).names
+
+    def partition(self, entry: dict) -> Path:
+        issued_month = str(entry["issued"])[:7]
+        return self.path / f"model={entry['model']}" / f"issued_month={issued_month}"
+
+    def _paths(self, entry: dict) -> tuple[Path, Path]:
+        partition = self.partition(entry)
+        partition.mkdir(parents=True, exist_ok=True)
+        file_path = partition / f"{entry['entry_id']}.parquet"
+        tmp_path = partition / f".{entry['entry_id']}.parquet.tmp"  # hidden from dataset readers
+        return file_path, tmp_path
+
+    def write(self, entry: dict, df: pd.DataFrame) -> None:
+        file_path, tmp_path = self._paths(entry)
+        with timer.stage("write"):
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, file_path)
+        logger.debug(f"Entry {entry['entry_id']} written to {file_path}")
+
+    def write_blocks(self, entry: dict, blocks: Iterable[pd.DataFrame]) -> int:
+        """ Stream the blocks of an entry to its file as successive row groups. """
+        file_path, tmp_path = self._paths(entry)
+        n_rows, parquet_writer = 0, None
+        try:
+            for block in blocks:
+                if not len(block):
+                    continue
+                with timer.stage("write"):
+                    if parquet_writer is None:
+                        table = pa.Table.from_pandas(block, preserve_index=False)
+                        parquet_writer = pq.ParquetWriter(tmp_path, table.schema)
+                    else:
+                        table = pa.Table.from_pandas(block, schema=parquet_writer.schema, preserve_index=False)
+                    parquet_writer.write_table(table)
+                n_rows += len(block)
+        except BaseException:
+            if parquet_writer is not None:
+                parquet_writer.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        if parquet_writer is None:
+            return 0
+        with timer.stage("write"):
+            parquet_writer.close()
+            os.replace(tmp_path, file_path)
+        logger.debug(f"Entry {entry['entry_id']} streamed to {file_path} ({n_rows} rows)")
+        return n_rows
+
+
+def get_staging_writer(staging_path: Path) -> StagingWriter:
+    """ CSV staging if the staging path is a `.csv` file, partitioned Parquet dataset otherwise. """
+    staging_path = Path(staging_path)
+    if staging_path.suffix == ".csv":
+        return CsvStagingWriter(staging_path)
+    if staging_path.suffix:
+        logger.error(f"Staging path {staging_path} must be a .csv file or a folder.")
+        raise ValueError(f"Staging path {staging_path} must be a .csv file or a folder.")
+    return ParquetStagingWriter(staging_path)
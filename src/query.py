@@ -3,7 +3,7 @@ import json
 import hashlib
 from pathlib import Path
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 
@@ -56,18 +56,25 @@ class Query:
         path = Path(path)
         with path.open("r") as f:
             data = json.load(f)
+        return Query.from_dict(data)
 
+    @staticmethod
+    def from_dict(data: dict) -> Query:
         tr = TimeRange(
             start=datetime.fromisoformat(data["time_range"]["start"]),
             end=datetime.fromisoformat(data["time_range"]["end"])
         )
         pc = PointCloud.from_list(data["points"])
-        
+
+        if "members" in data:
+            members = [Query.from_dict(m) for m in data["members"]]
+            return QueryGroup(time_range=tr, points=pc, name=data.get("name", ""), members=members)
         return Query(time_range=tr, points=pc, name=data.get("name", ""))
 
     def to_dict(self) -> dict:
         return {
             "id": self.id,
+            "name": self.name,
             "time_range": {
                 "start": self.time_range.start.isoformat(),
                 "end": self.time_range.end.isoformat()
@@ -77,3 +84,30 @@ class Query:
 
     def __repr__(self) -> str:
         return f"Query(time_range=({self.time_range.start} to {self.time_range.end}), num_points={len(self.points.points)})"
+
+@dataclass(repr=False)
+class QueryGroup(Query):
+    """
+    Several queries retrieved together: the union of their points over a time range covering
+    theirs. Retrieved files are attributed back to the member queries they cover.
+    """
+    members: list[Query] = field(default_factory=list)
+
+    @classmethod
+    def merge(cls, queries: list[Query], time_range: TimeRange | None = None) -> QueryGroup:
+        points = []
+        for query in queries:
+            points.extend(p for p in query.points.points if p not in points)
+        time_range = time_range or TimeRange(
+            start=min(q.time_range.start for q in queries),
+            end=max(q.time_range.end for q in queries),
+        )
+        return cls(
+            time_range=time_range,
+            points=PointCloud(points),
+            name="+".join(q.name or q.id for q in queries),
+            members=list(queries),
+        )
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "members": [m.to_dict() for m in self.members]}
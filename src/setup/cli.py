@@ -23,6 +23,12 @@ def parse_args() -> argparse.Namespace:
         type=str,
         help="Path to the JSON file containing the list of time ranges and points"
     )
+    retrieval_parser.add_argument(
+        "--query-paths",
+        type=str,
+        nargs="+",
+        help="Paths to several query files, retrieved together with shared requests (overrides --query-path)"
+    )
     retrieval_parser.add_argument(
         "--landing-path",
         type=str,
@@ -49,12 +55,64 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Skip the actual data retrieval query (no save will occur)."
     )
+    retrieval_parser.add_argument(
+        "--plan",
+        action="store_true",
+        default=False,
+        help="Let the cost-aware planner choose the request boundaries (day chunks, spatial layout, variable groups) instead of 'batch_issue', and print the plan before executing."
+    )
+    retrieval_parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Retrieve every request again, even if an identical retrieval already exists in the index."
+    )
+    retrieval_parser.add_argument(
+        "--consolidate",
+        action="store_true",
+        default=False,
+        help="Append each retrieved file to the Zarr store of its query as soon as it is saved."
+    )
     retrieval_parser.add_argument(
         "--concurrent-jobs",
         type=int,
         default=1,
         help="Maximum number of simultaneous API requests to execute. Use >1 for parallel execution (e.g., 5). Default is 1 (sequential)."
     )
+    retrieval_parser.add_argument(
+        "--max-concurrent-jobs",
+        type=int,
+        help="Upper bound for the adaptive concurrency. Concurrency starts at --concurrent-jobs, is halved when MARS rejects requests and grows back up to this value while latency stays stable. Defaults to --concurrent-jobs."
+    )
+    retrieval_parser.add_argument(
+        "--max-submit-rate",
+        type=float,
+        help="Global rate limit, in requests started per minute."
+    )
+    retrieval_parser.add_argument(
+        "--recent-first",
+        action="store_true",
+        default=False,
+        help="Execute the requests with the most recent issue dates first."
+    )
+    retrieval_parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="Submit and poll the MARS jobs from a single event loop instead of blocking one thread per job, so that many jobs can be queued at once (--concurrent-jobs is then the number of jobs in flight)."
+    )
+    retrieval_parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        default=False,
+        help="Keep the totals of the run up to date in metrics/retrieval.prom in the landing folder, in the Prometheus text format."
+    )
+    retrieval_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        help="Maximum number of attempts per request for transient errors (overrides the config file)."
+    )
     retrieval_parser.add_argument(
         "--verbose",
         action="store_true",
@@ -62,6 +120,111 @@ def parse_args() -> argparse.Namespace:
         help="Enable verbose logging"
     ) # Not implemented yet
 
+    # === Resume retrieval pipeline ===
+    resume_parser = subparsers.add_parser("resume", help="Resume an interrupted retrieval run from its journal.")
+    resume_parser.add_argument(
+        "--run-id",
+        type=str,
+        help="ID of the run to resume. Defaults to the most recent unfinished run."
+    )
+    resume_parser.add_argument(
+        "--landing-path",
+        type=str,
+        help="Path to the landing folder containing the journal"
+    )
+    resume_parser.add_argument(
+        "--config-path",
+        type=str,
+        help="Path to the YAML configuration file (only used to locate the landing folder)"
+    )
+    resume_parser.add_argument(
+        "--max-concurrent-jobs",
+        type=int,
+        help="Upper bound for the adaptive concurrency. Concurrency starts at --concurrent-jobs, is halved when MARS rejects requests and grows back up to this value while latency stays stable. Defaults to --concurrent-jobs."
+    )
+    resume_parser.add_argument(
+        "--max-submit-rate",
+        type=float,
+        help="Global rate limit, in requests started per minute."
+    )
+    resume_parser.add_argument(
+        "--recent-first",
+        action="store_true",
+        default=False,
+        help="Execute the requests with the most recent issue dates first."
+    )
+    resume_parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="Submit and poll the MARS jobs from a single event loop instead of blocking one thread per job, so that many jobs can be queued at once (--concurrent-jobs is then the number of jobs in flight)."
+    )
+    resume_parser.add_argument(
+        "--prometheus",
+        action="store_true",
+        default=False,
+        help="Keep the totals of the run up to date in metrics/retrieval.prom in the landing folder, in the Prometheus text format."
+    )
+    resume_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        help="Maximum number of attempts per request for transient errors (overrides the journaled config)."
+    )
+    resume_parser.add_argument(
+        "--concurrent-jobs",
+        type=int,
+        default=1,
+        help="Maximum number of simultaneous API requests to execute. Default is 1 (sequential)."
+    )
+
+    # === Cost mapping ===
+    cost_parser = subparsers.add_parser("cost", help="Estimate the MARS cost of variable combinations without retrieving data.")
+    cost_parser.add_argument(
+        "--query-path",
+        type=str,
+        help="Path to the JSON file containing the list of time ranges and points"
+    )
+    cost_parser.add_argument(
+        "--config-path",
+        type=str,
+        help="Path to the YAML configuration file"
+    )
+    cost_parser.add_argument(
+        "--landing-path",
+        type=str,
+        help="Path to the landing folder where cost checks are cached"
+    )
+    cost_parser.add_argument(
+        "--variables",
+        type=str,
+        nargs="+",
+        help="Variables to combine. Defaults to the variables of the configuration."
+    )
+    cost_parser.add_argument(
+        "--max-combination-size",
+        type=int,
+        default=2,
+        help="Largest number of variables in a combination. Default is 2 (all single variables and pairs)."
+    )
+    cost_parser.add_argument(
+        "--sample-requests",
+        type=int,
+        default=1,
+        help="Number of requests of the query to estimate for each combination. Default is 1."
+    )
+    cost_parser.add_argument(
+        "--concurrent-jobs",
+        type=int,
+        default=4,
+        help="Number of cost checks to run concurrently. Default is 4."
+    )
+    cost_parser.add_argument(
+        "--output-path",
+        type=str,
+        help="Path of the output cost table (CSV). Defaults to 'variable_costs.csv' in the landing folder."
+    )
+
     # === Preprocessing pipeline ===
     preprocess_parser = subparsers.add_parser("preprocess", help="Run the data preprocessing pipeline.")
     preprocess_parser.add_argument(
@@ -74,5 +237,159 @@ def parse_args() -> argparse.Namespace:
         type=str,
         help="..."
     )
+    preprocess_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes extracting landing files in parallel. Default is 1 (sequential)."
+    )
+    preprocess_parser.add_argument(
+        "--interpolation",
+        type=str,
+        choices=["linear", "nearest"],
+        default="linear",
+        help="Interpolation method at the query points. Default is linear (bilinear)."
+    )
+    preprocess_parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["auto", "xarray", "eccodes"],
+        default="auto",
+        help="Reader of the landing files. 'auto' streams GRIB files with eccodes and opens other formats with xarray."
+    )
+    preprocess_parser.add_argument(
+        "--chunks",
+        type=str,
+        help="Open files read with xarray lazily with Dask, chunked as e.g. 'time=1,step=12,number=10', and stream them to staging."
+    )
+    preprocess_parser.add_argument(
+        "--layout",
+        type=str,
+        choices=["wide", "long"],
+        default="wide",
+        help="Layout of the staging rows: one column per variable ('wide', default) or one row per variable with 'variable' and 'value' columns ('long')."
+    )
+    preprocess_parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Log the time spent in each preprocessing stage (open, decode, interpolate, dataframe, metadata, concat, write)."
+    )
+    preprocess_parser.add_argument(
+        "--profile-output",
+        type=str,
+        help="Profile the run with cProfile and write the statistics to this file (e.g. preprocess.prof)."
+    )
+    preprocess_parser.add_argument(
+        "--rescan",
+        action="store_true",
+        default=False,
+        help="Ignore the saved position in the index and compare the whole index with the entries already in staging."
+    )
+    preprocess_parser.add_argument(
+        "--series-cache",
+        action="store_true",
+        default=False,
+        help="Also write the preprocessed entries to the memory-mapped series cache of the staging output (one .npy array per query, model, level and variable)."
+    )
+
+    # === Consolidation ===
+    consolidate_parser = subparsers.add_parser("consolidate", help="Append the landing files to one Zarr store per query.")
+    consolidate_parser.add_argument(
+        "--landing-path",
+        type=str,
+        help="Path to the folder containing the retrieved data files and their index"
+    )
+    consolidate_parser.add_argument(
+        "--store-path",
+        type=str,
+        help="Folder of the Zarr stores. Default is the 'zarr' folder of the landing path."
+    )
+    consolidate_parser.add_argument(
+        "--interpolation",
+        type=str,
+        choices=["linear", "nearest"],
+        default="linear",
+        help="Interpolation method at the query points. Default is linear (bilinear)."
+    )
+    consolidate_parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["auto", "xarray", "eccodes"],
+        default="auto",
+        help="Reader of the landing files. 'auto' streams GRIB files with eccodes and opens other formats with xarray."
+    )
+
+    # === Read staging ===
+    read_parser = subparsers.add_parser("read", help="Read forecasts from the staging output, by valid time.")
+    read_parser.add_argument(
+        "--staging-path",
+        type=str,
+        help="Path to the staging output (Parquet folder or .csv file)"
+    )
+    read_parser.add_argument(
+        "--config-path",
+        type=str,
+        help="Path to the YAML configuration file (only used to locate the staging output)"
+    )
+    read_parser.add_argument(
+        "--start",
+        type=str,
+        help="First valid time, e.g. 2016-01-02 or 2016-01-02T06:00 (UTC)."
+    )
+    read_parser.add_argument(
+        "--end",
+        type=str,
+        help="Last valid time (UTC)."
+    )
+    read_parser.add_argument(
+        "--max-lead-hours",
+        type=float,
+        help="Keep the forecasts with a lead time (step) of at most this many hours."
+    )
+    read_parser.add_argument(
+        "--as-of",
+        type=str,
+        help="Keep the forecasts issued at or before this time (UTC), e.g. to backtest."
+    )
+    read_parser.add_argument(
+        "--points",
+        type=int,
+        nargs="+",
+        help="Indexes of the query points to read (see --query-id)."
+    )
+    read_parser.add_argument(
+        "--query-id",
+        type=str,
+        help="Only read the entries of this query."
+    )
+    read_parser.add_argument(
+        "--model",
+        type=str,
+        help="Only read the entries of this model (hres or ens)."
+    )
+    read_parser.add_argument(
+        "--variables",
+        type=str,
+        nargs="+",
+        help="Variables to read, by their staging names (e.g. t2m u10)."
+    )
+    read_parser.add_argument(
+        "--latest",
+        action="store_true",
+        default=False,
+        help="Keep only the latest issue of each valid time and point."
+    )
+    read_parser.add_argument(
+        "--with-entries",
+        action="store_true",
+        default=False,
+        help="Join the metadata of the entries (query, retrieval, issued, ...) to the rows."
+    )
+    read_parser.add_argument(
+        "--output-path",
+        type=str,
+        help="Write the rows to this .csv or .parquet file instead of logging a summary of them."
+    )
 
     return parser.parse_args()
@@ -4,6 +4,8 @@ DEFAULT_LEVEL = "surface"
 DEFAULT_RETRIEVAL_MODE = "grid"
 ALLOWED_RETRIEVAL_MODES = ["point", "grid"]
 
+DEFAULT_COALESCE_POINTS = False
+
 DEFAULT_FORMAT = "netcdf"
 ALLOWED_FORMATS = ["grib2", "netcdf"]
 
@@ -13,4 +15,11 @@ DEFAULT_LANDING_PATH = "./data/landing/"
 DEFAULT_STAGING_PATH = "./data/staging/"
 
 DEFAULT_LOOKBACK = 48  # in hours
-DEFAULT_STEP_GRANULARITY = 1  # in hours
\ No newline at end of file
+DEFAULT_STEP_GRANULARITY = 1  # in hours
+
+DEFAULT_CHECKSUM = True
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_DELAY = 30.0  # in seconds
+DEFAULT_RETRY_MAX_DELAY = 600.0  # in seconds
+DEFAULT_FAILURE_RATE = 0.2  # failures per hour a MARS request runs
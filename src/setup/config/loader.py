@@ -10,7 +10,7 @@ from .schema import PipelineConfig
 
 def load_config(args: argparse.Namespace = None) -> PipelineConfig:
     # Load YAML configuration
-    path = Path(args.config_path) if args and args.config_path else Path(__file__).parent.parent.parent.parent / "config" / "config.yml"
+    path = Path(args.config_path) if args and getattr(args, "config_path", None) else Path(__file__).parent.parent.parent.parent / "config" / "config.yml"
     with path.open("r") as f:
         config_dict = yaml.safe_load(f)
 
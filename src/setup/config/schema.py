@@ -1,5 +1,5 @@
 from __future__ import annotations
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 from pathlib import Path
 
 from .defaults import (
@@ -7,8 +7,10 @@ from .defaults import (
     DEFAULT_LANDING_PATH, DEFAULT_STAGING_PATH,
     DEFAULT_MODEL, DEFAULT_LEVEL, ALLOWED_MODELS,
     DEFAULT_LOOKBACK, DEFAULT_STEP_GRANULARITY,
-    DEFAULT_RETRIEVAL_MODE, ALLOWED_RETRIEVAL_MODES,
+    DEFAULT_RETRIEVAL_MODE, ALLOWED_RETRIEVAL_MODES, DEFAULT_COALESCE_POINTS,
     DEFAULT_FORMAT, ALLOWED_FORMATS,
+    DEFAULT_CHECKSUM, DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_BASE_DELAY, DEFAULT_RETRY_MAX_DELAY,
+    DEFAULT_FAILURE_RATE,
 )
 
 
@@ -29,6 +31,7 @@ class PipelineConfig:
     # Query settings
     retrieval_mode: str = DEFAULT_RETRIEVAL_MODE
     batch_issue: bool | int = False
+    coalesce_points: bool = DEFAULT_COALESCE_POINTS
     format: str = DEFAULT_FORMAT
     query_path: Path = Path(DEFAULT_QUERY_PATH)
     variables: list[str] = field(default_factory=list)
@@ -36,6 +39,15 @@ class PipelineConfig:
     lookback: int = DEFAULT_LOOKBACK
     step_granularity: int = DEFAULT_STEP_GRANULARITY
 
+    # Download settings
+    checksum: bool = DEFAULT_CHECKSUM
+
+    # Retry settings
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS
+    retry_base_delay: float = DEFAULT_RETRY_BASE_DELAY
+    retry_max_delay: float = DEFAULT_RETRY_MAX_DELAY
+    failure_rate: float = DEFAULT_FAILURE_RATE
+
     def __post_init__(self):
         # Ensure paths are Path objects
         if not isinstance(self.landing_path, Path):
@@ -59,6 +71,18 @@ class PipelineConfig:
         if (isinstance(self.batch_issue, bool) and self.batch_issue) or not isinstance(self.batch_issue, (bool, int)):
             raise ValueError("batch_issue must be either False or an integer specifying the number of issue days to process at once.")
 
+        # Validate retry settings
+        if not isinstance(self.max_attempts, int) or self.max_attempts < 1:
+            raise ValueError("max_attempts must be an integer >= 1.")
+        if self.retry_base_delay < 0 or self.retry_max_delay < 0:
+            raise ValueError("retry_base_delay and retry_max_delay must be >= 0.")
+        if self.failure_rate < 0:
+            raise ValueError("failure_rate must be >= 0.")
+
         # Validate format
         if self.format not in ALLOWED_FORMATS:
             raise ValueError(f"Format '{self.format}' is not allowed. Choose from {ALLOWED_FORMATS}.")
+
+    def to_dict(self) -> dict:
+        """ Return the configuration as a JSON serializable dict. """
+        return {k: str(v) if isinstance(v, Path) else v for k, v in asdict(self).items()}
@@ -1,16 +1,62 @@
 from __future__ import annotations
+import os
 import time
 import json
 import hashlib
+import dataclasses
 from pathlib import Path
+from typing import Callable
 from dataclasses import dataclass
 
-import pandas as pd
-
 from . import logger
-from .query import Query
+from .query import Query, QueryGroup
+from .index import RetrievalIndex
 from .setup import PipelineConfig
+from .utils.geometry import AREA_POINTS_KEY, covered_points
+
+
+DATA_FILE_SIGNATURES = {
+    "grib2": [b"GRIB"],
+    "netcdf": [b"CDF\x01", b"CDF\x02", b"\x89HDF\r\n\x1a\n"],
+}
+
+
+GRIB_END_MARKER = b"7777"
+
+
+def validate_data_file(path: Path, format: str, size: int | None = None) -> bool:
+    """
+    Check that a data file exists, is not empty and starts with the signature of its format.
+    GRIB files must also end with the end marker of a message (truncated downloads do not), and
+    the size of the file must be `size` when it is known.
+    """
+    path = Path(path)
+    if not path.is_file() or path.stat().st_size == 0:
+        return False
+    if size is not None and path.stat().st_size != int(size):
+        return False
 
+    signatures = DATA_FILE_SIGNATURES.get(format)
+    if signatures is None:
+        logger.error(f"Unsupported format: {format}")
+        raise NotImplementedError(f"Format {format} not supported")
+
+    with path.open("rb") as f:
+        header = f.read(max(len(s) for s in signatures))
+        if format == "grib2":
+            f.seek(-len(GRIB_END_MARKER), os.SEEK_END)
+            if f.read() != GRIB_END_MARKER:
+                return False
+    return any(header.startswith(s) for s in signatures)
+
+
+def file_checksum(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """ SHA-256 of a file, read in chunks. """
+    digest = hashlib.sha256()
+    with Path(path).open("rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 @dataclass
 class RetrievalMeta:
@@ -28,6 +74,7 @@ class RetrievalMeta:
     issued: str
     area: str
     grid: str
+    area_points: str = ""  # query points a coalesced request was built for (see `encode_points`)
 
     @classmethod
     def from_request(cls, request: dict, config: PipelineConfig) -> RetrievalMeta:
@@ -38,13 +85,14 @@ class RetrievalMeta:
             retrieval_mode=config.retrieval_mode,
             batch_issue=config.batch_issue,
             format=config.format,
-            variables=config.variables,
+            variables=list(request.get("param", config.variables)),
             issue_hours=config.issue_hours,
             lookback=config.lookback,
             step_granularity=config.step_granularity,
             issued=request["date"] + f" {request['time']}:00",
             area=request["area"],
             grid=request["grid"],
+            area_points=request.get(AREA_POINTS_KEY, ""),
         )
 
     @property
@@ -64,18 +112,33 @@ class RetrievalTicket:
     query_file_path: Path
     cost_check_file_path: Path
     now: int
+    size: int | None = None  # in bytes, set when the download is committed
+    checksum: str | None = None  # SHA-256 of the data file
 
     @property
     def id(self) -> str:
         hash_input = (f"{self.meta.id}_{self.now}_{self.data_file_path}_{self.query_file_path}")
         return hashlib.sha256(hash_input.encode()).hexdigest()[:16]
 
+    @property
+    def part_file_path(self) -> Path:
+        """ Temporary file the data is downloaded to, renamed to `data_file_path` once validated. """
+        return self.data_file_path.with_name(self.data_file_path.name + ".part")
+
 class StorageManager:
 
     def __init__(self, base_folder: Path):
         self.base_folder = base_folder
         self.base_folder.mkdir(parents=True, exist_ok=True)
         self.index_file = self.base_folder / "index.csv"
+        self.index_db_file = self.base_folder / "index.sqlite"
+
+        legacy_index = self.index_file.exists() and not self.index_db_file.exists()
+        self.index = RetrievalIndex(self.index_db_file)
+        self.on_finalize: Callable[[dict], None] | None = None  # called with each new index entry
+        if legacy_index:
+            logger.info(f"Migrating legacy index {self.index_file} to {self.index_db_file}")
+            self.index.import_csv(self.index_file)
 
     def allocate(self, meta: RetrievalMeta, query: Query) -> RetrievalTicket:
         """ Allocate storage for a new retrieval based on its metadata. """
@@ -88,21 +151,24 @@ class StorageManager:
 
         now_timestamp = int(time.time())
 
+        # the retrieval ID tells apart requests for the same issue with different areas (point mode)
+        file_stem = f"ecmwf_{meta.model}_{meta.level}_{meta.issued.replace('/', '_')}_{now_timestamp}_{meta.id}"
         if meta.format == "netcdf":
             logger.debug("Allocating .nc data file")
-            data_file_path = data_subfolder / f"ecmwf_{meta.model}_{meta.level}_{meta.issued.replace('/', '_')}_{now_timestamp}.nc"
+            data_file_path = data_subfolder / f"{file_stem}.nc"
         elif meta.format == "grib2":
             logger.debug("Allocating .grib data file")
-            data_file_path = data_subfolder / f"ecmwf_{meta.model}_{meta.level}_{meta.issued.replace('/', '_')}_{now_timestamp}.grib"
+            data_file_path = data_subfolder / f"{file_stem}.grib"
         else:
             logger.error(f"Unsupported format: {meta.format}")
             raise NotImplementedError(f"Format {meta.format} not supported")
         logger.debug(f"Allocating data storage at {data_file_path}")
 
         query_file_path = queries_subfolder / f"query_{query.id}.json"
-        cost_check_file_path = queries_cost_subfolder / f"ecmwf_cost_{meta.model}_{meta.level}_{meta.issued.replace('/', '_')}_{now_timestamp}.txt"
+        cost_check_file_path = queries_cost_subfolder / f"{file_stem.replace('ecmwf_', 'ecmwf_cost_', 1)}.txt"
 
-        if data_file_path.exists():
+        part_file_path = data_file_path.with_name(data_file_path.name + ".part")
+        if data_file_path.exists() or part_file_path.exists():
             logger.error(f"File {data_file_path} already exists. Allocation failed.")
             raise FileExistsError(f"File {data_file_path} already exists.")
         if query_file_path.exists():
@@ -117,15 +183,112 @@ class StorageManager:
         )
 
     def finalize(self, ticket: RetrievalTicket, query: Query, success: bool) -> None:
-        """ Finalize the storage of a retrieval, updating the index. """
+        """
+        Finalize the storage of a retrieval, updating the index. A retrieval for a `QueryGroup`
+        is indexed once for each member query it covers.
+        """
         if success:
             logger.info(f"Success, finalizing storage for {ticket.data_file_path}")
-            self._save_query(query, ticket)
-            self._add_index_entry(query, ticket)
+            for member in self.attributed_queries(query, ticket.meta):
+                member_ticket = dataclasses.replace(
+                    ticket, query_file_path=ticket.query_file_path.with_name(f"query_{member.id}.json")
+                )
+                self._save_query(member, member_ticket)
+                entry = self._add_index_entry(member, member_ticket)
+                if self.on_finalize is not None:
+                    self.on_finalize(entry)
         else:
             logger.info(f"Removing potential incomplete file {ticket.data_file_path}")
-            if ticket.data_file_path.exists():
-                ticket.data_file_path.unlink()
+            for path in (ticket.part_file_path, ticket.data_file_path):
+                if path.exists():
+                    path.unlink()
+
+    def commit_download(
+        self,
+        ticket: RetrievalTicket,
+        size: int | None = None,
+        checksum: str | None = None,
+        compute_checksum: bool = True,
+    ) -> None:
+        """
+        Validate the downloaded part file of a ticket (advertised `size`, structure of its format)
+        and atomically rename it to the data file. The size and SHA-256 of the file (computed from
+        the file if not given) are kept on the ticket and recorded in the index by `finalize`.
+        """
+        part_file_path = ticket.part_file_path
+        if not validate_data_file(part_file_path, ticket.meta.format, size):
+            actual = part_file_path.stat().st_size if part_file_path.exists() else 0
+            logger.error(
+                f"Downloaded file {part_file_path} is not a valid {ticket.meta.format} file "
+                f"({actual} bytes, {size if size is not None else 'unknown'} expected)"
+            )
+            raise OSError(f"Downloaded file {part_file_path} is not a valid {ticket.meta.format} file")
+
+        ticket.size = part_file_path.stat().st_size
+        if checksum is None and compute_checksum:
+            checksum = file_checksum(part_file_path)
+        ticket.checksum = checksum
+        os.replace(part_file_path, ticket.data_file_path)
+        logger.debug(f"Download committed to {ticket.data_file_path} ({ticket.size} bytes, sha256 {checksum})")
+
+    def lookup(self, meta: RetrievalMeta) -> dict | None:
+        """ Return the most recent index entry for this retrieval whose data file is still valid, if any. """
+        entries = self.index.find(retrieval_id=meta.id, format=meta.format)
+        for entry in reversed(entries):
+            data_file_path = self.base_folder / entry["data_file"]
+            if validate_data_file(data_file_path, meta.format, entry.get("size")):
+                return entry
+            logger.debug(f"Cached file {data_file_path} is missing or invalid, ignoring entry {entry['entry_id']}")
+        return None
+
+    @staticmethod
+    def attributed_queries(query: Query, meta: RetrievalMeta) -> list[Query]:
+        """
+        Queries to index a retrieval under: the query itself, or the members of a `QueryGroup`
+        with points in the retrieved area and a time range overlapping the retrieved dates.
+        """
+        if not isinstance(query, QueryGroup):
+            return [query]
+
+        dates = meta.issued.split(" ")[0].split("/to/")
+        first, last = dates[0], dates[-1]
+        return [
+            member for member in query.members
+            if member.time_range.start.strftime("%Y-%m-%d") <= last
+            and member.time_range.end.strftime("%Y-%m-%d") >= first
+            and covered_points(member.points, meta.area, meta.area_points)
+        ]
+
+    def link(self, entry: dict, meta: RetrievalMeta, query: Query) -> None:
+        """ Register an already retrieved data file for the given query, unless it is already indexed for it. """
+        if isinstance(query, QueryGroup):
+            for member in self.attributed_queries(query, meta):
+                self.link(entry, meta, member)
+            return
+
+        if entry["query_id"] == query.id:
+            logger.debug(f"Entry {entry['entry_id']} already indexed for query {query.id}")
+            return
+
+        if any(e["data_file"] == entry["data_file"] for e in self.index.find(retrieval_id=meta.id, query_id=query.id)):
+            logger.debug(f"Data file {entry['data_file']} already indexed for query {query.id}")
+            return
+
+        ticket = RetrievalTicket(
+            meta=meta,
+            data_file_path=self.base_folder / entry["data_file"],
+            query_file_path=self.base_folder / "queries" / f"query_{query.id}.json",
+            cost_check_file_path=self.base_folder / entry["cost_check_file"],
+            now=int(time.time()),
+            size=entry.get("size"),
+            checksum=entry.get("checksum"),
+        )
+        ticket.query_file_path.parent.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Linking cached file {ticket.data_file_path} to query {query.id}")
+        self._save_query(query, ticket)
+        entry = self._add_index_entry(query, ticket)
+        if self.on_finalize is not None:
+            self.on_finalize(entry)
 
     def _save_query(self, query: Query, ticket: RetrievalTicket) -> None:
         """ Save the query metadata to a JSON file. """
@@ -134,8 +297,8 @@ class StorageManager:
             json.dump(query_data, f, indent=4)
         logger.debug(f"Query saved at {ticket.query_file_path}")
 
-    def _add_index_entry(self, query: Query, ticket: RetrievalTicket) -> None:
-        """ Add an entry to the index file. """
+    def _add_index_entry(self, query: Query, ticket: RetrievalTicket) -> dict:
+        """ Add an entry to the index file and return it. """
         entry = {
             # File paths
             "data_file": str(ticket.data_file_path.relative_to(self.base_folder)),
@@ -161,18 +324,22 @@ class StorageManager:
             "variables": ",".join(ticket.meta.variables),
 
             # Metadata (query computed)
+            "area": ticket.meta.area,
             "grid": ticket.meta.grid,
+            "area_points": ticket.meta.area_points,
+
+            # Data file integrity
+            "size": ticket.size,
+            "checksum": ticket.checksum,
 
             # Retrieval timestamp
             "timestamp": ticket.now,
         }
-        df_entry = pd.DataFrame([entry])
-
-        if self.index_file.exists():
-            df_index = pd.read_csv(self.index_file)
-            df_index = pd.concat([df_index, df_entry], ignore_index=True)
-        else:
-            df_index = df_entry
+        self.index.append(entry)
+        logger.debug(f"Index updated at {self.index_db_file}")
+        return entry
 
-        df_index.to_csv(self.index_file, index=False)
-        logger.debug(f"Index updated at {self.index_file}")
+    def export_index(self) -> None:
+        """ Export the index database to `index.csv` for inspection. """
+        self.index.export_csv(self.index_file)
+        logger.info(f"Index exported to {self.index_file}")
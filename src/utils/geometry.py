@@ -1,6 +1,25 @@
 from ..query import PointCloud
 
 
+# Key of the query points a coalesced request was built for (see `encode_points`), not sent to MARS
+AREA_POINTS_KEY = "_area_points"
+
+
+def cluster_points(points: PointCloud, max_extent: float) -> list[PointCloud]:
+    """ Greedily group points into clusters whose bounding box is at most `max_extent` degrees wide. """
+    clusters: list[list] = []
+    for p in sorted(points.points, key=lambda p: (p.lat, p.lon)):
+        for cluster in clusters:
+            lats = [q.lat for q in cluster] + [p.lat]
+            lons = [q.lon for q in cluster] + [p.lon]
+            if max(lats) - min(lats) <= max_extent and max(lons) - min(lons) <= max_extent:
+                cluster.append(p)
+                break
+        else:
+            clusters.append([p])
+    return [PointCloud(c) for c in clusters]
+
+
 def get_smallest_bounding_box(pc: PointCloud, res: float) -> tuple[float, float, float, float]:
     """
     Calculates the smallest axis-aligned bounding box that contains all points in the given PointCloud, 
@@ -22,3 +41,40 @@ def get_smallest_bounding_box(pc: PointCloud, res: float) -> tuple[float, float,
         snap(lon_min, res, mode="down"),
         snap(lon_max, res, mode="up"),
     )
+
+
+def encode_points(points: PointCloud) -> str:
+    """ Coordinates of the points as `lat,lon;lat,lon`, to record which points a request was built for. """
+    return ";".join(f"{p.lat},{p.lon}" for p in points.points)
+
+
+def points_in_list(points: PointCloud, encoded: str) -> list[int]:
+    """ Indexes of the points among the coordinates recorded with `encode_points`. """
+    coords = {tuple(float(v) for v in item.split(",")) for item in encoded.split(";") if item}
+    return [i for i, p in enumerate(points.points) if (p.lat, p.lon) in coords]
+
+
+def points_in_area(points: PointCloud, area: str) -> list[int]:
+    """
+    Indexes of the points inside a MARS area `N/W/S/E`. Areas are already snapped outward to
+    the grid, so no tolerance is added beyond the float rounding of their edges.
+    """
+    north, west, south, east = (float(v) for v in str(area).split("/"))
+    eps = 1e-9
+    return [
+        i for i, p in enumerate(points.points)
+        if south - eps <= p.lat <= north + eps and west - eps <= p.lon <= east + eps
+    ]
+
+
+def covered_points(points: PointCloud, area: str | None, area_points: str | None = None) -> list[int]:
+    """
+    Indexes of the points a retrieval was made for: the recorded `area_points` of a coalesced
+    request, else the points inside its area (every point without area). Each query point is
+    thus extracted from a single file, even where the areas of coalesced requests overlap.
+    """
+    if area_points:
+        return points_in_list(points, area_points)
+    if not area:
+        return list(range(len(points.points)))
+    return points_in_area(points, area)
@@ -0,0 +1,87 @@
+from __future__ import annotations
+import time
+import cProfile
+from pathlib import Path
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from . import logger
+
+
+class StageTimer:
+    """
+    Accumulates the wall time and number of calls of the named stages of a pipeline.
+
+    Stages are timed with `with timer.stage("name"):`. A disabled timer hands out a no-op
+    context manager, so stages can stay instrumented in hot loops. Timings collected in
+    other processes are returned with `pop` and added back with `merge`.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.seconds: dict[str, float] = defaultdict(float)
+        self.calls: dict[str, int] = defaultdict(int)
+
+    def stage(self, name: str):
+        return self._timed(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def to_dict(self) -> dict[str, dict]:
+        return {name: {"seconds": self.seconds[name], "calls": self.calls[name]} for name in self.seconds}
+
+    def pop(self) -> dict[str, dict]:
+        """ Return the timings collected so far and reset them. """
+        timings = self.to_dict()
+        self.seconds.clear()
+        self.calls.clear()
+        return timings
+
+    def merge(self, timings: dict[str, dict]) -> None:
+        for name, timing in timings.items():
+            self.seconds[name] += timing["seconds"]
+            self.calls[name] += timing["calls"]
+
+    def log_summary(self, title: str, wall: float | None = None) -> None:
+        """ Log the time of each stage, slowest first, with its share of `wall` if given. """
+        if not self.seconds:
+            logger.info(f"{title}: no stage timed.")
+            return
+        logger.info(f"{title}" + (f" in {wall:.2f}s:" if wall else ":"))
+        for name, seconds in sorted(self.seconds.items(), key=lambda item: -item[1]):
+            share = f" ({100 * seconds / wall:.0f}%)" if wall else ""
+            calls = self.calls[name]
+            logger.info(f"  - {name}: {seconds:.3f}s{share} in {calls} calls, {1e3 * seconds / calls:.2f}ms per call")
+
+
+# Stages of the preprocessing, shared by its modules (one timer per process)
+timer = StageTimer()
+
+
+@contextmanager
+def profiled(output_path: Path | str | None):
+    """
+    Run the enclosed block under cProfile and dump the statistics to `output_path`, in the
+    `pstats` format (readable by `python -m pstats`, snakeviz or gprof2dot). No-op if None.
+    """
+    if output_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(output_path)
+        logger.info(f"Profile written to {output_path} (inspect with 'python -m pstats {output_path}')")